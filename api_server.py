@@ -21,9 +21,10 @@ import uuid
 
 # Import chat agent and model components
 from chat_agent import CGEModelChatAgent
-from solver import Model, ModelException, run_model
+from solver import ModelException, get_policy_engine
+import writers
+from workerpool import WorkerPool
 import yaml
-import pandas as pd
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -57,6 +58,14 @@ MODEL_DIR = Path(__file__).parent.absolute()
 CACHE_DIR = MODEL_DIR / "cache"
 CACHE_DIR.mkdir(exist_ok=True)
 
+# Baseline trajectories, shared by every scenario (and process) using the same base closures
+BASE_CACHE_DIR = CACHE_DIR / "bases"
+
+# Scenarios run on a pool of worker processes that each hold the set up model, so a scenario
+# only costs its solve. CGE_SCENARIO_WORKERS=0 runs them in the server process instead
+SCENARIO_WORKERS = int(os.environ.get("CGE_SCENARIO_WORKERS", "2"))
+worker_pool: Optional[WorkerPool] = None
+
 
 # Pydantic Models for Request/Response
 class ShockRequest(BaseModel):
@@ -73,6 +82,7 @@ class RunScenarioRequest(BaseModel):
     shocks: Dict[str, float] = Field(..., description="Dictionary of variable shocks")
     reporting_vars: Optional[List[str]] = Field(None, description="Variables to include in output")
     output_dir: Optional[str] = Field(None, description="Directory for output files")
+    output_format: str = Field("xlsx", description="Format of the output files: xlsx, parquet, arrow or csv")
 
 
 class ChatRequest(BaseModel):
@@ -90,6 +100,7 @@ class ScenarioStatusResponse(BaseModel):
     completed_at: Optional[str] = None
     error: Optional[str] = None
     output_dir: Optional[str] = None
+    progress: Optional[Dict[str, int]] = None
 
 
 class ScenarioResultsResponse(BaseModel):
@@ -129,7 +140,42 @@ class CompareScenariosRequest(BaseModel):
 
 # Cache Functions
 
-def generate_cache_key(year: int, steps: int, shocks: Dict[str, float], reporting_vars: Optional[List[str]] = None) -> str:
+def record_scenario_step(scenario_id: str, simtype: str, step: int, svarnames: List[str], values):
+    """Record a completed step of a running scenario, for its status and partial results"""
+    scenario = scenarios_db.get(scenario_id)
+    if scenario is None:
+        return
+    scenario.setdefault("progress", {"base": 0, "policy": 0})[simtype] = step + 1
+    if simtype == "policy":
+        scenario.setdefault("partial_results", {})[f"S{step}"] = dict(zip(svarnames, values.tolist()))
+
+
+@app.on_event("startup")
+def start_worker_pool():
+    """Set up the model in the server, which checks every scenario, and start the scenario workers"""
+    global worker_pool
+    get_policy_engine(model_file="orani.model", cachedir=str(BASE_CACHE_DIR), basedir=str(MODEL_DIR))
+    
+    # Runs on the event loop before any request is served, so before the server has started
+    # threads of its own (run_in_executor starts them on first use) and the workers can be forked
+    if SCENARIO_WORKERS > 0:
+        worker_pool = WorkerPool(
+            SCENARIO_WORKERS, MODEL_DIR, model_file="orani.model",
+            cachedir=str(BASE_CACHE_DIR), onstep=record_scenario_step
+        )
+
+
+@app.on_event("shutdown")
+def stop_worker_pool():
+    """Stop the scenario workers"""
+    global worker_pool
+    if worker_pool is not None:
+        worker_pool.shutdown()
+        worker_pool = None
+
+
+def generate_cache_key(year: int, steps: int, shocks: Dict[str, float], reporting_vars: Optional[List[str]] = None,
+                       output_format: str = "xlsx") -> str:
     """
     Generate a cache key from scenario parameters.
     Uses hash to create a unique identifier for identical parameter combinations.
@@ -144,6 +190,9 @@ def generate_cache_key(year: int, steps: int, shocks: Dict[str, float], reportin
         "shocks": sorted_shocks,
         "reporting_vars": sorted(reporting_vars) if reporting_vars else None
     }
+    # Excel results keep the keys they had before there was a choice of format
+    if output_format != "xlsx":
+        cache_data["output_format"] = output_format
     
     # Convert to JSON string and hash it
     cache_string = json.dumps(cache_data, sort_keys=True)
@@ -157,24 +206,40 @@ def get_cache_path(cache_key: str) -> Path:
     return CACHE_DIR / cache_key
 
 
-def cache_exists(cache_key: str) -> bool:
+def results_file(stem: str, output_format: str = "xlsx") -> str:
+    """Name of the file holding the svars of a simulation (base or policy)"""
+    if output_format == "xlsx":
+        return f"{stem}.xlsx"
+    return writers.table_path(stem, "svars", output_format)
+
+
+def list_output_files(directory: Path, output_format: str = "xlsx") -> List[str]:
+    """Names of the base, policy and summary output files in a directory"""
+    return [
+        os.path.basename(path)
+        for stem in ["base", "policy", "summary"]
+        for path in writers.output_paths(str(directory / stem), output_format)
+    ]
+
+
+def cache_exists(cache_key: str, output_format: str = "xlsx") -> bool:
     """Check if cached results exist for a given cache key"""
     cache_path = get_cache_path(cache_key)
-    base_file = cache_path / "base.xlsx"
-    policy_file = cache_path / "policy.xlsx"
+    base_file = cache_path / results_file("base", output_format)
+    policy_file = cache_path / results_file("policy", output_format)
     return base_file.exists() and policy_file.exists()
 
 
-def save_to_cache(cache_key: str, source_dir: Path, scenario_id: Optional[str] = None):
+def save_to_cache(cache_key: str, source_dir: Path, scenario_id: Optional[str] = None, output_format: str = "xlsx"):
     """
     Save results from source_dir to cache.
-    Copies base.xlsx, policy.xlsx, and summary.xlsx to cache.
+    Copies the base, policy and summary files to cache.
     Also creates a mapping file linking scenario_id to cache_key.
     """
     cache_path = get_cache_path(cache_key)
     cache_path.mkdir(parents=True, exist_ok=True)
     
-    output_files = ["base.xlsx", "policy.xlsx", "summary.xlsx"]
+    output_files = list_output_files(source_dir, output_format)
     for filename in output_files:
         src = source_dir / filename
         dst = cache_path / filename
@@ -203,19 +268,19 @@ def save_to_cache(cache_key: str, source_dir: Path, scenario_id: Optional[str] =
             json.dump({"cache_key": cache_key, "scenario_id": scenario_id}, f, indent=2)
 
 
-def load_from_cache(cache_key: str, target_dir: Path, scenario_id: Optional[str] = None):
+def load_from_cache(cache_key: str, target_dir: Path, scenario_id: Optional[str] = None, output_format: str = "xlsx"):
     """
     Load cached results to target_dir.
     Copies cached files to the target output directory.
     Also creates mapping files linking scenario_id to cache_key.
     """
     cache_path = get_cache_path(cache_key)
-    if not cache_exists(cache_key):
+    if not cache_exists(cache_key, output_format):
         raise FileNotFoundError(f"Cache not found for key: {cache_key}")
     
     target_dir.mkdir(parents=True, exist_ok=True)
     
-    output_files = ["base.xlsx", "policy.xlsx", "summary.xlsx"]
+    output_files = list_output_files(cache_path, output_format)
     for filename in output_files:
         src = cache_path / filename
         dst = target_dir / filename
@@ -275,20 +340,26 @@ async def run_scenario(request: RunScenarioRequest, background_tasks: Background
     - **steps**: Number of years to simulate (default: 1)
     - **shocks**: Dictionary of variable shocks {variable_name: shock_value}
     - **reporting_vars**: Optional list of variables to include in output
+    - **output_format**: Format of the output files - xlsx (default), parquet, arrow or csv
     
     **Caching**: If a scenario with identical parameters has been run before,
     cached results are returned immediately without re-running the model.
     """
+    format_error = writers.check_format(request.output_format)
+    if format_error is not None:
+        raise HTTPException(status_code=400, detail=format_error)
+    
     # Generate cache key from parameters
     cache_key = generate_cache_key(
         request.year,
         request.steps,
         request.shocks,
-        request.reporting_vars
+        request.reporting_vars,
+        request.output_format
     )
     
     # Check if cache exists
-    if cache_exists(cache_key):
+    if cache_exists(cache_key, request.output_format):
         # Generate scenario ID (UUID) and output directory (use scenario_id)
         scenario_id = str(uuid.uuid4())
         output_dir = request.output_dir or f"outputs/{scenario_id}"
@@ -307,7 +378,8 @@ async def run_scenario(request: RunScenarioRequest, background_tasks: Background
             load_from_cache,
             cache_key,
             output_path,
-            scenario_id
+            scenario_id,
+            request.output_format
         )
         
         # Store scenario info
@@ -321,6 +393,7 @@ async def run_scenario(request: RunScenarioRequest, background_tasks: Background
             "steps": request.steps,
             "shocks": request.shocks,
             "output_dir": output_dir,
+            "output_format": request.output_format,
             "cached": True,
             "cache_key": cache_key
         }
@@ -340,6 +413,17 @@ async def run_scenario(request: RunScenarioRequest, background_tasks: Background
     output_dir = request.output_dir or f"outputs/{scenario_id}"
     started_at = datetime.now().isoformat()
     
+    # Reject shocks that leave the model unsolvable now, rather than once the run has failed
+    config = create_scenario_config(
+        request.scenario_name, request.year, request.steps, request.shocks,
+        request.reporting_vars, output_dir, request.output_format
+    )
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, check_scenario, config)
+    except (ModelException, OSError, ValueError, TypeError) as e:
+        # Unsolvable closures, closure files that cannot be read and settings that are not valid
+        raise HTTPException(status_code=400, detail=str(e))
+    
     # Store scenario info (minimal synchronous operation)
     scenarios_db[scenario_id] = {
         "scenario_id": scenario_id,
@@ -350,6 +434,7 @@ async def run_scenario(request: RunScenarioRequest, background_tasks: Background
         "steps": request.steps,
         "shocks": request.shocks,
         "output_dir": output_dir,
+        "output_format": request.output_format,
         "cache_key": cache_key
     }
     
@@ -363,7 +448,8 @@ async def run_scenario(request: RunScenarioRequest, background_tasks: Background
         request.shocks,
         request.reporting_vars,
         output_dir,
-        cache_key
+        cache_key,
+        request.output_format
     )
     
     # Yield control to event loop to ensure response is sent immediately
@@ -386,7 +472,8 @@ async def execute_scenario(
     shocks: Dict[str, float],
     reporting_vars: Optional[List[str]],
     output_dir: str,
-    cache_key: str
+    cache_key: str,
+    output_format: str = "xlsx"
 ):
     """Execute scenario in background (async wrapper for blocking operations)"""
     try:
@@ -402,7 +489,8 @@ async def execute_scenario(
             shocks,
             reporting_vars,
             output_dir,
-            cache_key
+            cache_key,
+            output_format
         )
     except Exception as e:
         scenarios_db[scenario_id]["status"] = "error"
@@ -418,103 +506,52 @@ def _execute_scenario_sync(
     shocks: Dict[str, float],
     reporting_vars: Optional[List[str]],
     output_dir: str,
-    cache_key: str
+    cache_key: str,
+    output_format: str = "xlsx"
 ):
     """Synchronous execution of scenario (runs in thread pool)"""
     try:
         # Create config
         config = create_scenario_config(
-            scenario_name, year, steps, shocks, reporting_vars, output_dir
+            scenario_name, year, steps, shocks, reporting_vars, output_dir, output_format
         )
         
-        # Create temp config file
-        import tempfile
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.yml', delete=False, dir=MODEL_DIR) as f:
-            yaml.dump(config, f)
-            config_path = f.name
+        # Publish each step as it completes, so the status shows how far the run has got and
+        # the policy results can be followed before the run finishes
+        scenarios_db[scenario_id]["progress"] = {"base": 0, "policy": 0}
+        scenarios_db[scenario_id]["partial_results"] = {}
         
-        # Change to model directory
-        original_dir = os.getcwd()
-        os.chdir(MODEL_DIR)
+        # Prepare output directory (use absolute path)
+        output_path = Path(output_dir)
+        if not output_path.is_absolute():
+            output_path = MODEL_DIR / output_path
+        output_path.mkdir(parents=True, exist_ok=True)
         
-        try:
-            # Run model
-            run_model(model_file="orani.model", do_policy=True)
-            
-            # Prepare output directory (use absolute path)
-            output_path = Path(output_dir)
-            if not output_path.is_absolute():
-                output_path = MODEL_DIR / output_path
-            output_path.mkdir(parents=True, exist_ok=True)
-            
-            # Move output files from current directory (MODEL_DIR) to output directory
-            # Since we're in MODEL_DIR after chdir, files should be in current working directory
-            output_files = ["base.xlsx", "policy.xlsx", "summary.xlsx"]
-            files_moved = []
-            files_missing = []
-            
-            # Get current working directory (should be MODEL_DIR)
-            current_dir = Path.cwd()
-            
-            for filename in output_files:
-                # Try multiple possible locations
-                possible_srcs = [
-                    current_dir / filename,  # Current directory (MODEL_DIR after chdir)
-                    MODEL_DIR / filename,     # Explicit MODEL_DIR path
-                    Path(filename)           # Relative to current directory
-                ]
-                
-                src = None
-                for possible_src in possible_srcs:
-                    if possible_src.exists():
-                        src = possible_src
-                        break
-                
-                dst = output_path / filename
-                
-                if src and src.exists():
-                    try:
-                        # Use absolute paths for move operation
-                        shutil.move(str(src.resolve()), str(dst.resolve()))
-                        files_moved.append(filename)
-                    except Exception as move_error:
-                        # If move fails, try copy then delete
-                        try:
-                            shutil.copy2(str(src.resolve()), str(dst.resolve()))
-                            src.unlink()
-                            files_moved.append(filename)
-                        except Exception as copy_error:
-                            # Log error but continue
-                            print(f"Warning: Failed to move {filename}: {move_error}, {copy_error}")
-                            files_missing.append(filename)
-                else:
-                    files_missing.append(filename)
-                    print(f"Warning: Output file {filename} not found. Tried: {[str(p) for p in possible_srcs]}")
-            
-            # Verify critical files were moved successfully
-            critical_files = ["base.xlsx", "policy.xlsx"]
-            missing_critical = [f for f in critical_files if f in files_missing]
-            
-            if missing_critical:
-                raise FileNotFoundError(
-                    f"Failed to move critical output files: {', '.join(missing_critical)}. "
-                    f"Files moved: {', '.join(files_moved) if files_moved else 'none'}. "
-                    f"Current directory: {current_dir}, MODEL_DIR: {MODEL_DIR}"
-                )
-            
-            # Save to cache for future use (only if we have base and policy)
-            if "base.xlsx" in files_moved and "policy.xlsx" in files_moved:
-                save_to_cache(cache_key, output_path, scenario_id)
-            
-            # Update status
-            scenarios_db[scenario_id]["status"] = "completed"
-            scenarios_db[scenario_id]["completed_at"] = datetime.now().isoformat()
-            scenarios_db[scenario_id]["cache_key"] = cache_key
-            
-        finally:
-            os.chdir(original_dir)
-            if os.path.exists(config_path):
-                os.unlink(config_path)
+        # The output files are written straight into the output directory
+        if worker_pool is not None:
+            worker_pool.run(config, output_path, scenario_id)
+        else:
+            _run_in_server(scenario_id, config, output_path)
+        files_written = list_output_files(output_path, output_format)
+        
+        # Verify critical files were written
+        critical_files = [results_file("base", output_format), results_file("policy", output_format)]
+        missing_critical = [f for f in critical_files if f not in files_written]
+        
+        if missing_critical:
+            raise FileNotFoundError(
+                f"Missing critical output files: {', '.join(missing_critical)}. "
+                f"Files written: {', '.join(files_written) if files_written else 'none'}. "
+                f"Output directory: {output_path}"
+            )
+        
+        # Save to cache for future use (only if we have base and policy)
+        save_to_cache(cache_key, output_path, scenario_id, output_format)
+        
+        # Update status
+        scenarios_db[scenario_id]["status"] = "completed"
+        scenarios_db[scenario_id]["completed_at"] = datetime.now().isoformat()
+        scenarios_db[scenario_id]["cache_key"] = cache_key
                 
     except Exception as e:
         scenarios_db[scenario_id]["status"] = "error"
@@ -522,22 +559,45 @@ def _execute_scenario_sync(
         scenarios_db[scenario_id]["error_traceback"] = traceback.format_exc()
 
 
+def check_scenario(config: Dict[str, Any]):
+    """
+    Check that a scenario's closures, with its shocks applied, can be solved - without running
+    anything. Raises a ModelException naming the problem equations and variables if not, an
+    OSError if a closure file cannot be read, or a ValueError/TypeError for settings that are
+    not valid (eg a shock that is not a number).
+    """
+    engine = get_policy_engine(model_file="orani.model", cachedir=str(BASE_CACHE_DIR), basedir=str(MODEL_DIR))
+    engine.check_scenario(config)
+
+
+def _run_in_server(scenario_id: str, config: Dict[str, Any], output_path: Path):
+    """
+    Run a scenario in the server process (when there is no worker pool), writing its output
+    files to the output directory. Nothing depends on the current directory, so scenarios can
+    run on several threads at once.
+    """
+    def record_step(result):
+        record_scenario_step(scenario_id, result.simtype, result.step, result.svarnames, result.aggregated_svars())
+    
+    # Run the policy against the shared engine - the baseline is only solved
+    # the first time it is needed
+    engine = get_policy_engine(model_file="orani.model", cachedir=str(BASE_CACHE_DIR), basedir=str(MODEL_DIR))
+    engine.run_policy(dict(config, outputdir=str(output_path)), callback=record_step)
+
+
 def create_scenario_config(
     scenario_name: str, year: int, steps: int,
     shocks: Dict[str, float], reporting_vars: Optional[List[str]],
-    output_dir: str
+    output_dir: str, output_format: str = "xlsx"
 ) -> Dict[str, Any]:
     """Create scenario configuration"""
     with open(MODEL_DIR / "default.yml", 'r') as f:
         base_config = yaml.safe_load(f)
     
-    # Create closure files
+    # The policy closures are the base closures with the shocks applied in memory by the model
     base_closures = []
-    policy_closures = []
     
     closures_dir = MODEL_DIR / "closures"
-    temp_closures_dir = MODEL_DIR / f"temp_closures/{scenario_name}"
-    temp_closures_dir.mkdir(parents=True, exist_ok=True)
     
     for step in range(steps):
         current_year = year + step
@@ -545,34 +605,26 @@ def create_scenario_config(
         if not base_closure.exists():
             base_closure = closures_dir / "base2023.txt"
         base_closures.append(str(base_closure))
-        
-        policy_closure = temp_closures_dir / f"pol{current_year}.txt"
-        create_shock_closure(base_closure, shocks, policy_closure)
-        policy_closures.append(str(policy_closure))
     
     config = base_config.copy()
     config["steps"] = steps
     config["basefiles"] = base_closures
-    config["polfiles"] = policy_closures
+    config["polfiles"] = base_closures
+    config["shocks"] = shocks
     if reporting_vars:
         config["reportingvars"] = reporting_vars
+    config["outputformat"] = output_format
     
     return config
 
 
-def _read_results_files(output_dir: Path, variables: Optional[str] = None) -> Dict[str, Any]:
+def _read_results_files(output_dir: Path, variables: Optional[str] = None, output_format: str = "xlsx") -> Dict[str, Any]:
     """Read results files synchronously (runs in thread pool)"""
-    base_file = output_dir / "base.xlsx"
-    policy_file = output_dir / "policy.xlsx"
-    
     results = {}
-    if base_file.exists():
-        base_df = pd.read_excel(base_file, sheet_name="svars")
-        results["base"] = base_df.to_dict(orient="records")
-    
-    if policy_file.exists():
-        policy_df = pd.read_excel(policy_file, sheet_name="svars")
-        results["policy"] = policy_df.to_dict(orient="records")
+    for sim_type in ["base", "policy"]:
+        if (output_dir / results_file(sim_type, output_format)).exists():
+            df = writers.read_long(str(output_dir / sim_type), "svars", output_format, "SVAR")
+            results[sim_type] = df.to_dict(orient="records")
     
     if variables:
         var_list = [v.strip() for v in variables.split(",")]
@@ -587,37 +639,6 @@ def _read_results_files(output_dir: Path, variables: Optional[str] = None) -> Di
     return results
 
 
-def create_shock_closure(base_closure: Path, shocks: Dict[str, float], output_path: Path):
-    """Create closure file with shocks"""
-    lines = []
-    if base_closure.exists():
-        with open(base_closure, 'r') as f:
-            lines = [line.strip() for line in f.readlines() if line.strip()]
-    
-    for var_name, shock_value in shocks.items():
-        var_found = False
-        for i, line in enumerate(lines):
-            if line.startswith('shock') and var_name in line:
-                lines[i] = f"shock {var_name} {shock_value}"
-                var_found = True
-                break
-            elif line.startswith('add') and var_name in line:
-                var_found = True
-                if not any(lines[j].startswith('shock') and var_name in lines[j] 
-                          for j in range(i+1, len(lines))):
-                    lines.insert(i+1, f"shock {var_name} {shock_value}")
-                break
-        
-        if not var_found:
-            lines.append(f"add {var_name}")
-            lines.append(f"shock {var_name} {shock_value}")
-    
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_path, 'w') as f:
-        for line in lines:
-            f.write(line + '\n')
-
-
 @app.get("/api/v1/scenarios/{scenario_id}/status", response_model=ScenarioStatusResponse, tags=["Scenarios"])
 async def get_scenario_status(scenario_id: str):
     """
@@ -632,6 +653,33 @@ async def get_scenario_status(scenario_id: str):
     return ScenarioStatusResponse(**scenario)
 
 
+@app.get("/api/v1/scenarios/{scenario_id}/partial", response_model=ScenarioResultsResponse, tags=["Scenarios"])
+async def get_scenario_partial_results(scenario_id: str, variables: Optional[str] = None):
+    """
+    Get the policy results of the steps completed so far, while a scenario is still running
+    
+    - **scenario_id**: Scenario ID
+    - **variables**: Comma-separated list of variables to retrieve (optional)
+    """
+    if scenario_id not in scenarios_db:
+        raise HTTPException(status_code=404, detail=f"Scenario {scenario_id} not found")
+    
+    # A copy, as the run may still be adding steps
+    partial = dict(scenarios_db[scenario_id].get("partial_results", {}))
+    
+    names = list(next(iter(partial.values()))) if partial else []
+    if variables:
+        var_list = [v.strip() for v in variables.split(",")]
+        names = [name for name in names if any(var in name for var in var_list)]
+    
+    rows = [{"SVAR": name, **{step: values[name] for step, values in partial.items()}} for name in names]
+    return ScenarioResultsResponse(
+        scenario_id=scenario_id,
+        results={"policy": rows},
+        format="json"
+    )
+
+
 @app.get("/api/v1/scenarios/{scenario_id}/results", response_model=ScenarioResultsResponse, tags=["Scenarios"])
 async def get_scenario_results(
     scenario_id: str,
@@ -658,6 +706,7 @@ async def get_scenario_results(
     output_dir = Path(scenario.get("output_dir", f"outputs/{scenario_id}"))
     if not output_dir.is_absolute():
         output_dir = MODEL_DIR / output_dir
+    output_format = scenario.get("output_format", "xlsx")
     
     if format == "json":
         try:
@@ -667,7 +716,8 @@ async def get_scenario_results(
                 None,
                 _read_results_files,
                 output_dir,
-                variables
+                variables,
+                output_format
             )
             
             return ScenarioResultsResponse(
@@ -682,38 +732,62 @@ async def get_scenario_results(
         return ScenarioResultsResponse(
             scenario_id=scenario_id,
             results={
-                "base_file": str(output_dir / "base.xlsx"),
-                "policy_file": str(output_dir / "policy.xlsx")
+                "base_file": str(output_dir / results_file("base", output_format)),
+                "policy_file": str(output_dir / results_file("policy", output_format))
             },
-            format="excel"
+            format="excel" if output_format == "xlsx" else output_format
         )
 
 
 @app.get("/api/v1/scenarios/{scenario_id}/download/{file_type}", tags=["Scenarios"])
-async def download_scenario_file(scenario_id: str, file_type: str):
+async def download_scenario_file(scenario_id: str, file_type: str, table: Optional[str] = None):
     """
     Download scenario result files
     
     - **scenario_id**: Scenario ID
-    - **file_type**: "base" or "policy"
+    - **file_type**: "base", "policy" or "summary"
+    - **table**: For the columnar output formats, which table to download - "svars" (the default)
+      or "dvars" for base and policy, a tab of the write statements for summary. An Excel
+      workbook holds all of its tables, so this is not used for xlsx
     """
     if scenario_id not in scenarios_db:
         raise HTTPException(status_code=404, detail=f"Scenario {scenario_id} not found")
+    if file_type not in ["base", "policy", "summary"]:
+        raise HTTPException(status_code=400, detail=f"file_type must be one of base, policy or summary, got '{file_type}'")
     
     scenario = scenarios_db[scenario_id]
     output_dir = Path(scenario.get("output_dir", f"outputs/{scenario_id}"))
     if not output_dir.is_absolute():
         output_dir = MODEL_DIR / output_dir
     
-    file_path = output_dir / f"{file_type}.xlsx"
-    
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail=f"File {file_type}.xlsx not found")
-    
+    # The files are found the same way list_output_files finds them
+    output_format = scenario.get("output_format", "xlsx")
+    stem = str(output_dir / file_type)
+    paths = writers.output_paths(stem, output_format)
+    if output_format != "xlsx":
+        tables = writers.table_names(stem, output_format)
+        if table is None and file_type in ["base", "policy"]:
+            table = "svars"
+        if table is None:
+            if len(tables) != 1:
+                raise HTTPException(status_code=400, detail=f"Name the table to download, one of {', '.join(tables) if tables else 'none'}")
+            table = tables[0]
+        paths = [path for path, name in zip(paths, tables) if name == table]
+    
+    if not paths:
+        missing = file_type if output_format == "xlsx" else f"{file_type} {table}"
+        raise HTTPException(status_code=404, detail=f"No {missing} file found")
+    file_path = Path(paths[0])
+    filename = file_path.name
+    
+    media_types = {
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "csv": "text/csv"
+    }
     return FileResponse(
         path=str(file_path),
-        filename=f"{scenario_id}_{file_type}.xlsx",
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        filename=f"{scenario_id}_{filename}",
+        media_type=media_types.get(output_format, "application/octet-stream")
     )
 
 
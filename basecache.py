@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+On disk cache of baseline trajectories.
+
+The baseline depends only on the model file, the input data, the base closure
+files and the number of steps and substeps, so its trajectory (the svar and dvar
+history that the policy run and the writes draw on) is stored against a hash of
+exactly those. Any process pointed at the same cache directory can then skip
+the baseline simulation.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+# Bump this whenever the contents of a cache entry (or how the baseline is solved) changes
+BASECACHE_VERSION = 2
+
+
+def base_key(model_file, datafiles, basefiles, steps, substeps):
+    '''
+    Build the content address of a baseline
+
+    Parameters
+    ----------
+    model_file: Path to the model file
+    datafiles: List of paths to the input data files
+    basefiles: List of paths to the base closure files, in step order
+    steps: Number of steps
+    substeps: Number of substeps
+
+    Returns
+    -------
+    The hex digest identifying the baseline
+    '''
+    h = hashlib.sha256()
+    h.update(f"basecache {BASECACHE_VERSION} steps {steps} substeps {substeps}\n".encode())
+
+    for label, paths in [("model", [model_file]), ("data", datafiles), ("closure", basefiles)]:
+        for path in paths:
+            h.update(f"{label} {len(paths)}\n".encode())
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    h.update(chunk)
+            h.update(b"\n")
+
+    return h.hexdigest()
+
+
+class BaseCache(object):
+    '''
+    BaseCache
+
+    A directory of baseline trajectories. Each entry is a single .npz file named by its key,
+    holding the svar and dvar histories as (steps, substeps, n) arrays.
+    '''
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key + ".npz")
+
+    def load(self, key):
+        '''
+        Returns
+        -------
+        [basesvarvals, basedvarvals] as (steps, substeps, n) arrays, or None if there is no
+        (readable) entry for the key
+        '''
+        try:
+            with np.load(self.path(key)) as data:
+                return [data["svars"], data["dvars"]]
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, key, basesvarvals, basedvarvals):
+        '''
+        Store a baseline trajectory. The entry is written to a temporary file and moved into
+        place, so a concurrent reader never sees a partial entry.
+        '''
+        handle, temppath = tempfile.mkstemp(suffix=".npz", dir=self.cachedir)
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                np.savez(file, svars=np.asarray(basesvarvals, dtype=float), dvars=np.asarray(basedvarvals, dtype=float))
+            os.replace(temppath, self.path(key))
+        except BaseException:
+            if os.path.exists(temppath):
+                os.unlink(temppath)
+            raise
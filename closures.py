@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Closures compiled into arrays.
+
+A closure is the set of exogenous svars of a step and the shock to each. Rather than a
+dictionary of offset to [shock, ischange] it is held as three arrays in the order the variables
+were added: the offsets of the exogenous svars, whether each is a change variable, and the
+shocks. The first two make up the structure of the closure, which is the same for most years
+of a simulation - closures with the same structure share one copy of those arrays, and each
+year only has its own vector of shocks.
+
+Closure files are compiled once and kept by the sha256 of their contents, so neither reading
+the same file again nor reading a copy of it under another name parses anything.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+class Closure(object):
+    '''
+    Closure
+
+    The exogenous svars of a step (exogenous, offsets into the svars), whether each is a
+    change variable (ischange) and the shock to each (shocks). Treat the arrays as read only -
+    exogenous and ischange may be shared with other closures.
+    '''
+    def __init__(self, exogenous, ischange, shocks):
+        self.exogenous = exogenous
+        self.ischange = ischange
+        self.shocks = shocks
+        self._sortorder = None
+
+    def __len__(self):
+        return len(self.exogenous)
+
+    def exogenous_values(self, basevals, substeps):
+        '''
+        The values the exogenous svars take over one substep
+
+        Parameters
+        ----------
+        basevals: The values of the exogenous svars in the baseline over the same substep (for
+                  the policy), or 0
+        substeps: The number of substeps in a step
+
+        Returns
+        -------
+        An array of the values, in the order of exogenous
+        '''
+        return np.where(self.ischange,
+                        basevals + (self.shocks / substeps),
+                        ((1 + basevals / 100) * (1 + self.shocks / 100) ** (1 / substeps)) * 100 - 100)
+
+    def positions(self, offsets):
+        '''
+        Returns
+        -------
+        The position of each offset in exogenous, or -1 where it is not exogenous
+        '''
+        if self._sortorder is None:
+            self._sortorder = np.argsort(self.exogenous, kind="stable")
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(self) == 0:
+            return np.full(len(offsets), -1, dtype=np.int64)
+        sortedexogenous = self.exogenous[self._sortorder]
+        idx = np.minimum(np.searchsorted(sortedexogenous, offsets), len(self) - 1)
+        return np.where(sortedexogenous[idx] == offsets, self._sortorder[idx], -1)
+
+    def shocked(self, offsets, shock, ischange):
+        '''
+        Returns
+        -------
+        A copy of the closure with the given svars shocked, adding any that are not exogenous to
+        the end. If they all are the copy shares the structure of this closure.
+        '''
+        offsets = np.asarray(offsets, dtype=np.int64)
+        positions = self.positions(offsets)
+        shocks = self.shocks.copy()
+        shocks[positions[positions >= 0]] = shock
+
+        missing = offsets[positions < 0]
+        if len(missing) == 0 and (self.ischange[positions] == ischange).all():
+            closure = Closure(self.exogenous, self.ischange, shocks)
+            closure._sortorder = self._sortorder
+            return closure
+
+        flags = self.ischange.copy()
+        flags[positions[positions >= 0]] = ischange
+        return Closure(np.concatenate([self.exogenous, missing]),
+                       np.concatenate([flags, np.full(len(missing), ischange)]),
+                       np.concatenate([shocks, np.full(len(missing), float(shock))]))
+
+
+class ClosureBuilder(object):
+    '''
+    ClosureBuilder
+
+    Builds up a closure from the add, remove and shock lines of a closure file, keeping track
+    of what is exogenous with masks over the svars rather than sets of offsets.
+    '''
+    def __init__(self, nsvars):
+        self.isexogenous = np.zeros(nsvars, dtype=bool)
+        self.ischange = np.zeros(nsvars, dtype=bool)
+        self.shocks = np.zeros(nsvars)
+        self.order = np.zeros(nsvars, dtype=np.int64) # When each svar was added
+        self.added = 0
+
+    def add(self, offsets, ischange):
+        '''
+        Make the svars exogenous, with no shock
+
+        Returns
+        -------
+        True if any of them were already exogenous
+        '''
+        offsets = np.asarray(offsets, dtype=np.int64)
+        new = offsets[~self.isexogenous[offsets]]
+        new = new[np.sort(np.unique(new, return_index=True)[1])]
+        self.order[new] = self.added + np.arange(len(new))
+        self.added += len(new)
+        repeated = len(new) < len(offsets)
+
+        self.isexogenous[offsets] = True
+        self.ischange[offsets] = ischange
+        self.shocks[offsets] = 0
+        return repeated
+
+    def contains(self, offsets):
+        return bool(self.isexogenous[np.asarray(offsets, dtype=np.int64)].all())
+
+    def remove(self, offsets):
+        self.isexogenous[np.asarray(offsets, dtype=np.int64)] = False
+
+    def shock(self, offsets, shock):
+        self.shocks[np.asarray(offsets, dtype=np.int64)] = shock
+
+    def build(self):
+        '''
+        Returns
+        -------
+        The Closure, with the svars in the order they were added
+        '''
+        exogenous = np.flatnonzero(self.isexogenous)
+        exogenous = exogenous[np.argsort(self.order[exogenous], kind="stable")]
+        return Closure(exogenous, self.ischange[exogenous], self.shocks[exogenous])
+
+
+class ClosureStore(object):
+    '''
+    ClosureStore
+
+    The closures compiled so far, by the sha256 of the file they came from, with the structure
+    of each shared between all the closures that have the same one.
+    '''
+    def __init__(self):
+        self.closures = {} # sha256 of the file -> Closure
+        self.structures = {} # hash of the structure -> (exogenous, ischange)
+        self.hashes = {} # (path, size, mtime) -> sha256 of the file, so unchanged files are not hashed again
+        self.problems = {} # hash of the exogenous svars -> what is structurally wrong with them, "" if nothing
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            with open(path, 'rb') as file:
+                self.hashes[key] = hashlib.sha256(file.read()).hexdigest()
+        return self.hashes[key]
+
+    def intern(self, closure):
+        '''
+        Returns
+        -------
+        The closure, sharing the arrays of its structure with any other closure with the same
+        '''
+        key = hashlib.sha1(closure.exogenous.tobytes() + closure.ischange.tobytes()).hexdigest()
+        if key not in self.structures:
+            self.structures[key] = (closure.exogenous, closure.ischange)
+        exogenous, ischange = self.structures[key]
+        return Closure(exogenous, ischange, closure.shocks)
+
+    def get(self, path, compile):
+        '''
+        The compiled closure for a file, compiling it (with compile(path)) if its contents have
+        not been seen before
+        '''
+        key = self.file_hash(path)
+        if key not in self.closures:
+            self.closures[key] = self.intern(compile(path))
+        return self.closures[key]
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Storage for the history of a simulation.
+
+Each simulation records the dvars at the start of every substep and the svars solved in
+every substep. The store allocates both histories up front, as (steps, substeps, n) arrays,
+so a substep only copies its vector into the next slot. The arrays can also be memory
+mapped .npy files, which keeps long runs with many substeps out of RAM. Those files can be
+read back afterwards with np.load(path, mmap_mode='r').
+
+What is kept is set by the retention policy:
+
+- full: every svar and dvar, for every step
+- reporting: only the svars and dvars that are written out (the reporting vars), for every step
+- final: as for reporting, but for the final step only
+
+Under the reporting and final policies any svars that a later simulation needs (eg the
+exogenous variables of the policy closures, which take their baseline values) can be
+tracked for every step and substep regardless.
+"""
+
+import os
+
+import numpy as np
+
+
+RETENTION_POLICIES = ["full", "reporting", "final"]
+
+
+class HistoryStore(object):
+    '''
+    HistoryStore
+
+    The svar and dvar histories of one simulation. Columns are addressed by their offsets in
+    the full svar and dvar vectors, whatever subset is actually held.
+    '''
+    def __init__(self, steps, substeps, nsvars, ndvars, directory=None, name="history",
+                 svarcolumns=None, dvarcolumns=None, finalonly=False, trackedsvars=None):
+        '''
+        Parameters
+        ----------
+        steps: Number of steps
+        substeps: Number of substeps
+        nsvars: Length of the svar vector
+        ndvars: Length of the dvar vector
+        directory: If given, the histories are memory mapped to {name}.svars.npy,
+                   {name}.dvars.npy (and {name}.tracked.npy) in this directory. Otherwise they
+                   are held in memory
+        name: The stem of the file names
+        svarcolumns: Offsets of the svars to keep, or None for all of them
+        dvarcolumns: Offsets of the dvars to keep, or None for all of them
+        finalonly: Keep the final step only
+        trackedsvars: Offsets of svars to keep for every step and substep, on top of svarcolumns
+        '''
+        self.steps = steps
+        self.substeps = substeps
+        self.directory = directory
+        self.name = name
+
+        self.svarcolumns = self._columns(svarcolumns, nsvars)
+        self.dvarcolumns = self._columns(dvarcolumns, ndvars)
+        self.trackedsvars = self._columns(trackedsvars, nsvars) if trackedsvars is not None else np.zeros(0, dtype=np.int64)
+
+        # The steps held in the svars and dvars arrays
+        self.stepnumbers = [steps - 1] if finalonly else list(range(steps))
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.svars = self._allocate("svars", (len(self.stepnumbers), substeps, len(self.svarcolumns)))
+        self.dvars = self._allocate("dvars", (len(self.stepnumbers), substeps, len(self.dvarcolumns)))
+        if len(self.trackedsvars) > 0:
+            self.tracked = self._allocate("tracked", (steps, substeps, len(self.trackedsvars)))
+        else:
+            self.tracked = np.zeros((steps, substeps, 0))
+
+        # Full vectors can be stored without a gather
+        self._allsvars = len(self.svarcolumns) == nsvars
+        self._alldvars = len(self.dvarcolumns) == ndvars
+
+    @classmethod
+    def from_arrays(cls, svars, dvars):
+        '''
+        A full history holding the given (steps, substeps, n) svar and dvar arrays
+        '''
+        store = cls.__new__(cls)
+        store.steps, store.substeps = svars.shape[0], svars.shape[1]
+        store.directory = None
+        store.name = "history"
+        store.svarcolumns = np.arange(svars.shape[2])
+        store.dvarcolumns = np.arange(dvars.shape[2])
+        store.trackedsvars = np.zeros(0, dtype=np.int64)
+        store.stepnumbers = list(range(store.steps))
+        store.svars = svars
+        store.dvars = dvars
+        store.tracked = np.zeros((store.steps, store.substeps, 0))
+        store._allsvars = True
+        store._alldvars = True
+        return store
+
+    @staticmethod
+    def _columns(columns, n):
+        if columns is None:
+            return np.arange(n)
+        return np.unique(np.asarray(columns, dtype=np.int64))
+
+    def _allocate(self, part, shape):
+        if self.directory is None:
+            return np.zeros(shape)
+
+        # A previous store may still be mapping a file of the same name (eg a baseline held on to
+        # by a PolicyEngine). Unlinking it first leaves that mapping intact, where truncating the
+        # file in place would pull the data out from under it.
+        path = os.path.join(self.directory, f"{self.name}.{part}.npy")
+        if os.path.exists(path):
+            os.unlink(path)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape)
+
+    @property
+    def isfull(self):
+        '''
+        True if every svar and dvar is held for every step
+        '''
+        return self._allsvars and self._alldvars and len(self.stepnumbers) == self.steps
+
+    def record_dvars(self, step, substep, values):
+        if step in self.stepnumbers:
+            row = self.stepnumbers.index(step)
+            self.dvars[row, substep] = values if self._alldvars else values[self.dvarcolumns]
+
+    def record_svars(self, step, substep, values):
+        if step in self.stepnumbers:
+            row = self.stepnumbers.index(step)
+            self.svars[row, substep] = values if self._allsvars else values[self.svarcolumns]
+        if len(self.trackedsvars) > 0:
+            self.tracked[step, substep] = values[self.trackedsvars]
+
+    def _positions(self, held, offsets, what):
+        # Where each of the (full) offsets sits within the held columns
+        offsets = np.asarray(offsets, dtype=np.int64)
+        positions = np.searchsorted(held, offsets)
+        if np.any(positions >= len(held)) or not np.array_equal(held[positions], offsets):
+            raise ValueError(f"The {what} requested are not held in the history {self.name}.")
+        return positions
+
+    def svar_values(self, step, substep, offsets):
+        '''
+        Returns
+        -------
+        The values of the svars at the given offsets, solved in the given step and substep
+        '''
+        if len(self.trackedsvars) > 0 and np.isin(offsets, self.trackedsvars).all():
+            return self.tracked[step, substep, self._positions(self.trackedsvars, offsets, "svars")]
+        if step not in self.stepnumbers:
+            raise ValueError(f"Step {step} is not held in the history {self.name}.")
+        return self.svars[self.stepnumbers.index(step), substep, self._positions(self.svarcolumns, offsets, "svars")]
+
+    def svar_history(self, offsets):
+        '''
+        Returns
+        -------
+        A (held steps, substeps, len(offsets)) array of the svars at the given offsets
+        '''
+        return self.svars[:, :, self._positions(self.svarcolumns, offsets, "svars")]
+
+    def dvar_history(self, offsets):
+        '''
+        Returns
+        -------
+        A (held steps, substeps, len(offsets)) array of the dvars at the given offsets
+        '''
+        return self.dvars[:, :, self._positions(self.dvarcolumns, offsets, "dvars")]
+
+    def prefix(self, steps):
+        '''
+        Returns
+        -------
+        A full history holding the first steps of this one (which must be full)
+        '''
+        if not self.isfull:
+            raise ValueError(f"Cannot take the first steps of the history {self.name}, it is not a full history.")
+        return HistoryStore.from_arrays(self.svars[:steps], self.dvars[:steps])
+
+    def flush(self):
+        '''
+        Write any memory mapped histories out to disk
+        '''
+        for part in [self.svars, self.dvars, self.tracked]:
+            if isinstance(part, np.memmap):
+                part.flush()
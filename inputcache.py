@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+On disk cache of the Excel workbooks read by File statements.
+
+Parsing a workbook with pd.read_excel is the slowest part of starting up a model. The first
+time a workbook is read each of its sheets is written out in a binary form (an .npz of its
+columns, or a pickle for the odd sheet that mixes types within a column), and from then on
+the workbook is served from those files. The sheets are only
+loaded when the model asks for them, so sheets the model never references are never read.
+
+An entry is invalidated by the size and modification time of the workbook, confirmed against
+its sha256 - touching the workbook costs a hash, changing it costs a rebuild.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+
+# Bump this whenever the layout of an entry changes
+INPUTCACHE_VERSION = 1
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_atomic(path, write):
+    # Write through a temporary file in the same directory, so readers never see a partial file
+    handle, temppath = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            write(file)
+        os.replace(temppath, path)
+    except BaseException:
+        if os.path.exists(temppath):
+            os.unlink(temppath)
+        raise
+
+
+def _is_text(column):
+    # A column of strings, possibly with some missing values
+    return all(isinstance(value, str) for value in column[column.notna()])
+
+
+def _can_store_columns(df):
+    '''
+    Returns
+    -------
+    True if the sheet can be stored as an .npz of its columns: string column names, a default
+    index, and every column either numeric or text
+    '''
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+        return False
+    if not all(isinstance(name, str) for name in df.columns) or not df.columns.is_unique:
+        return False
+    for name in df.columns:
+        if df[name].dtype.kind in 'biuf':
+            continue
+        if not _is_text(df[name]):
+            return False
+    return True
+
+
+def _save_columns(file, df):
+    arrays = {}
+    for i, name in enumerate(df.columns):
+        column = df[name]
+        if column.dtype.kind in 'biuf':
+            arrays[f"values{i}"] = column.to_numpy()
+        else:
+            missing = column.isna().to_numpy()
+            arrays[f"values{i}"] = np.array(column.fillna("").tolist(), dtype=str)
+            arrays[f"missing{i}"] = missing
+    np.savez(file, **arrays)
+
+
+def _load_columns(path, columns, dtypes):
+    data = {}
+    with np.load(path) as arrays:
+        for i, (name, dtype) in enumerate(zip(columns, dtypes)):
+            values = arrays[f"values{i}"]
+            if f"missing{i}" in arrays:
+                values = values.astype(object)
+                values[arrays[f"missing{i}"]] = np.nan
+            data[name] = pd.Series(values, dtype=dtype)
+    return pd.DataFrame(data)
+
+
+class CachedWorkbook(Mapping):
+    '''
+    CachedWorkbook
+
+    A read only dictionary of sheet name to dataframe, in the same shape as pd.read_excel(...,
+    sheet_name=None) gives, that loads each sheet from the cache on first use. Pickling it
+    (eg into a compiled model) gives a plain dictionary of the sheets loaded so far.
+    '''
+    def __init__(self, directory, sheets):
+        self.directory = directory
+        self.sheets = {sheet["name"]: sheet for sheet in sheets}
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            sheet = self.sheets[name]
+            path = os.path.join(self.directory, sheet["file"])
+            if sheet["format"] == "npz":
+                self.loaded[name] = _load_columns(path, sheet["columns"], sheet["dtypes"])
+            else:
+                with open(path, 'rb') as file:
+                    self.loaded[name] = pickle.load(file)
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.sheets)
+
+    def __len__(self):
+        return len(self.sheets)
+
+    def __reduce__(self):
+        return (dict, (dict(self.loaded),))
+
+
+class InputCache(object):
+    '''
+    InputCache
+
+    A directory of cached workbooks. Each workbook gets a subdirectory named by its path,
+    holding a manifest.json and one file per sheet.
+    '''
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def entry_directory(self, path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+        return os.path.join(self.cachedir, f"{stem}-{digest}")
+
+    def read_excel(self, path):
+        '''
+        Read all the sheets of a workbook, from the cache if it holds a current copy
+
+        Returns
+        -------
+        A CachedWorkbook of sheet name to dataframe
+        '''
+        directory = self.entry_directory(path)
+        manifest = self._current_manifest(path, directory)
+        if manifest is not None:
+            return CachedWorkbook(directory, manifest["sheets"])
+
+        workbook = pd.read_excel(path, sheet_name=None)
+        manifest = self._build(path, directory, workbook)
+        cached = CachedWorkbook(directory, manifest["sheets"])
+        cached.loaded = workbook
+        return cached
+
+    def _current_manifest(self, path, directory):
+        # The manifest for the workbook, if it is still valid
+        try:
+            with open(os.path.join(directory, "manifest.json"), 'r') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if manifest.get("version") != INPUTCACHE_VERSION or manifest.get("pandas") != pd.__version__:
+            return None
+
+        stat = os.stat(path)
+        if manifest["size"] == stat.st_size and manifest["mtime_ns"] == stat.st_mtime_ns:
+            return manifest
+
+        # The workbook has been touched - it is only stale if its contents have changed
+        if manifest["size"] != stat.st_size or manifest["sha256"] != file_sha256(path):
+            return None
+        manifest["mtime_ns"] = stat.st_mtime_ns
+        self._write_manifest(directory, manifest)
+        return manifest
+
+    def _build(self, path, directory, workbook):
+        os.makedirs(directory, exist_ok=True)
+        stat = os.stat(path)
+        sha256 = file_sha256(path)
+
+        # The sheet files carry the hash of the workbook, so a rebuild never overwrites a file
+        # that a reader of the previous manifest may be about to open
+        sheets = []
+        for i, (name, df) in enumerate(workbook.items()):
+            if _can_store_columns(df):
+                sheet = {"name": name, "file": f"{sha256[:16]}-{i}.npz", "format": "npz",
+                         "columns": list(df.columns), "dtypes": [str(dtype) for dtype in df.dtypes]}
+                _write_atomic(os.path.join(directory, sheet["file"]), lambda file: _save_columns(file, df))
+            else:
+                sheet = {"name": name, "file": f"{sha256[:16]}-{i}.pkl", "format": "pickle"}
+                _write_atomic(os.path.join(directory, sheet["file"]), lambda file: pickle.dump(df, file, protocol=pickle.HIGHEST_PROTOCOL))
+            sheets.append(sheet)
+
+        manifest = {"version": INPUTCACHE_VERSION, "pandas": pd.__version__, "source": os.path.abspath(path),
+                    "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256, "sheets": sheets}
+        self._write_manifest(directory, manifest)
+
+        return manifest
+
+    def _write_manifest(self, directory, manifest):
+        _write_atomic(os.path.join(directory, "manifest.json"), lambda file: file.write(json.dumps(manifest, indent=1).encode()))
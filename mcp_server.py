@@ -6,9 +6,7 @@ Enables agentic workflows for economic simulations
 
 import asyncio
 import json
-import os
 import sys
-import tempfile
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 from datetime import datetime
@@ -20,6 +18,9 @@ import pandas as pd
 MODEL_DIR = Path(__file__).parent.absolute()
 sys.path.insert(0, str(MODEL_DIR))
 
+# Baseline trajectories - the same directory the API server uses, so the two share baselines
+BASE_CACHE_DIR = MODEL_DIR / "cache" / "bases"
+
 # MCP imports
 try:
     from mcp.server import Server
@@ -37,7 +38,7 @@ except ImportError:
     sys.exit(1)
 
 # Import model components
-from solver import Model, ModelException, run_model
+from solver import ModelException, get_policy_engine
 
 
 class CGEModelServer:
@@ -264,51 +265,27 @@ class CGEModelServer:
     async def _execute_scenario(self, scenario_id: str, config: Dict[str, Any]):
         """Execute scenario in background"""
         try:
-            # Create temp config file
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.yml', delete=False, dir=MODEL_DIR) as f:
-                yaml.dump(config, f)
-                config_path = f.name
+            # The run is on a thread of its own, so the event loop keeps serving requests and
+            # several scenarios can run at once against the engine
+            await asyncio.to_thread(self._run_scenario, config)
             
-            # Change to model directory
-            original_dir = os.getcwd()
-            os.chdir(MODEL_DIR)
-            
-            try:
-                # Create model instance with custom config
-                model = Model(ymlfile=config_path)
-                
-                # Parse model file
-                model.parse_model_file(config.get("model_file", "orani.model"))
-                
-                # Read data
-                model.read_datavars()
-                
-                if model.solve:
-                    # Take differentials
-                    model.equation_manager.diffall(model.solvarhandler, model.datavarvals)
-                    
-                    # Read closures
-                    model.read_closure_shocks()
-                    
-                    # Run simulation (simplified - uses existing run_model logic)
-                    # This would need full porting of the solving logic
-                    # For now, we'll use the existing run_model function
-                    run_model(model_file=config.get("model_file", "orani.model"), do_policy=True)
-                
-                # Update status
-                self.scenarios[scenario_id]["status"] = "completed"
-                self.scenarios[scenario_id]["completed_at"] = datetime.now().isoformat()
-                
-            finally:
-                os.chdir(original_dir)
-                if os.path.exists(config_path):
-                    os.unlink(config_path)
+            # Update status
+            self.scenarios[scenario_id]["status"] = "completed"
+            self.scenarios[scenario_id]["completed_at"] = datetime.now().isoformat()
             
         except Exception as e:
             self.scenarios[scenario_id]["status"] = "error"
             self.scenarios[scenario_id]["error"] = str(e)
             self.scenarios[scenario_id]["error_traceback"] = traceback.format_exc()
     
+    def _run_scenario(self, config: Dict[str, Any]):
+        """Run a scenario, blocking until it is done"""
+        # Run the policy against the shared engine - the model is only set up, and
+        # the baseline only solved, the first time they are needed. The paths are relative
+        # to the model directory and the outputs go straight into the scenario's directory
+        engine = get_policy_engine(model_file=config.get("model_file", "orani.model"), cachedir=str(BASE_CACHE_DIR), basedir=str(MODEL_DIR))
+        engine.run_policy(dict(config, outputdir=config.get("output_dir", f"outputs/{config['scenario_name']}")))
+    
     def _create_scenario_config(self, scenario_name: str, year: int, steps: int,
                                 shocks: Dict[str, float], reporting_vars: Optional[List[str]],
                                 output_dir: str) -> Dict[str, Any]:
@@ -318,13 +295,10 @@ class CGEModelServer:
         with open(config_path, 'r') as f:
             base_config = yaml.safe_load(f)
         
-        # Create closure files for each step
+        # The policy closures are the base closures with the shocks applied in memory by the model
         base_closures = []
-        policy_closures = []
         
         closures_dir = MODEL_DIR / "closures"
-        temp_closures_dir = MODEL_DIR / f"temp_closures/{scenario_name}"
-        temp_closures_dir.mkdir(parents=True, exist_ok=True)
         
         for step in range(steps):
             current_year = year + step
@@ -335,25 +309,13 @@ class CGEModelServer:
                 base_closures.append(str(base_closure))
             else:
                 # Use first available base closure as template
-                first_base = closures_dir / "base2023.txt"
-                if first_base.exists():
-                    base_closures.append(str(first_base))
-                else:
-                    base_closures.append(str(base_closure))
-            
-            # Policy closure with shocks
-            policy_closure = temp_closures_dir / f"pol{current_year}.txt"
-            self._create_shock_closure(
-                base_closure if base_closure.exists() else closures_dir / "base2023.txt",
-                shocks,
-                policy_closure
-            )
-            policy_closures.append(str(policy_closure))
+                base_closures.append(str(closures_dir / "base2023.txt"))
         
         config = base_config.copy()
         config["steps"] = steps
         config["basefiles"] = base_closures
-        config["polfiles"] = policy_closures
+        config["polfiles"] = base_closures
+        config["shocks"] = shocks
         if reporting_vars:
             config["reportingvars"] = reporting_vars
         config["scenario_name"] = scenario_name
@@ -362,47 +324,6 @@ class CGEModelServer:
         
         return config
     
-    def _create_shock_closure(self, base_closure: Path, 
-                             shocks: Dict[str, float], 
-                             output_path: Path):
-        """Create closure file with shocks"""
-        lines = []
-        
-        if base_closure and base_closure.exists():
-            with open(base_closure, 'r') as f:
-                lines = [line.strip() for line in f.readlines() if line.strip()]
-        
-        # Apply shocks
-        for var_name, shock_value in shocks.items():
-            # Check if variable is already in closure
-            var_found = False
-            for i, line in enumerate(lines):
-                if line.startswith('shock') and var_name in line:
-                    lines[i] = f"shock {var_name} {shock_value}"
-                    var_found = True
-                    break
-                elif line.startswith('add') and var_name in line:
-                    var_found = True
-                    # Add shock after add statement
-                    insert_pos = i + 1
-                    has_shock = any(
-                        lines[j].startswith('shock') and var_name in lines[j]
-                        for j in range(i+1, len(lines))
-                    )
-                    if not has_shock:
-                        lines.insert(insert_pos, f"shock {var_name} {shock_value}")
-                    break
-            
-            if not var_found:
-                lines.append(f"add {var_name}")
-                lines.append(f"shock {var_name} {shock_value}")
-        
-        # Write output
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(output_path, 'w') as f:
-            for line in lines:
-                f.write(line + '\n')
-    
     async def _get_scenario_status(self, args: Dict[str, Any]) -> List[TextContent]:
         """Get scenario status"""
         scenario_id = args["scenario_id"]
@@ -14,21 +14,30 @@ import os
 import glob
 
 import copy
+import hashlib
+import pickle
+import queue
+import threading
 
 import time
 
 import variables
 import statements
+import basecache
+import closures
+import history
+import inputcache
+import writers
 
-from scipy.sparse import identity, coo_matrix, csr_matrix
-from scipy.sparse.linalg import spsolve
+from scipy.sparse import csr_matrix, csc_matrix
+from scipy.sparse.linalg import splu
+from scipy.sparse.csgraph import maximum_bipartite_matching
 
 try:
     from pypardiso import PyPardisoSolver
 except ImportError:
     PyPardisoSolver = None
 
-import itertools
 import numpy as np
 
 import warnings
@@ -37,122 +46,313 @@ import traceback
 
 import csv
 
-# A helper function for matix solution
-def do_inversion(A, b, rowlabels, doiterative=False, docondense=False, solver=None):
-    
-    
-    # Solve the linear system Ax = b
-    with warnings.catch_warnings(record=True) as w:
-        warnings.simplefilter("always")
+# The version of the compiled model artifact. Bump this whenever anything that is pickled into it changes
+COMPILED_VERSION = 4
 
-        if docondense:
-            
-            t0 = time.time()
-            # In this section we will be doing an automatic condensation of the matrix to solve
-            # The procedure will take all rows of the matrix with a single non-zero entry, and will
-            # drop the corresponding rows and columns out, as they don't need to be handled by the
-            # sparse matrix solver
-            
-            # We will break the problem into the following:
-            # - xtriv and xtriv - the trivial elements of x and b that are defined by the single non-zero entries in A
-            # - Astar, bstar, xstar - the non-trivial elements
-            # - a suite of mappings
-            
-            # Step 1 - identify the trivial rows
-            
-            # Calculate the number of non-zero elements in each row
-            row_nz_counts = np.diff(A.indptr)
-            # Identify rows with exactly one non-zero entry
-            single_nz_rows = np.where(row_nz_counts == 1)[0]            
-            # Identify corresponding columns
-            single_nz_cols = A.indices[A.indptr[single_nz_rows]]
-
-            # Step 2 - build the required matricies to map from original to current problem
-            # These are
-            #
-            # - Apre - premultiplier for A to remove redundant rows/eqns. Based on I
-            # - Apost - postmultiplier for A to remove redundant cols/variables. Based on I
-            #         - when used as a premultiplier this will alos return xstar to the ordering of x
-            
-            # - xtrivpre - premultiplier for b to get xtriv. Based on A
-            # - bstarpre - premultiplier for b to get bstar. Based on A
-            
-            # Apre
-            csr_identity = identity(A.shape[0], format='csr')            
-            rows_to_keep = np.setdiff1d(np.arange(csr_identity.shape[0]), single_nz_rows)
-            Apre = csr_identity[rows_to_keep]
-            
-            # Apost
-            csc_identity = identity(A.shape[1], format='csc')            
-            cols_to_keep = np.setdiff1d(np.arange(csc_identity.shape[1]), single_nz_cols)
-            Apost = csc_identity[:,cols_to_keep]
-            
-            # xtrivpre
-            new_data = []
-            new_row_indices = []
-            new_col_indices = []
-            
-            for row in single_nz_rows:
-                # Iterate over the row's non-zero elements
-                start, end = A.indptr[row], A.indptr[row + 1]
-                new_data.extend([1/x for x in A.data[start:end]])
-                new_row_indices.extend([row] * (end - start))
-                new_col_indices.extend(A.indices[start:end])
-            
-            # Create a new sparse matrix with only these rows, inverted values, and transposed
-            xtrivpre = csr_matrix((new_data, (new_row_indices, new_col_indices)), shape=A.shape).T
-            
-            # bstarpre
-            new_data = []
-            new_row_indices = []
-            new_col_indices = []
-            
-            for row in rows_to_keep:
-                # Iterate over the row's non-zero elements
-                start, end = A.indptr[row], A.indptr[row + 1]
-                new_data.extend(A.data[start:end])
-                new_row_indices.extend([row] * (end - start))
-                new_col_indices.extend(A.indices[start:end])            
+# The members of Model that make up the compiled artifact - everything that parse_model_file,
+# read_datavars and diffall set up
+COMPILED_ATTRIBUTES = ["statements", "filedata", "newfiles", "writes", "set_manager",
+                       "solvarhandler", "datavarhandler", "initialdatavarvals",
+                       "assert_manager", "formula_manager", "equation_manager", "update_manager"]
 
-            bstarpre = csr_matrix((new_data, (new_row_indices, new_col_indices)), shape=A.shape)
+# Patterns used when reading the model file
+STATEMENT_KEYWORD_REGEX = re.compile(r"^(equation|formula|update|file|datavar|solvar|set|subset|write|loopformulas|assert)", re.IGNORECASE)
+DIRECTIVE_REGEX = re.compile(r"^\[[^\]]+\]")
+MODIFIER_REGEX = re.compile(r"^\[[^\]]*\]")
+SET_FROM_REGEX = re.compile(r" from ", re.IGNORECASE)
+SET_CROSS_REGEX = re.compile(r" x ", re.IGNORECASE)
 
 
-            Atosolve = Apre @ A @ Apost
-            xtriv = xtrivpre @ b
-            btosolve = Apre @ (b - bstarpre @ xtriv)
+# Holds on to the factorisations of the system so that they can be reused
+class FactorizationCache(object):
+    '''
+    FactorizationCache
+
+    The sparsity pattern of the system is the same for every substep that shares a closure, so
+    the work that only depends on the pattern is done once per (sparsity pattern, closure) and
+    kept here. For each key this holds:
+
+    - the mapping from the data of the full CSR jacobian to the data of the reduced
+      (equations by endogenous) system, so that the reduced system is a single gather
+    - for SuperLU, the fill reducing column ordering from the first factorisation. Later
+      factorisations are done on the pre-permuted system with the natural ordering
+    - the last numeric factorisation, which is reused as-is when the reduced system is
+      bitwise identical (for example base and policy at the start of the first step)
+    - for PyPardiso, a solver of its own. PyPardiso keeps the factorisation of the last matrix
+      it saw and reuses it while the values are unchanged, but any change in the values redoes
+      the analysis as well as the numeric factorisation
 
-            print(time.time() - t0)
+    '''
+    def __init__(self, usepardiso=False):
+        if usepardiso and PyPardisoSolver is None:
+            raise ModelException("doiterative is set, but pypardiso is not installed.")
+        self.usepardiso = usepardiso
+        self.entries = {}
 
-        else:
-            Atosolve = A
-            btosolve = b
-            
+    def get_key(self, A, exogenous):
+        '''
+        Returns
+        -------
+        The (sparsity pattern hash, closure hash) key for the system
 
+        '''
+        pattern = hashlib.sha1(np.int64(A.shape[1]).tobytes() + A.indptr.tobytes() + A.indices.tobytes()).hexdigest()
+        closure = hashlib.sha1(np.asarray(exogenous, dtype=np.int64).tobytes()).hexdigest()
+        return (pattern, closure)
 
-        print(Atosolve.shape)
-        if Atosolve.shape[0] != Atosolve.shape[1]:
-            if Atosolve.shape[0] > Atosolve.shape[1]:
-                raise ModelException(f"Cannot solve the proposed system - there are {Atosolve.shape[0] - Atosolve.shape[1]} too many exogenous variables.")
+    def get_entry(self, A, exogenous):
+        '''
+        Find (or set up) the cache entry for the CSR matrix A with the given exogenous columns
+        '''
+        key = self.get_key(A, exogenous)
+        if key not in self.entries:
+            isexogenous = np.zeros(A.shape[1], dtype=bool)
+            isexogenous[exogenous] = True
+            endogenous = np.flatnonzero(~isexogenous)
+
+            # Track where each entry of A ends up by carrying its (1 based) position through the slicing
+            positions = csr_matrix((np.arange(1, A.nnz + 1), A.indices, A.indptr), shape=A.shape)
+            if self.usepardiso:
+                reduced = positions[:, endogenous].tocsr()
             else:
-                raise ModelException(f"Cannot solve the proposed system - there are {Atosolve.shape[1] - Atosolve.shape[0]} too few exogenous variables.")
+                reduced = positions.tocsc()[:, endogenous]
+            reduced.sort_indices()
+
+            self.entries[key] = {"endogenous": endogenous,
+                                 "take": reduced.data - 1,
+                                 "indptr": reduced.indptr,
+                                 "indices": reduced.indices,
+                                 "shape": reduced.shape,
+                                 "colorder": None,
+                                 "data": None,
+                                 "lu": None,
+                                 "lupermuted": False,
+                                 "solver": PyPardisoSolver() if self.usepardiso else None}
+        return self.entries[key]
+
+    def reduce(self, entry, A):
+        '''
+        Returns
+        -------
+        The equations by endogenous part of A, as a CSC matrix for SuperLU or CSR for PyPardiso,
+        with its rows equilibrated, and the scale applied to each row (to be applied to the rhs)
 
+        '''
+        data = A.data[entry["take"]]
+        if self.usepardiso:
+            rows = np.repeat(np.arange(entry["shape"][0]), np.diff(entry["indptr"]))
+        else:
+            rows = entry["indices"]
+        
+        # Scale each row to a largest coefficient of 1. Some rows are only held together by a
+        # tiny coefficient - (V1PUR+TINY)*p1 = ... where the flow is zero fixes p1 at 0 with a
+        # coefficient of 1e-12 - and the pivoting would otherwise lose them to round off
+        rowmax = np.zeros(entry["shape"][0])
+        np.maximum.at(rowmax, rows, np.abs(data))
+        rowscale = 1 / np.where(rowmax > 0, rowmax, 1)
+        data = data * rowscale[rows]
+        
+        if self.usepardiso:
+            return csr_matrix((data, entry["indices"], entry["indptr"]), shape=entry["shape"]), rowscale
+        else:
+            return csc_matrix((data, entry["indices"], entry["indptr"]), shape=entry["shape"]), rowscale
 
+    def solve(self, entry, Ared, b):
+        '''
+        Solve Ared x = b, reusing whatever we can from earlier factorisations of this entry
+        '''
+        if self.usepardiso:
+            # PyPardiso keeps the factorisation of the last matrix it saw, and only refactorises
+            # (analysis included) if the matrix has changed
+            return entry["solver"].solve(Ared, b).squeeze()
+
+        if entry["lu"] is not None and np.array_equal(entry["data"], Ared.data):
+            return self._lu_solve(entry, b)
+
+        if entry["colorder"] is None:
+            # First time through - let SuperLU find the ordering, and keep hold of it
+            lu = splu(Ared, permc_spec="COLAMD")
+            # perm_c maps each column to its position, we want the columns in position order
+            entry["colorder"] = np.argsort(lu.perm_c)
+            # Fold the column permutation into the gather for the next factorisation
+            permuted = csc_matrix((entry["take"] + 1, entry["indices"], entry["indptr"]), shape=entry["shape"])[:, entry["colorder"]]
+            entry["take"] = permuted.data - 1
+            entry["indices"] = permuted.indices
+            entry["indptr"] = permuted.indptr
+            entry["data"] = Ared[:, entry["colorder"]].data.copy()
+            entry["lu"] = lu
+            entry["lupermuted"] = False
+            return lu.solve(b)
+
+        # Ared has its columns already in the stored order
+        entry["lu"] = splu(Ared, permc_spec="NATURAL")
+        entry["data"] = Ared.data.copy()
+        entry["lupermuted"] = True
+        return self._lu_solve(entry, b)
+
+    def _lu_solve(self, entry, b):
+        # A factorisation of the pre-permuted system gives its solution in the stored column order
+        if not entry["lupermuted"]:
+            return entry["lu"].solve(b)
+        x = np.empty(len(b))
+        x[entry["colorder"]] = entry["lu"].solve(b)
+        return x
 
-        if doiterative:
-            print("iterative")
-            solver.free_memory(everything=True)
-            x = solver.solve(Atosolve, btosolve).squeeze()
 
+# A helper function to find identical rows for the error reporting
+def find_identical_rows(A, rowlabels):
+    '''
+    Returns
+    -------
+    A string listing the labels of the rows of A that are identical to another row, or an empty string
+    '''
+    A = csr_matrix(A)
+    A.sum_duplicates()
+    A.sort_indices()
+    
+    row_dict = {}
+    for idx in range(A.shape[0]):
+        start, end = A.indptr[idx], A.indptr[idx + 1]
+        row = (A.indices[start:end].tobytes(), A.data[start:end].tobytes())
+        if row in row_dict:
+            row_dict[row].append(idx)  # Add index to the group of identical rows
+        else:
+            row_dict[row] = [idx]  # Create a new group for this row
 
+    identical_groups = [indices for indices in row_dict.values() if len(indices) > 1]
 
-            
+    warningstring = ""
+    if identical_groups:
+        warningstring = warningstring + "\nIn addition, the following identical rows were detected:\n"
+        
+        for i in identical_groups:
+            for j in i:
+                warningstring = warningstring + rowlabels[j] + " "
+        warningstring = warningstring + "\n"
+    return warningstring
+
+
+def structural_problems(pattern, exogenous, rowlabels, collabels, maxnames=20):
+    '''
+    Check a closure against the sparsity pattern of the system alone, so that it can be done
+    before anything is solved. The equations by endogenous variables system has to be square,
+    and a maximum bipartite matching of the equations to the endogenous variables they contain
+    has to cover them all (full structural rank). A closure that fails gives a singular system
+    whatever the data - one that passes can still be numerically singular.
+
+    Parameters
+    ----------
+    pattern: The CSR sparsity pattern of the jacobian (equations by solvars)
+    exogenous: Array of the columns (solvars) that are exogenous
+    rowlabels: The labels of the rows (equations)
+    collabels: The labels of the columns (solvars)
+    maxnames: The most equations, and variables, to name
+
+    Returns
+    -------
+    A string describing the problems, or an empty string if there are none
+    '''
+    isexogenous = np.zeros(pattern.shape[1], dtype=bool)
+    isexogenous[np.asarray(exogenous, dtype=np.int64)] = True
+    endogenous = np.flatnonzero(~isexogenous)
+    reduced = csr_matrix(pattern)[:, endogenous]
+    nrows, ncols = reduced.shape
+    
+    # For each equation, the endogenous variable it is matched with (-1 if none)
+    matching = maximum_bipartite_matching(reduced, perm_type="column")
+    unmatchedrows = np.flatnonzero(matching < 0)
+    ismatched = np.zeros(ncols, dtype=bool)
+    ismatched[matching[matching >= 0]] = True
+    unmatchedcols = endogenous[~ismatched]
+    
+    if nrows == ncols and len(unmatchedrows) == 0:
+        return ""
+    
+    def names(labels, indexes):
+        listed = " ".join(labels[i] for i in indexes[:maxnames])
+        if len(indexes) > maxnames:
+            listed = listed + f" (and {len(indexes) - maxnames} more)"
+        return listed
+    
+    problemstring = ""
+    if nrows > ncols:
+        problemstring = problemstring + f"There are {nrows - ncols} too many exogenous variables.\n"
+    elif nrows < ncols:
+        problemstring = problemstring + f"There are {ncols - nrows} too few exogenous variables.\n"
+    problemstring = problemstring + f"The structural rank of the system is {nrows - len(unmatchedrows)}, for {nrows} equations and {ncols} endogenous variables.\n"
+    if len(unmatchedrows) > 0:
+        problemstring = problemstring + f"Equations a maximum matching leaves without an endogenous variable: {names(rowlabels, unmatchedrows)}\n"
+    if len(unmatchedcols) > 0:
+        problemstring = problemstring + f"Endogenous variables a maximum matching leaves without an equation: {names(collabels, unmatchedcols)}\n"
+    return problemstring
+
+
+# A helper function for matix solution
+def do_inversion(A, b, rowlabels, doiterative=False, solver=None, exogenous=None):
+    '''
+    Solve the linearised system for the change in the solvars
+
+    Parameters
+    ----------
+    A: The CSR matrix of partial derivatives (equations by solvars)
+    b: If exogenous is None, the rhs of the (already square) system Ax = b. Otherwise the
+       values of the exogenous variables, in the same order as exogenous
+    rowlabels: The labels of the rows of A, used in the error reporting
+    doiterative: Use PyPardiso rather than SuperLU (only used if solver is None)
+    solver: The FactorizationCache to use. If None, a throwaway one is used
+    exogenous: Array of the columns (solvars) that are exogenous. These columns are moved
+               onto the rhs and only the equations by endogenous system is factorised
+
+    Returns
+    -------
+    x, the full vector of solvar values (including the exogenous values)
+
+    '''
+    if solver is None:
+        solver = FactorizationCache(doiterative)
+    
+    A = csr_matrix(A)
+    
+    # Split the columns into the exogenous ones, whose values are known, and the endogenous
+    # ones that we are solving for. With A = [A_N A_E] we are solving A_N x_N = rhs - A_E x_E
+    if exogenous is None:
+        exogenous = np.zeros(0, dtype=np.int64)
+        rhs = b
+        b = np.zeros(0)
+    else:
+        exogenous = np.asarray(exogenous, dtype=np.int64)
+        rhs = 0
+    
+    xfull = np.zeros(A.shape[1])
+    xfull[exogenous] = b
+    btosolve = rhs - (A @ xfull)
+    
+    entry = solver.get_entry(A, exogenous)
+    Atosolve, rowscale = solver.reduce(entry, A)
+    btosolve = btosolve * rowscale
+    nrows, ncols = Atosolve.shape
+
+    print(Atosolve.shape)
+    if nrows != ncols:
+        if nrows > ncols:
+            raise ModelException(f"Cannot solve the proposed system - there are {nrows - ncols} too many exogenous variables.")
         else:
-            print("not iterative")
-            x = spsolve(Atosolve, btosolve)
+            raise ModelException(f"Cannot solve the proposed system - there are {ncols - nrows} too few exogenous variables.")
+    
+    
+    # Solve the linear system Ax = b
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+
+        try:
+            x = solver.solve(entry, Atosolve, btosolve)
+        except RuntimeError as e:
+            # SuperLU raises (rather than warns) on an exactly singular factor
+            raise ModelException(f"Error inverting. {e}\n{find_identical_rows(Atosolve, rowlabels)}")
 
         
         # Handle any warnings raised. We transform these into exceptions as
-        # rank errors (etc) only get raised as warnings by spsolve, however for us
+        # rank errors (etc) only get raised as warnings by the solvers, however for us
         # the should be fatal
         
         warningstring = ""
@@ -161,33 +361,13 @@ def do_inversion(A, b, rowlabels, doiterative=False, docondense=False, solver=No
             for warning in w:
                 warningstring = warningstring + str(warning.message) + "\n"
             
-            row_tuples = [tuple(A.getrow(i).toarray()[0]) for i in range(A.shape[0])]
-            row_dict = {}
-                
-            for idx, row in enumerate(row_tuples):
-                if row in row_dict:
-                    row_dict[row].append(idx)  # Add index to the group of identical rows
-                else:
-                    row_dict[row] = [idx]  # Create a new group for this row
-
-            identical_groups = [indices for indices in row_dict.values() if len(indices) > 1]
-
-            if identical_groups:
-                warningstring = warningstring + "\nIn addition, the following identical rows were detected:\n"
-                
-                for i in identical_groups:
-                    for j in i:
-                        warningstring = warningstring + rowlabels[j] + " "
-                warningstring = warningstring + "\n"
+            warningstring = warningstring + find_identical_rows(Atosolve, rowlabels)
 
             raise ModelException(f"Error inverting. {warningstring}")
 
-    # Finally, if we used the condensed version we need to reconstruct the correct x vector
-
-    if docondense:
-        return (Apost @ x) + xtriv
-    else:
-        return x
+    # Finally, scatter the endogenous solution back into the full x vector
+    xfull[entry["endogenous"]] = x
+    return xfull
 
 
 # Implementing a cleaner exception handler to make the outputs a little more readable
@@ -228,26 +408,166 @@ class ModelException(Exception):
 
 
 
+def aggregate_substeps(svars, ischange):
+    '''
+    Aggregate the svars solved in each substep of a step up into the step
+
+    Parameters
+    ----------
+    svars: An array of svars with the substeps on its second last axis
+    ischange: For each svar (the last axis), true if it is a change variable
+
+    Returns
+    -------
+    The aggregated svars, without the substep axis. Over the substeps changes add up and
+    percentage changes compound
+    '''
+    compounded = np.prod(1 + svars/100, axis=-2) * 100 - 100
+    return np.where(ischange, svars.sum(axis=-2), compounded)
+
+
+class StepResult(object):
+    '''
+    StepResult
+
+    The reporting vars of one completed step of a simulation, as run_simulation_iter yields them
+    '''
+    def __init__(self, simtype, step, svars, dvars, svarnames, dvarnames, ischange):
+        '''
+        Parameters
+        ----------
+        simtype: "base" or "policy"
+        step: The step just completed
+        svars: A (substeps, number of reporting svars) array of the svars solved in each substep
+        dvars: A (substeps, number of reporting dvars) array of the dvars at the start of each substep
+        svarnames: The full names of the reporting svars
+        dvarnames: The full names of the reporting dvars
+        ischange: For each reporting svar, true if it is a change variable
+        '''
+        self.simtype = simtype
+        self.step = step
+        self.svars = svars
+        self.dvars = dvars
+        self.svarnames = svarnames
+        self.dvarnames = dvarnames
+        self.ischange = ischange
+
+    def aggregated_svars(self):
+        '''
+        Returns
+        -------
+        The svars over the whole step, as do_writes reports them
+        '''
+        return aggregate_substeps(self.svars, self.ischange)
+
+
+def read_statements(modellines, infile_name):
+    '''
+    Split the lines of a model file into a sequence of statements. Statements commence with a
+    reserved word (not in a comment) and terminate with a semicolon, and may span lines.
+
+    Parameters
+    ----------
+    modellines: The lines of the model file
+    infile_name: The name of the model file, for error messages
+
+    Returns
+    -------
+    A list of dictionaries, each with the statement 'line' (including the trailing semicolon)
+    and its 'linenumberstart' and 'linenumberend'
+    '''
+    statements = []
+
+    # aggregate into a sequence of statements
+    # aggregated statement, lines, line numbers
+    
+    statement = {'line':"", 'linenumberstart': 0}
+    instatement = False
+    linenumber = 0
+    aggregatedline = ""
+    
+    # Statements commence with a suitable reserved word (not in a comment), and terminate with a semicolon
+    # The 'working' string is what we use to bite off the appropriate bits until we have consumed the whole line
+    for i in modellines:
+    
+        linenumber = linenumber + 1
+        
+        # Comments start with a hash, and go to EOL. Strip so that we can find keywords etc
+        commentstart = i.find("#")
+        if commentstart >= 0:
+            working = i[:commentstart].strip()
+        else:
+            working = i.strip()
+                
+        # We admit the possibility (though it isnt neat) of multiple statements on a single line split by one or more semicolons
+        # Also a statement can span multiple lines
+        
+        # do while we havent finished with the current line
+        while len(working) > 0:
+            
+            # if we are not already in a statement, the first non-whitespace should be a reserved word
+            if not instatement:
+                resmatch = STATEMENT_KEYWORD_REGEX.match(working)
+                if not resmatch:
+                    # there is something unexpected - die gracefully
+                    raise ModelException(f"Parsing error, {infile_name}: Expected statement type on line {str(linenumber)}, instead encountered '{working}'.")
+                # We must now be in a statement (otherwise the previous if would have failed)
+                statement['linenumberstart'] = linenumber
+                instatement = True
+            
+            # End of statement is via a semicolon (not within a comment - already handled above)
+            eos = working.find(";")
+            if eos >= 0:
+                # collect the part up to and including the semicolon
+                aggregatedline = aggregatedline + working[:eos+1]
+                # append the statement
+                statement['line'] = aggregatedline
+                statement['linenumberend'] = linenumber
+                statements.append(statement)
+                # reset
+                aggregatedline = ""
+                statement = {'line':""}
+                instatement = False
+                # hold onto the possible remainder
+                working = working[eos+1:].strip()
+            else:
+                aggregatedline = aggregatedline + working + " "
+                working = ""
+        
+    # if we get to here and we still have something in the 'aggregatedline' it means we never hit a trailing semicolon.
+    # we will still remember what line that statement started on in the temporary 'statement' dictionary
+    if len(aggregatedline) > 0:
+        raise ModelException(f"Parsing error, {infile_name}: last statement commencing line {str(statement['linenumberstart'])} was not terminated with a semicolon")
+
+    return statements
+
+
 class Model(object):
     '''
     The Model class is a high level wrapper around a CGE model file
     '''
     
-    def __init__(self, ymlfile="default.yml"):
+    def __init__(self, ymlfile="default.yml", basedir=None):
         '''
         Initialise the Model class with default parameters, empty strings and such
         Parameters
         ----------
         ymlfile: Optional string to open the model directive yml file.
                  Default is "default.yml"
+        basedir: The directory that the relative paths used by the model (the yml file, the model
+                 file, the data, closure and output files named in the yml, and the compiled
+                 directory) are relative to. By default the current directory at the time the model is created -
+                 the model never looks at the current directory after that
 
         Returns
         -------
         None.
         '''
         
+        self.basedir = os.path.abspath(basedir if basedir is not None else os.getcwd())
+
         # read the yml file that will resolve 
-        with open(ymlfile, 'r') as file:
+        with open(self.resolve(ymlfile), 'r') as file:
             try:
                 yaml_data = yaml.safe_load(file)
             except:
@@ -285,6 +605,69 @@ class Model(object):
         except:
             self.doiterative = False
         
+        try:
+            self.diffworkers = yaml_data['diffworkers']
+        except:
+            self.diffworkers = 1
+        
+        # Run the policy on a thread of its own, each step starting as soon as the baseline has finished it
+        try:
+            self.pipeline = yaml_data['pipeline']
+        except:
+            self.pipeline = False
+        
+        # Shocks applied to the policy closure of every step, on top of the polfiles. The
+        # variables are named as they are in the closure files
+        try:
+            self.shocks = yaml_data['shocks']
+        except:
+            self.shocks = None
+        
+        # Closure files already compiled, shared with the copies of the model
+        self.closurestore = closures.ClosureStore()
+        
+        try:
+            self.memmaphistory = yaml_data['memmaphistory']
+        except:
+            self.memmaphistory = False
+        
+        try:
+            self.retention = yaml_data['retention']
+        except:
+            self.retention = "full"
+        if self.retention not in history.RETENTION_POLICIES:
+            raise ModelException(f"Model initialisation error: retention must be one of {history.RETENTION_POLICIES}, got '{self.retention}'.")
+        
+        # The format the results are written in (see writers.py)
+        try:
+            self.outputformat = yaml_data['outputformat']
+        except:
+            self.outputformat = "xlsx"
+        formaterror = writers.check_format(self.outputformat)
+        if formaterror is not None:
+            raise ModelException(f"Model initialisation error: {formaterror}.")
+        
+        # Where the results are written
+        try:
+            self.outputdir = self.resolve(yaml_data['outputdir'])
+        except:
+            self.outputdir = self.basedir
+        
+        try:
+            self.compileddir = yaml_data['compileddir']
+        except:
+            self.compileddir = "compiled"
+        # An empty compileddir turns the compiled model off
+        self.compileddir = self.resolve(self.compileddir) if self.compileddir else None
+
+        # Binary copies of the input workbooks (see inputcache.py). By default these sit with the compiled
+        # model, an empty inputcachedir turns the cache off
+        try:
+            inputcachedir = yaml_data['inputcachedir']
+        except:
+            inputcachedir = os.path.join(self.compileddir, "inputs") if self.compileddir else None
+        self.inputcache = inputcache.InputCache(self.resolve(inputcachedir)) if inputcachedir else None
+
         self.filedata = {} # A dictionary (symbolic filename level) of dictionaries (sheet name level) of dataframes - input files only
         self.newfiles = {} # A dictionary of strings that give output file names
 
@@ -292,11 +675,15 @@ class Model(object):
         
         self.set_manager = sets.CgeSetManager()
         
+        # The current svar and dvar values, as float64 arrays aligned to the fullnames of the handlers
         self.solvarhandler = variables.SolVarHandler(self.set_manager)
-        self.solvarvals = []
+        self.solvarvals = np.zeros(0)
         
         self.datavarhandler = variables.DataVarHandler(self.set_manager)
-        self.datavarvals = []
+        self.datavarvals = np.zeros(0)
+        
+        # The dvars as read from the files, which every simulation starts from
+        self.initialdatavarvals = np.zeros(0)
         
         self.assert_manager = statements.AssertManager(self.set_manager, self.datavarhandler)
         
@@ -308,19 +695,29 @@ class Model(object):
         
         self.writes = {} # A dictionary (keyed by dvars) of file/tab combinations for writes
         
-        # lists of lists of the history of dvar and svar vals
-        # the highest level index is for the step, the next level is for a substep
-        # An n-step solution will leave n+1 stamps for alldvarvals - the first is 
-        # pre substep 0, the remainder are post each of the n steps
-        # svarvals are only valid post a solution, so there are n of them
-        self.allsvarvals = []
-        self.alldvarvals = []
+        # The history of dvar and svar vals of the current simulation and of the baseline, each a
+        # HistoryStore. These hold the dvars going into each substep and the solution of each substep,
+        # for whatever the retention policy keeps. They are None until a simulation has been run
+        self.history = None
+        self.basehistory = None
+        
+        # Set up once the differentials have been taken
+        self.factorizations = None
         
         
     def model_stats(self):
         
         return {'num_statements': len(self.statements)}
     
+    
+    def resolve(self, path):
+        '''
+        Returns
+        -------
+        The path, relative to the base directory of the model unless it is absolute
+        '''
+        return os.path.join(self.basedir, path)
+    
         
     def parse_model_file(self, infile_name):
         '''
@@ -345,74 +742,14 @@ class Model(object):
         # but does no syntactic checking for the statements
         
         try:
-            with open(infile_name, 'r') as file:
+            with open(self.resolve(infile_name), 'r') as file:
                 modellines = file.readlines()
         except FileNotFoundError:
             raise ModelException(f"Parsing error: The file '{infile_name}' was not found.")
         except Exception as e:
             raise ModelException(f"Parsing error: An error occurred: {e}")
             
-        # aggregate into a sequence of statements
-        # aggregated statement, lines, line numbers
-        
-        statement = {'line':"", 'linenumberstart': 0}
-        instatement = False
-        linenumber = 0
-        aggregatedline = ""
-        
-        # Statements commence with a suitable reserved word (not in a comment), and terminate with a semicolon
-        # The 'working' string is what we use to bite off the appropriate bits until we have consumed the whole line
-        for i in modellines:
-        
-            linenumber = linenumber + 1
-            
-            # Comments start with a hash, and go to EOL. Strip so that we can find keywords etc
-            commentsearch = re.search(r"#", i)
-            if commentsearch:
-                working = i[:commentsearch.span()[0]].strip()
-            else:
-                working = i.strip()
-                    
-            # We admit the possibility (though it isnt neat) of multiple statements on a single line split by one or more semicolons
-            # Also a statement can span multiple lines
-            
-            # do while we havent finished with the current line
-            while len(working) > 0:
-                
-                # if we are not already in a statement, the first non-whitespace should be a reserved word
-                if not instatement:
-                    resmatch = re.search('^(equation|formula|update|file|datavar|solvar|set|subset|write|loopformulas|assert)', working, re.IGNORECASE)
-                    if not resmatch:
-                        # there is something unexpected - die gracefully
-                        raise ModelException(f"Parsing error, {infile_name}: Expected statement type on line {str(linenumber)}, instead encountered '{working}'.")
-                    # We must now be in a statement (otherwise the previous if would have failed)
-                    statement['linenumberstart'] = linenumber
-                    instatement = True
-                
-                # End of statement is via a semicolon (not within a comment - already handled above)
-                eossearch = re.search(r";", working)
-                if eossearch:
-                    # collect the part up to and including the semicolon
-                    aggregatedline = aggregatedline + working[:eossearch.span()[0]+1]
-                    # append the statement
-                    statement['line'] = aggregatedline
-                    statement['linenumberend'] = linenumber
-                    self.statements.append(statement)
-                    # reset
-                    aggregatedline = ""
-                    statement = {'line':""}
-                    instatement = False
-                    # hold onto the possible remainder
-                    working = working[eossearch.span()[1]+1:]
-                else:
-                    aggregatedline = aggregatedline + working + " "
-                    working = ""
-            
-        # if we get to here and we still have something in the 'aggregatedline' it means we never hit a trailing semicolon.
-        # we will still remember what line that statement started on in the temporary 'statement' dictionary
-        if len(aggregatedline) > 0:
-            raise ModelException(f"Parsing error, {infile_name}: last statement commencing line {str(statement['linenumberstart'])} was not terminated with a semicolon")
-            
+        self.statements = self.statements + read_statements(modellines, infile_name)
             
         # Step 2 - Break the full statement list down by statement types
         
@@ -470,7 +807,11 @@ class Model(object):
             symbolicname = statementtext.strip()
     
             # Read the Excel file into a DataFrame. sheet_name is none so that we pull in all tabs
-            self.filedata[symbolicname] = pd.read_excel(self.files[symbolicname], sheet_name=None)
+            # With the input cache the tabs are only loaded as they are used
+            if self.inputcache is not None:
+                self.filedata[symbolicname] = self.inputcache.read_excel(self.resolve(self.files[symbolicname]))
+            else:
+                self.filedata[symbolicname] = pd.read_excel(self.resolve(self.files[symbolicname]), sheet_name=None)
 
 
     def _parse_handle_datavar(self, statementtext, linenumber):
@@ -529,7 +870,7 @@ class Model(object):
         change = False
         linear = False
         
-        directivematch = re.search(r"^\[[^\]]+\]", statementtext)
+        directivematch = DIRECTIVE_REGEX.match(statementtext)
         if directivematch:
             directives = statementtext[1:directivematch.span()[1]-1]
             rest = statementtext[directivematch.span()[1]:]
@@ -580,7 +921,7 @@ class Model(object):
                 break
 
         # Reads are straightforward, and should come from already executed file statements
-        readsearch = re.search(r" from ", text, re.IGNORECASE)
+        readsearch = SET_FROM_REGEX.search(text)
         if readsearch:
             
             
@@ -612,7 +953,7 @@ class Model(object):
             raise ModelException("Multiple incompatible operators in set operation {statementtext}, line {linenumber}.")
 
         
-        if re.search(r"\+", statementtext, re.IGNORECASE):
+        if "+" in statementtext:
             # Handle one or more sums
             # 1 - split at " + " and tidy up    
             chunks = [i.strip() for i in right.split(" + ")]
@@ -643,14 +984,14 @@ class Model(object):
         
             return
         
-        elif re.search(r"\-", text, re.IGNORECASE):
+        elif "-" in text:
             chunks = [i.strip() for i in right.split(" - ")]
             if len(chunks) != 2:
                 raise ModelException(f"Expected exactly two sets on the right hand side of set difference {statementtext}, line {linenumber}.")
             self.set_manager.sub_sets(chunks[0], chunks[1], left)
             return
             # Handle a single subtraction
-        elif re.search(r" x ", text, re.IGNORECASE):
+        elif SET_CROSS_REGEX.search(text):
             chunks = [i.strip() for i in right.split(" x ")]
             if len(chunks) != 2:
                 raise ModelException(f"Expected exactly two sets on the right hand side of set cross product {statementtext}, line {linenumber}.")
@@ -738,7 +1079,7 @@ class Model(object):
     def _parse_handle_formula(self, statementtext, linenumber):
         
         # split off any leading modifiers
-        modmatch = re.search(r"^\[[^\]]*\]", statementtext)
+        modmatch = MODIFIER_REGEX.match(statementtext)
         if modmatch:
             modifiers = statementtext[modmatch.span()[0]: modmatch.span()[1]]
             modifiers = [i.strip().lower() for i in modifiers[1:-1].split(",")]
@@ -798,12 +1139,33 @@ class Model(object):
         self.writes[chunks[0]] = (filename, tabname)
 
     def read_datavars(self):
-        self.datavarvals = self.datavarhandler.read_from_files(self.filedata)
+        self.initialdatavarvals = self.datavarhandler.read_from_files(self.filedata)
+        self.datavarvals = self.initialdatavarvals.copy()
         
         
     def do_updates(self):
         self.update_manager.evaluate_all_formulae(self.datavarvals, asupdates=True, svarhandler=self.solvarhandler, svarvals=self.solvarvals)
             
+    def reporting_offsets(self):
+        '''
+        Returns
+        -------
+        The offsets of the svars and of the dvars that are written out - those of the reporting
+        vars, or all of them if there are no reporting vars
+        '''
+        if self.reportingvars is not None:
+            # Each reporting var is a block of columns, and the blocks are taken in the order they sit in the values
+            reportingvars = set(self.reportingvars)
+            offsets = []
+            for handler in [self.solvarhandler, self.datavarhandler]:
+                blocks = [np.arange(handler.offsets[name], handler.offsets[name] + handler.sizes[name]) for name in handler.names if name in reportingvars]
+                offsets.append(np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int64))
+            svaroffsets, dvaroffsets = offsets
+        else:
+            svaroffsets = np.arange(len(self.solvarhandler.fullnamesbycolumn))
+            dvaroffsets = np.arange(len(self.datavarhandler.fullnamesbycolumn))
+        return svaroffsets, dvaroffsets
+
     def do_writes(self, aggregate=True, long=True):
         
         # This first section does the writes that are flagged as reporting vars
@@ -817,18 +1179,17 @@ class Model(object):
         
         # We are building a list of offsets here. This is in especially important when we are doing the long format, where we are building a big dataframe
         # that is a subset of the fullnames and the datavalues.
+        svaroffsets, dvaroffsets = self.reporting_offsets()
+        
+        os.makedirs(self.outputdir, exist_ok=True)
+        
         if self.reportingvars is not None:
-            svaroffsets = [index for index, sublist in enumerate(self.solvarhandler.fullnamesbycolumn) if sublist[0] in self.reportingvars]
-            dvaroffsets = [index for index, sublist in enumerate(self.datavarhandler.fullnamesbycolumn) if sublist[0] in self.reportingvars]
             missingnames = [name for name in self.reportingvars if name not in list(self.solvarhandler.offsets.keys()) + list(self.datavarhandler.offsets.keys()) ]
 
             if len(missingnames) > 0:
                 print("Warning - the following names have been listed in the reporting variables but do not appear as either a data nor a solution variable:")
                 for i in missingnames:
                     print(f" -> {i}")
-        else:
-            svaroffsets = [index for index, sublist in enumerate(self.solvarhandler.fullnamesbycolumn)]
-            dvaroffsets = [index for index, sublist in enumerate(self.datavarhandler.fullnamesbycolumn)]
             
         # We will handle the solve/don't solve by defining two different simlist options
         if self.solve == True:
@@ -839,140 +1200,60 @@ class Model(object):
         if not long:
             # We'll be putting dataframes in a dict
             dfdict = {}
+        
+        # Excel keeps the full names, the columnar formats split them into encoded variable and element columns
+        encoded = self.outputformat != "xlsx"
             
         for sim in simlist:
 
             # Here we are taking slices of the full svarvals and dvarvals based on the offsets
+            # Only the steps kept by the retention policy are written
             if sim == 'base':
-                
-                svars = [
-                    [
-                        [substep[i] for i in svaroffsets]  
-                        for substep in step
-                        ]
-                    for step in self.basesvarvals
-                    ]
-                
-                dvars = [
-                    [
-                        [substep[i] for i in dvaroffsets]  
-                        for substep in step
-                        ]
-                    for step in self.basedvarvals
-                    ]
-                
+                svars = self.basehistory.svar_history(svaroffsets)
+                dvars = self.basehistory.dvar_history(dvaroffsets)
+                stepnumbers = self.basehistory.stepnumbers
             elif sim == 'policy':
-                svars = [
-                    [
-                        [substep[i] for i in svaroffsets]  
-                        for substep in step
-                        ]
-                    for step in self.allsvarvals
-                    ]
-                
-                dvars = [
-                    [
-                        [substep[i] for i in dvaroffsets]  
-                        for substep in step
-                        ]
-                    for step in self.alldvarvals
-                    ]
+                svars = self.history.svar_history(svaroffsets)
+                dvars = self.history.dvar_history(dvaroffsets)
+                stepnumbers = self.history.stepnumbers
             else:
-                dvars = [
-                    [
-                        [self.datavarvals[i] for i in dvaroffsets]  
-                        ]
-                    ]
+                dvars = self.datavarvals[dvaroffsets].reshape(1, 1, -1)
+                stepnumbers = [0]
+            
+            # The tables written out for this sim
+            tables = {}
 
             if self.solve == True:
-                valheadings = ["SVAR"]
-    
-                # initialise the data block with the appropriate svar row data
-                if long:
-                    data = [[i] for i in [self.solvarhandler.fullnames[j] for j in svaroffsets]]
-                else:
-                    data = [i for i in [self.solvarhandler.fullnamesbycolumn[j] for j in svaroffsets]]
-    
+                # The value columns, one row per svar
                 if aggregate:
-                    for s in range(len(svars)):
-                        valheadings.append(f"S{s}")
-                        tempdata = [0] * len(self.solvarhandler.fullnames)
-                        for ss in range(len(svars[s])):
-                            for i,databit in enumerate(svars[s][ss]):
-                                if self.solvarhandler.change[self.solvarhandler.fullnamesbycolumn[i][0]]:
-                                    tempdata[i] = tempdata[i] + databit
-                                else:
-                                    tempdata[i] = ((1 + tempdata[i]/100) * (1 + databit/100)) * 100 - 100
-                        data = [i + [j] for i,j in zip(data, tempdata)]
+                    valheadings = [f"S{step}" for step in stepnumbers]
+                    # Over the substeps of a step, changes add up and percentage changes compound
+                    values = aggregate_substeps(svars, self.solvarhandler.change_mask()[svaroffsets]).T
                 else:
-                    for s in range(len(svars)):
-                        for ss in range(len(svars[s])):
-                            valheadings.append(f"S{s}SS{ss}")
-                            if data is None:
-                                data = [[i] for i in svars[s][ss]]
-                            else:
-                                data = [i + [j] for i,j in zip(data, svars[s][ss])]
+                    valheadings = [f"S{step}SS{ss}" for step in stepnumbers for ss in range(svars.shape[1])]
+                    values = svars.transpose(2, 0, 1).reshape(len(svaroffsets), -1)
                 
                 if long:
-                    svardf = pd.DataFrame(data, columns=valheadings)
+                    tables["svars"] = writers.long_frame(self.solvarhandler, svaroffsets, values, valheadings, "SVAR", encoded)
                 else:
-                    # Get the list of svar names that we are reporting
-                    svarnames = list(set([i[0] for i in data]))
-                    
-                    # make the appropriate df and put it in our list to be dropped out
-                    for i in svarnames:
-                        datasnip = [j[1:] for j in data if j[0] == i]
-                        if self.solvarhandler.sets[i] is not None:
-                            colheadings = self.solvarhandler.sets[i] + ['Value']
-                        else:
-                            colheadings = ['Value']
-                        dfdict[i] = pd.DataFrame(datasnip, columns=colheadings)
-
+                    # One df per svar, in the same format as the input data
+                    dfdict.update(writers.wide_frames(self.solvarhandler, svaroffsets, values, valheadings))
 
-            
-            valheadings = ["DVAR"]
-            # initialise the data block with the appropriate dvar row titles
-            if long:
-                data = [[i] for i in [self.datavarhandler.fullnames[j] for j in dvaroffsets]]
-            else:
-                data = [i for i in [self.datavarhandler.fullnamesbycolumn[j] for j in dvaroffsets]]
-            
+            # The value columns, one row per dvar. When aggregating we report the dvars at the start of each step
             if aggregate:
-                for s in range(len(dvars)):
-                    valheadings.append(f"S{s}")
-                    data = [i + [j] for i,j in zip(data, dvars[s][0])]
+                valheadings = [f"S{step}" for step in stepnumbers]
+                values = dvars[:, 0, :].T
             else:
-                for s in range(len(dvars)):
-                    for ss in range(len(dvars[s])):
-                        valheadings.append(f"S{s}SS{ss}")
-                        if data is None:
-                            data = [[i] for i in dvars[s][ss]]
-                        else:
-                            data = [i + [j] for i,j in zip(data, dvars[s][ss])]
+                valheadings = [f"S{step}SS{ss}" for step in stepnumbers for ss in range(dvars.shape[1])]
+                values = dvars.transpose(2, 0, 1).reshape(len(dvaroffsets), -1)
     
             if long:
-                dvardf = pd.DataFrame(data, columns=valheadings)
+                tables["dvars"] = writers.long_frame(self.datavarhandler, dvaroffsets, values, valheadings, "DVAR", encoded)
             else:
-                # Get the list of svar names that we are reporting
-                dvarnames = list(set([i[0] for i in data]))
-                
-                # make the appropriate df and put it in our list to be dropped out
-                for i in dvarnames:
-                    datasnip = [j[1:] for j in data if j[0] == i]
-                    if self.datavarhandler.sets[i] is not None:
-                        colheadings = self.datavarhandler.sets[i] + ['Value']
-                    else:
-                        colheadings = ['Value']
-                    dfdict[i] = pd.DataFrame(datasnip, columns=colheadings)            
+                # One df per dvar, in the same format as the input data
+                dfdict.update(writers.wide_frames(self.datavarhandler, dvaroffsets, values, valheadings))
             
-            with pd.ExcelWriter(sim +".xlsx", engine='openpyxl') as writer:
-                if long:
-                    if self.solve == True:
-                        svardf.to_excel(writer, sheet_name="svars", index=False)
-                    dvardf.to_excel(writer, sheet_name="dvars", index=False)        
-                else:
-                    for sheet_name, df in dfdict.items():
-                        df.to_excel(writer, sheet_name=sheet_name, index=False)
+            writers.write_tables(os.path.join(self.outputdir, sim), tables if long else dfdict, self.outputformat)
 
 
         # This second section does the write statements in the file. Here we have named logical files
@@ -993,19 +1274,12 @@ class Model(object):
 
         for item, deets in self.writes.items():
             
-            datazip = zip(self.datavarhandler.fullnamesbycolumn, self.datavarvals)
-            
             # First lets see if this is a datavar
             if item in self.datavarhandler.names:
-                # Build the appropriate dataframe
-                if self.datavarhandler.sets[item] is not None:
-                    datasnip = [j[0][1:] + [j[1]] for j in datazip if j[0][0] == item]
-                    colheadings = self.datavarhandler.sets[item] + ['Value']
-                else:
-                    datasnip = [[j[1]] for j in datazip if j[0][0] == item]
-                    colheadings = ['Value']
-                    
-                df = pd.DataFrame(datasnip, columns=colheadings)            
+                # Build the appropriate dataframe from the slice of the dvars that is this datavar
+                offset = self.datavarhandler.offsets[item]
+                values = self.datavarvals[offset:offset + self.datavarhandler.sizes[item]].reshape(-1, 1)
+                df = writers.wide_frame(self.datavarhandler, item, values, ["Value"])
             # Second, see if its a set
             elif item in self.set_manager.cge_sets:
                 df = pd.DataFrame({item:self.set_manager.cge_sets[item].elements})
@@ -1020,375 +1294,918 @@ class Model(object):
 
         for name, data in newfiledata.items():
             
-            with pd.ExcelWriter(self.newfiles[name], engine='openpyxl') as writer:
-                for [sheet_name, df] in data:
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
+            writers.write_tables(os.path.join(self.outputdir, os.path.splitext(self.newfiles[name])[0]), {sheet_name: df for [sheet_name, df] in data}, self.outputformat)
         
 
 
-    def read_closure_shocks(self):
+    def setup(self, model_file, usecompiled=True):
+        '''
+        Parse the model file, read the data and (if we are solving) take the differentials.
+        This is all the work that is shared between every simulation of the model.
+
+        Parameters
+        ----------
+        model_file: The model file to parse
+        usecompiled: Load the compiled artifact for the model file instead, if there is a valid one
+
+        Returns
+        -------
+        None.
+        '''
         
+        # If the model has been compiled (see compile_model), we can skip straight past the front end
+        if usecompiled and self.solve and self.compileddir is not None and self.load_compiled(model_file):
+            print(f"Loaded the compiled model from {self.compiled_path(model_file)}")
+            self.factorizations = FactorizationCache(self.doiterative)
+            return
         
-        self.baseclosures = []
-        self.polclosures = []
+        # Read model file
+        self.parse_model_file(model_file)
+    
+        print(f"Equations are of size {len(self.equation_manager.fullnames)}")
+        print(f"Svars are of size {len(self.solvarhandler.fullnames)}")
         
-        # Open and process the closures and shocks
-        for borp in ['b','p']:
-            
-            if borp == 'b':
-                files = self.basefiles
-            else:
-                files = self.polfiles
-                
-            for b in files:
-                
-                closure = {}
-                
-                with open(b, 'r') as file:
-                    closurelines = file.readlines()
-                    
-                for c in closurelines:
-                    
-                    if c.strip() != "":
-                        splitline = c.strip().split()
-                        
-                        # There are some possibilities here
-                        # We could be adding a variable, removing a variable, or shocking a variable
-                        if len(splitline) < 2:
-                            raise ModelException(f"Error: Was expecting at least two keywords on line '{splitline}' in file {b}")
-                        
-                        
-                        # We need to correctly interpret the variable. It could have no sets (in which case it's all elements),
-                        # it could have named sets, and it could have named elements
-        
-                        if '_' in splitline[1]:
-        
-                            splitbits = splitline[1].split("_")
-                            var = splitbits[0]
-                            setsetc = splitbits[1:]
-        
-                            # First, get the sets the variable is defined over
-                            variablesets = self.solvarhandler.sets[var]
-        
-                            # Iterate through the setsetc and pull out either the sets that are named, or the elements
-                            tuplebuilder = []
-                            for n, s in enumerate(setsetc):
-                                if s[0] != "'":
-                                    # This should be a named set.
-                                    # We need to get the mapping from the elements of the named set back through
-                                    # to the elements of the variable set
-                                    mapping = self.set_manager.get_mapping(variablesets[n],s)
-                                    if mapping is None:
-                                        raise ModelException(f"Error parsing shock line '{c.strip()}' in file {b}. Unknown set {s} - did you forget quotes?")
-                                    tuplebuilder.append(self.set_manager.get_mapping(variablesets[n],s))
-                                else:
-                                    # This is an element of the set over which the set was defined. Need to strip the quotes
-                                    try:
-                                        idx = self.set_manager.cge_sets[variablesets[n]].get_idx(s[1:-1])
-                                    except:
-                                        raise ModelException(f"Error processing line {c} in closure file {b}.")
-                                    tuplebuilder.append([idx])
-                                    
-                            # now use itertools to build tuples
-                            indextuples = list(itertools.product(*tuplebuilder))
-                            
-                            # Get the offsets
-                            offsets = self.solvarhandler.get_index_list(var, variablesets, indextuples)
-                        else:
-                            var = splitline[1]
-                            offsets = list(range(self.solvarhandler.offsets[splitline[1]], self.solvarhandler.offsets[splitline[1]] + self.solvarhandler.sizes[splitline[1]]))
+        # Read the required vars
+        print("Reading data vars")
+        self.read_datavars()
         
+        if self.solve:
+            print("Taking differentials")
+            # Take the differentials - noting that some may be dependent on datavars (hence why it is after the evaluation of formulae)
+            self.equation_manager.diffall(self.solvarhandler, self.datavarvals, workers=self.diffworkers)
             
+            # The factorisations are kept across substeps, steps and simulations
+            self.factorizations = FactorizationCache(self.doiterative)
+
+    def compiled_path(self, model_file):
+        '''
+        Returns
+        -------
+        The path of the compiled artifact for the model file. The name carries a hash of the
+        model file, the files section of the yml and the artifact version, so a change to any of
+        those means a different artifact.
+        '''
+        h = hashlib.sha256()
+        h.update(f"compiled {COMPILED_VERSION}\n".encode())
+        with open(self.resolve(model_file), 'rb') as file:
+            h.update(file.read())
+        for name in sorted(self.files):
+            h.update(f"\n{name} {self.files[name]}".encode())
         
+        stem = os.path.splitext(os.path.basename(model_file))[0]
+        return os.path.join(self.compileddir, f"{stem}-{h.hexdigest()[:16]}.pkl")
+
+    def data_hashes(self):
+        '''
+        Returns
+        -------
+        A dictionary of the sha256 of each input data file read by the model, keyed by the path
+        given in the yml
+        '''
+        hashes = {}
+        for name in sorted(self.filedata):
+            with open(self.resolve(self.files[name]), 'rb') as file:
+                hashes[self.files[name]] = hashlib.sha256(file.read()).hexdigest()
+        return hashes
+
+    def save_compiled(self, model_file):
+        '''
+        Write the parsed and differentiated model out as a compiled artifact. This needs to be
+        called after setup.
+
+        Returns
+        -------
+        The path of the artifact
+        '''
+        path = self.compiled_path(model_file)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
         
-                        if splitline[0].lower() == "add":
-                            # We will warn for any variables that are repeated, but not throw an error
-                            
-                            intersection = list(set(closure) & set(offsets))
-                            if intersection != []:
-                                print(f"Warning - some elements of closure line '{c}' are already in the closure")
-                                
-                            for o in offsets:
-                                closure[o] = [0, self.solvarhandler.ischange(var)]
-        
-                        elif splitline[0].lower() == "remove":
-                            # Make sure that every element being removed is already in the closure
-                            if list(set(offsets) - set(closure)) != []:
-                                raise ModelException(f"Error - trying to remove elements that are not in the closure in line '{c}'.")
+        artifact = {"version": COMPILED_VERSION,
+                    "datahashes": self.data_hashes(),
+                    "state": {name: getattr(self, name) for name in COMPILED_ATTRIBUTES}}
         
-                            for o in offsets:
-                                del closure[o]
+        with open(path + ".tmp", 'wb') as file:
+            pickle.dump(artifact, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def load_compiled(self, model_file):
+        '''
+        Load the compiled artifact for the model file, if there is one and it is still valid
+        for the data on disk
+
+        Returns
+        -------
+        True if the artifact was loaded, False otherwise (in which case the model is untouched)
+        '''
+        path = self.compiled_path(model_file)
+        if not os.path.exists(path):
+            return False
         
-                                
-                        elif splitline[0].lower() == "shock":
+        try:
+            with open(path, 'rb') as file:
+                artifact = pickle.load(file)
+        except Exception as e:
+            print(f"Warning - unable to read the compiled model {path} ({e}), recompiling")
+            return False
+        
+        if artifact.get("version") != COMPILED_VERSION:
+            return False
+        
+        # The data feeds the differentials (through any conditionals), so it has to match too
+        for datafile, datahash in artifact["datahashes"].items():
+            if not os.path.exists(self.resolve(datafile)):
+                return False
+            with open(self.resolve(datafile), 'rb') as file:
+                if hashlib.sha256(file.read()).hexdigest() != datahash:
+                    print(f"Data file {datafile} has changed since the model was compiled, recompiling")
+                    return False
+        
+        for name, value in artifact["state"].items():
+            setattr(self, name, value)
+        self.datavarvals = self.initialdatavarvals.copy()
+        return True
+
+    def reset(self):
+        '''
+        Throw away the current simulation and go back to the data as read from the files
+        '''
+        self.history = None
         
-                            # Make sure that every element being shocked is already in the closure
-                            if list(set(offsets) - set(closure)) != []:
-                                raise ModelException(f"Error - trying to shock elements that are not in the closure in line '{c}'.")
+        self.solvarvals = np.zeros(0)
         
-                            shockval = float(splitline[2])
-                            for o in offsets:
-                                closure[o][0] = shockval
-                            
+        # The data has not changed since it was read, so there is no need to read it again
+        self.datavarvals = self.initialdatavarvals.copy()
+
+    def archive_base(self):
+        '''
+        Archive the svars and dvars of the simulation just run as the baseline, and reset the model
+        so that it is ready for the policy
+        '''
+        # reset starts a new history, so the baseline can just take over the current one
+        self.basehistory = self.history
         
-                        else:
-                            raise ModelException(f"Error parsing shock line '{c.strip()}' in file {b}.")
-                
-                if borp == 'b':
-                    self.baseclosures.append(closure)
-                else:
-                    self.polclosures.append(closure)
+        self.reset()
 
-            
+    def run_simulation(self, simtype, retention=None, callback=None):
+        '''
+        Run all the steps and substeps of a simulation, from the current state of the model
+
+        Parameters
+        ----------
+        simtype: Either "base" or "policy". The policy draws on the archived baseline (basehistory)
+                 for the values of any variables that are exogenous in the policy closure
+        retention: The retention policy for the history of the simulation (see history.py), by
+                   default the one given in the yml
+        callback: If given, called with the StepResult of each step as it completes
 
+        Returns
+        -------
+        None.
+        '''
+        for result in self.run_simulation_iter(simtype, retention):
+            if callback is not None:
+                callback(result)
 
+    def run_iter(self):
+        '''
+        Run the baseline and then the policy (as run_model does), yielding each step of each as
+        it completes. The closures need to have been read. Stopping early leaves the model part
+        way through the simulation.
 
+        Yields
+        ------
+        A StepResult for each step of the baseline, then for each step of the policy
+        '''
+        yield from self.run_simulation_iter("base")
+        self.archive_base()
+        yield from self.run_simulation_iter("policy")
 
-def run_model(model_file="qgem.model", do_policy = True):
+    def policy_model(self):
+        '''
+        Returns
+        -------
+        A copy of the model that shares everything that is fixed once the model is set up (the
+        statements, the handlers, the kernels and the closures) but has its own simulation state,
+        jacobian buffers and factorisations, so that it can run the policy while this model runs
+        the baseline
+        '''
+        policy = copy.copy(self)
+        policy.equation_manager = copy.copy(self.equation_manager)
+        policy.equation_manager.jacobian = self.equation_manager.jacobian.copy()
+        policy.factorizations = FactorizationCache(self.doiterative)
+        policy.history = None
+        policy.solvarvals = np.zeros(0)
+        policy.datavarvals = self.initialdatavarvals.copy()
+        return policy
+
+    def run_pipelined(self, baseretention=None):
+        '''
+        Run the baseline and then the policy, as run_iter does, but with the policy on a thread of
+        its own (see policy_model). Each policy step only needs the baseline up to the same step, so
+        it starts as soon as the baseline has finished that step. The model is left as run_iter
+        leaves it.
+
+        Parameters
+        ----------
+        baseretention: The retention policy for the baseline, by default the one given in the yml
+
+        Yields
+        ------
+        A StepResult for each step of the baseline and of the policy, in the order they complete.
+        They are all yielded on the calling thread.
+        '''
+        policy = self.policy_model()
+        basesteps = queue.Queue() # The steps of the baseline that are done, None to stop the policy
+        results = queue.Queue() # The StepResults of the policy, or the exception it raised, then None
+        stop = threading.Event()
+        finished = threading.Event() # Set once the policy thread's final None has been taken off results
+        
+        def run_policy():
+            try:
+                steps = policy.run_simulation_iter("policy")
+                for s in range(self.steps):
+                    if basesteps.get() is None or stop.is_set():
+                        steps.close()
+                        return
+                    results.put(next(steps))
+                # Finish off the generator, which flushes the history
+                for _ in steps:
+                    pass
+            except BaseException as e:
+                results.put(e)
+            finally:
+                results.put(None)
+        
+        def policy_results(block):
+            # The policy steps that are done, raising anything the policy raised
+            while not finished.is_set():
+                try:
+                    result = results.get(block=block)
+                except queue.Empty:
+                    return
+                if result is None:
+                    finished.set()
+                    return
+                if isinstance(result, BaseException):
+                    raise result
+                yield result
+        
+        thread = None
+        try:
+            for result in self.run_simulation_iter("base", baseretention):
+                if thread is None:
+                    # The baseline history is allocated by now
+                    policy.basehistory = self.history
+                    thread = threading.Thread(target=run_policy, name="policy", daemon=True)
+                    thread.start()
+                basesteps.put(result.step)
+                yield result
+                yield from policy_results(block=False)
+            
+            if thread is not None:
+                yield from policy_results(block=True)
+        finally:
+            if thread is not None:
+                stop.set()
+                basesteps.put(None)
+                thread.join()
+        
+        self.basehistory = self.history
+        self.history = policy.history
+        self.solvarvals = policy.solvarvals
+        self.datavarvals = policy.datavarvals
+
+    def run_simulation_iter(self, simtype, retention=None):
+        '''
+        Run a simulation as run_simulation does, yielding the reporting vars of each step as it
+        completes. The history is flushed when the simulation finishes or the generator is closed.
+
+        Yields
+        ------
+        A StepResult for each step
+        '''
+        if retention is None:
+            retention = self.retention
+        
+        # Under the reporting and final retention policies we only hold on to what do_writes needs,
+        # plus (for the baseline) the svars that the policy closures take the baseline values of
+        svarcolumns = None
+        dvarcolumns = None
+        trackedsvars = None
+        if retention != "full":
+            svarcolumns, dvarcolumns = self.reporting_offsets()
+            if simtype == "base":
+                trackedsvars = np.unique(np.concatenate([closure.exogenous for closure in self.polclosures] + [np.zeros(0, dtype=np.int64)]))
+        
+        # Allocate the history for every step and substep up front. If memmaphistory is set in the
+        # yml it is memory mapped to {simtype}.svars.npy and {simtype}.dvars.npy alongside the outputs
+        self.history = history.HistoryStore(self.steps, self.substeps, len(self.solvarhandler.fullnames), len(self.datavarvals),
+                                            directory=self.outputdir if self.memmaphistory else None, name=simtype,
+                                            svarcolumns=svarcolumns, dvarcolumns=dvarcolumns,
+                                            finalonly=(retention == "final"), trackedsvars=trackedsvars)
+        
+        # What each step hands back, whatever the history holds on to
+        svaroffsets, dvaroffsets = self.reporting_offsets()
+        svarnames = [self.solvarhandler.fullnames[i] for i in svaroffsets]
+        dvarnames = [self.datavarhandler.fullnames[i] for i in dvaroffsets]
+        ischange = self.solvarhandler.change_mask()[svaroffsets]
+        
+        try:
+            yield from self._run_steps(simtype, svaroffsets, dvaroffsets, svarnames, dvarnames, ischange)
+        finally:
+            self.history.flush()
+
+    def _run_steps(self, simtype, svaroffsets, dvaroffsets, svarnames, dvarnames, ischange):
+        for s in range(self.steps):
+            print(f"Doing {simtype}")
+            print(f"  Doing step {s}")
+            stepsvars = np.zeros((self.substeps, len(svaroffsets)))
+            stepdvars = np.zeros((self.substeps, len(dvaroffsets)))
+            for ss in range(self.substeps):
+                # Evaluate all formulae
+                if ss == 0:
+                    excludedmodifiers = []
+                else:
+                    excludedmodifiers = ["initial"]
+
+                self.formula_manager.evaluate_all_formulae(self.datavarvals, excludedmodifiers = excludedmodifiers)
+                self.assert_manager.check_all(self.datavarvals)
     
-    # Instantiate the model
-    model = Model()
+                # Store the pre-substep dvarvals vector
+                self.history.record_dvars(s, ss, self.datavarvals)
+                stepdvars[ss] = self.datavarvals[dvaroffsets]
+        
+                # Build the A matrix
+                # The sparsity pattern of the partial derivatives is fixed, so the jacobian engine
+                # only refills the values for the current dvarvals
+                jacobian = self.equation_manager.jacobian.evaluate(self.datavarvals)
+                        
+                # This is the closure and shocks
+                if simtype == "base":
+                    closure = self.baseclosures[s]
+                else:
+                    closure = self.polclosures[s]
+                
+                # The exogenous variables are eliminated from the system, so here we just need
+                # the values that they take. In the policy run each takes its shock on top of the
+                # value it took in the base run
+                exogenous = closure.exogenous
+                if simtype == "policy":
+                    basevals = self.basehistory.svar_values(s, ss, exogenous)
+                else:
+                    basevals = 0
+                exogvals = closure.exogenous_values(basevals, self.substeps)
     
-    # Read model file
-    model.parse_model_file(model_file)
-
+    
+    
+                # Define labels and data
+                rowlabels = self.equation_manager.fullnames
+                collabels = self.solvarhandler.fullnames
 
 
+                zero_row_indices = np.where(jacobian.getnnz(axis=1) == 0)[0]
+                if len(zero_row_indices) > 0:
+                    print("Caught the following equations with no non-zero derivatives:")
+                    for i in zero_row_indices:
+                        print(f"   {rowlabels[i]}")
+    
+                # An exogenous variable counts as having a derivative (its closure row)
+                colnnz = jacobian.getnnz(axis=0)
+                colnnz[exogenous] += 1
+                zero_row_indices = np.where(colnnz == 0)[0]
+                if len(zero_row_indices) > 0:
+                    print("Caught the following variables with no non-zero derivatives:")
+                    for i in zero_row_indices:
+                        print(f"   {collabels[i]}")
+
+
+                x = do_inversion(jacobian, exogvals, rowlabels, solver=self.factorizations, exogenous=exogenous)
+
+                # Report the residual
+                Ax = jacobian.dot(x)
+                res = np.linalg.norm(Ax)
+                print(f"Residual norm is {res}")
     
-    print(f"Equations are of size {len(model.equation_manager.fullnames)}")
-    print(f"Svars are of size {len(model.solvarhandler.fullnames)}")
+                self.solvarvals = x
     
-    # Read the required vars
-    print("Reading data vars")
-    model.read_datavars()
+                # Keep history of the svarvals       
+                self.history.record_svars(s, ss, x)
+                stepsvars[ss] = x[svaroffsets]
+                
+                # Do updates
+                self.do_updates()
+                self.assert_manager.check_all(self.datavarvals)
+            
+            yield StepResult(simtype, s, stepsvars, stepdvars, svarnames, dvarnames, ischange)
 
-    if model.solve == False:
-        # Do any start of sim only formulae. This is all we will do before skipping over to the writes
-        model.formula_manager.evaluate_all_formulae(model.datavarvals)
-        
-        model.assert_manager.check_all(model.datavarvals)
-    else:
-        # Actually solve
 
-        print("Taking differentials")
-        # Take the differentials - noting that some may be dependent on datavars (hence why it is after the evaluation of formulae)
-        model.equation_manager.diffall(model.solvarhandler, model.datavarvals)
-        
+    def variable_offsets(self, spec, context, bareelements=False):
+        '''
+        Find the svar elements named as they are in a closure file - the whole variable (x1), the
+        elements over named subsets (x1_COM_IND) or quoted elements (x1labiEmplWgt_'EMIRATI'),
+        or a mixture of the two
+
+        Parameters
+        ----------
+        spec: The variable as it appears in the closure file
+        context: Where the spec came from, for the error messages
+        bareelements: If true an unquoted name that is not a subset is taken to be an element,
+                      so that x1labiEmplWgt_EMIRATI means x1labiEmplWgt_'EMIRATI'
+
+        Returns
+        -------
+        The name of the variable and an array of the offsets of the elements
+        '''
+        splitbits = spec.split("_")
+        var = splitbits[0]
+        setsetc = splitbits[1:]
+        
+        if var not in self.solvarhandler.offsets:
+            raise ModelException(f"Error parsing {context}. Unknown variable {var}.")
+        
+        if not setsetc:
+            return var, np.arange(self.solvarhandler.offsets[var], self.solvarhandler.offsets[var] + self.solvarhandler.sizes[var])
+        
+        # We need to correctly interpret the variable. It could have named sets, and it could have named elements
+        
+        # First, get the sets the variable is defined over
+        variablesets = self.solvarhandler.sets[var]
+        
+        # Iterate through the setsetc and pull out either the sets that are named, or the elements
+        tuplebuilder = []
+        for n, s in enumerate(setsetc):
+            if s[0] != "'":
+                # This should be a named set.
+                # We need to get the mapping from the elements of the named set back through
+                # to the elements of the variable set
+                mapping = self.set_manager.get_mapping(variablesets[n],s)
+                if mapping is None and bareelements and s in self.set_manager.cge_sets[variablesets[n]].elements:
+                    mapping = [self.set_manager.cge_sets[variablesets[n]].get_idx(s)]
+                if mapping is None:
+                    raise ModelException(f"Error parsing {context}. Unknown set {s} - did you forget quotes?")
+                tuplebuilder.append(mapping)
+            else:
+                # This is an element of the set over which the set was defined. Need to strip the quotes
+                try:
+                    idx = self.set_manager.cge_sets[variablesets[n]].get_idx(s[1:-1])
+                except:
+                    raise ModelException(f"Error parsing {context}. Unknown element {s}.")
+                tuplebuilder.append([idx])
+                
+        if len(tuplebuilder) != len(variablesets):
+            raise ModelException(f"Error parsing {context}. {var} ranges over {len(variablesets)} sets.")
         
-        # Read in the closure and shock files
-        model.read_closure_shocks()
+        # The offsets of every combination of the indexes, in the same order as itertools.product
+        # would give them
+        sizes = [len(self.set_manager.cge_sets[s]) for s in variablesets]
+        grid = np.ix_(*[np.asarray(indexes, dtype=np.int64) for indexes in tuplebuilder])
+        return var, self.solvarhandler.offsets[var] + np.ravel_multi_index(grid, sizes).ravel()
+
+    def read_closure(self, closurefile):
+        '''
+        Read a closure file. Each file is only compiled once - later reads (by this model or its
+        copies) of a file with the same contents come from memory
+
+        Returns
+        -------
+        The closures.Closure
+        '''
+        return self.closurestore.get(self.resolve(closurefile), lambda path: self._compile_closure_file(path, closurefile))
+
+    def _compile_closure_file(self, path, b):
         
-        # Solve the model
+        closure = closures.ClosureBuilder(len(self.solvarhandler.fullnames))
         
-        if model.doiterative:
-            # We need to spin up a pardiso solver
-            pardisosolver = PyPardisoSolver()
-        else:
-            pardisosolver = None
-            
-            
+        with open(path, 'r') as file:
+            closurelines = file.readlines()
             
-        for simtype in ['base', 'policy']:
-            # We are going to do 2 passes - a baseline and a policy run.
-            # At the end of the baseline we will archive the simluation results (ie, the svars and dvars)
-            # and then we will do the policy. The policy will draw on the archived baseline numbers
-            # to determine any shocks that need to be brought over for exogenous variables
+        for c in closurelines:
             
-            
-            for s in range(model.steps):
-                print(f"Doing {simtype}")
-                print(f"  Doing step {s}")
-                for ss in range(model.substeps):
-                    # Evaluate all formulae
-                    if ss == 0:
-                        excludedmodifiers = []
-                    else:
-                        excludedmodifiers = ["initial"]
-    
-    
-        #            print("Evaluating start of substep formulae")                
-                    model.formula_manager.evaluate_all_formulae(model.datavarvals, excludedmodifiers = excludedmodifiers)
-                    model.assert_manager.check_all(model.datavarvals)
-        
-                    # Store the pre-substep dvarvals vector
-                    if len(model.alldvarvals) == s: # Triggered on the first substep
-                        model.alldvarvals.append([])
-                    model.alldvarvals[s].append(copy.deepcopy(model.datavarvals))
-            
-            
-        #            print("Building solution system")
-                    # Build the A matrix
-                    # Define row indices, column indices, and data for non-zero elements
-                    row_indices = []
-                    col_indices = []
-                    data = []
-        
-                    # This is for the partial derivatives
-                    for i in range(len(model.equation_manager.derivatives)):
-                        for j in range(len(model.equation_manager.derivatives[i])):
-                            offset = model.equation_manager.derivatives[i][j][0]
-                            val = 0
-                            for twig in model.equation_manager.derivatives[i][j][1]:
-                                twigval = twig[3].evaluate(model.datavarhandler, None, twig[0], twig[1], [twig[2]], model.datavarvals, None)
-                                val = val + twigval[0]
-        
-                            row_indices.append(i)
-                            col_indices.append(offset)
-                            data.append(val)
-                            
-                    # This is the closure and shocks
-                    
-                    # First, define the right-hand side vector for the equation Ax = b
-                    # all the rhs for the equations are zeros
-                    if simtype == "base":
-                        closure = model.baseclosures[s]
-                    else:
-                        closure = model.polclosures[s]
-                    
-                    eqnlen = len(model.equation_manager.derivatives)
-                    closurelen = len(closure)
-        
-#                    b = [0] * eqnlen
-                    b = np.zeros(eqnlen + closurelen)
+            if c.strip() != "":
+                splitline = c.strip().split()
+                
+                # There are some possibilities here
+                # We could be adding a variable, removing a variable, or shocking a variable
+                if len(splitline) < 2:
+                    raise ModelException(f"Error: Was expecting at least two keywords on line '{splitline}' in file {b}")
+                
+                var, offsets = self.variable_offsets(splitline[1], f"shock line '{c.strip()}' in file {b}")
+                
+                if splitline[0].lower() == "add":
+                    # We will warn for any variables that are repeated, but not throw an error
+                    if closure.add(offsets, self.solvarhandler.ischange(var)):
+                        print(f"Warning - some elements of closure line '{c}' are already in the closure")
+                
+                elif splitline[0].lower() == "remove":
+                    # Make sure that every element being removed is already in the closure
+                    if not closure.contains(offsets):
+                        raise ModelException(f"Error - trying to remove elements that are not in the closure in line '{c}'.")
                     
-                    # We will need to do 2 things here
-                    # The first is that we will need to build the b vector. The ordering in this vector
-                    # is determined by the ordering in the closure file
-                    # The second is we need to keep hold of a list of if each variable was exogenous
-                    # or endogenous in the base (by step, not substep), so that if we do a swap
-                    # from baseline to policy we can adopt the baseline value in the policy
+                    closure.remove(offsets)
+                
+                elif splitline[0].lower() == "shock":
                     
+                    # Make sure that every element being shocked is already in the closure
+                    if not closure.contains(offsets):
+                        raise ModelException(f"Error - trying to shock elements that are not in the closure in line '{c}'.")
                     
-                    for i,j in enumerate(closure.keys()):
-                        row_indices.append(i + eqnlen)
-                        col_indices.append(j)
-                        data.append(1)
-                        
-                        # If we are doing the policy run, we need to get the value that this variable
-                        # took on in the base run.
-                        if simtype == "policy":
-                            baseval = model.basesvarvals[s][ss][j]
-                        else:
-                            # We'll just dummy in a zero so that we don't have to do two seperate calculations
-                            # in the next step
-                            baseval = 0
-                        
-                        
-                        
-                        if closure[j][1]: # Element 1 is true if the variable is a change variable, false if not
-                            b[i + eqnlen] = baseval + (closure[j][0] / model.substeps)
-#                            b.append(baseval + (closure[j][0] / model.substeps))
-                        else:
-                            b[i + eqnlen] = ((1 + baseval / 100) * (1+ closure[j][0] / 100) ** (1 / model.substeps)) * 100 - 100
-#                            b.append(((1 + baseval / 100) * (1+ closure[j][0] / 100) ** (1 / model.substeps)) * 100 - 100)
+                    closure.shock(offsets, float(splitline[2]))
+                
+                else:
+                    raise ModelException(f"Error parsing shock line '{c.strip()}' in file {b}.")
+        
+        return closure.build()
+
+    def apply_shocks(self, closure, shocks):
+        '''
+        Shock variables in a closure. A variable that is not already exogenous is added to the
+        closure - as with an add line, it is up to the caller to keep the closure square. Only
+        the vector of shocks is copied, unless variables have to be added.
+
+        Parameters
+        ----------
+        closure: A closures.Closure, as read_closure returns
+        shocks: A dictionary of the variable, named as in a closure file, to the shock. The
+                elements can be left unquoted (see variable_offsets)
+
+        Returns
+        -------
+        The shocked closure.
+        '''
+        for spec, shockval in shocks.items():
+            var, offsets = self.variable_offsets(spec, f"shock {spec}", bareelements=True)
+            closure = closure.shocked(offsets, float(shockval), self.solvarhandler.ischange(var))
+        return closure
+
+    def read_closure_shocks(self):
+        '''
+        Read the closures for every step of the baseline and the policy, and apply the shocks
+        (from the yml or the scenario) to the policy closures
+        '''
+        self.baseclosures = [self.read_closure(b) for b in self.basefiles]
+        self.polclosures = [self.read_closure(p) for p in self.polfiles]
         
+        if self.shocks:
+            self.polclosures = [self.apply_shocks(closure, self.shocks) for closure in self.polclosures]
         
+        self.check_closures()
+
+    def check_closures(self):
+        '''
+        Check every closure that has been read against the structure of the system (see
+        structural_problems), so that a closure that cannot be solved fails before anything is.
+        Each distinct set of exogenous variables is only checked once.
+
+        Returns
+        -------
+        None.
+        '''
+        pattern = None
+        for simtype, files, closurelist in [("base", self.basefiles, self.baseclosures), ("policy", self.polfiles, self.polclosures)]:
+            for s, (closurefile, closure) in enumerate(zip(files, closurelist)):
+                key = hashlib.sha1(closure.exogenous.tobytes()).hexdigest()
+                if key not in self.closurestore.problems:
+                    if pattern is None:
+                        pattern = self.equation_manager.jacobian.pattern()
+                    self.closurestore.problems[key] = structural_problems(pattern, closure.exogenous, self.equation_manager.fullnames, self.solvarhandler.fullnames)
+                if self.closurestore.problems[key]:
+                    raise ModelException(f"Cannot solve step {s} of the {simtype} with the closure {closurefile}.\n{self.closurestore.problems[key]}")
+
+
+def compile_model(model_file="qgem.model", ymlfile="default.yml"):
+    '''
+    Parse, read the data for, and differentiate the model, and write it out as a compiled
+    artifact (in the compileddir from the yml, "compiled" by default). Model.setup, and so
+    run_model and the PolicyEngine, then load the artifact rather than repeating that work.
+
+    Returns
+    -------
+    The path of the artifact
+    '''
+    model = Model(ymlfile)
+    if not model.solve:
+        raise ModelException(f"Cannot compile a model that is not being solved ({ymlfile}).")
+    
+    if model.compileddir is None:
+        raise ModelException(f"Cannot compile the model - compileddir is empty in {ymlfile}.")
+    
+    # Always build from scratch, rather than picking up an existing artifact
+    model.setup(model_file, usecompiled=False)
+    
+    path = model.save_compiled(model_file)
+    print(f"Compiled model written to {path}")
+    return path
+
+
+def benchmark_parse(model_file="qgem.model", ymlfile="default.yml", scale=10, repeats=3):
+    '''
+    Time the front end of the parser over a model scale times the size of the model file: the
+    split of the model text into statements, and the parse of every equation, formula, update
+    and assertion into its tree.
+
+    Returns
+    -------
+    A dictionary of the best times (in seconds) over the repeats, for 'statements' and 'expressions'
+    '''
+    model = Model(ymlfile)
+    model.parse_model_file(model_file)
+    
+    with open(model_file, 'r') as file:
+        modellines = file.readlines()
+    
+    expressions = []
+    for manager in [model.formula_manager, model.equation_manager, model.update_manager, model.assert_manager]:
+        for name, node in manager.rootnodes.items():
+            expressions.append((node.equationstringorig, node.sets, node.indexes, name, node.statementline))
+    
+    times = {'statements': float('inf'), 'expressions': float('inf')}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        read_statements(modellines * scale, model_file)
+        times['statements'] = min(times['statements'], time.perf_counter() - start)
+        
+        start = time.perf_counter()
+        for _ in range(scale):
+            for text, sets, indexes, name, line in expressions:
+                statements.StatementNode(text, sets, indexes, name, line)
+        times['expressions'] = min(times['expressions'], time.perf_counter() - start)
+    
+    print(f"Parsing {scale} x {model_file} ({scale * len(modellines)} lines, {scale * len(expressions)} expressions):")
+    print(f"    splitting into statements {times['statements']:.3f}s")
+    print(f"    parsing expressions       {times['expressions']:.3f}s")
+    return times
+
+
+class PolicyEngine(object):
+    '''
+    PolicyEngine
+
+    Runs many policy scenarios against a single set up of the model. The model file is parsed,
+    the data read and the differentials taken once, when the engine is created. Each baseline
+    (identified by the contents of its closure files and its substeps) is solved once and kept
+    in memory, so running N scenarios that share a baseline costs N+1 simulations rather than
+    2N. A baseline that is a prefix of a cached one (fewer steps over the same closure files) is
+    sliced out of the cached one.
+
+    If a cache directory is given, baselines are also stored on disk (see basecache.py), keyed
+    by the contents of the model file, the input data and the base closure files, so that
+    another process can skip the baseline entirely.
+
+    Each scenario runs on its own copy of the model (see Model.policy_model) and nothing reads or
+    writes the current directory, so several scenarios can run at once on different threads.
+    Only solving a baseline holds a lock, so that each baseline is solved once.
+
+    '''
+    def __init__(self, model_file="orani.model", ymlfile="default.yml", cachedir=None, basedir=None):
+        '''
+        Parameters
+        ----------
+        model_file: The model file to parse
+        ymlfile: The model directive yml file. This provides the data files and the defaults
+                 for everything a scenario does not override
+        cachedir: Optional directory for the on disk baseline cache
+        basedir: The directory the model file, the yml file and the paths in it are relative to,
+                 by default the current directory
+        '''
+        self.basecache = basecache.BaseCache(cachedir) if cachedir is not None else None
+        
+        self.model = Model(ymlfile, basedir)
+        if not self.model.solve:
+            raise ModelException(f"Cannot run policy scenarios with a model that is not being solved ({ymlfile}).")
+        self.model_file = self.model.resolve(model_file)
+        self.model.setup(model_file)
+        
+        self.defaults = {"basefiles": self.model.basefiles,
+                         "polfiles": self.model.polfiles,
+                         "steps": self.model.steps,
+                         "substeps": self.model.substeps,
+                         "reportingvars": self.model.reportingvars,
+                         "longformat": self.model.longformat,
+                         "outputformat": self.model.outputformat,
+                         "outputdir": self.model.outputdir,
+                         "shocks": self.model.shocks}
+        
+        self.bases = {} # (substeps, tuple of the sha256 of each base file) -> the full HistoryStore of the baseline
+        self.lock = threading.Lock() # Held while looking up or solving a baseline
+
+    def base_id(self, model):
+        '''
+        Returns
+        -------
+        The key of the baseline of a scenario model in bases. The closure files are identified by
+        their contents (as the on disk cache does), so an edited closure file is a new baseline
+        '''
+        return (model.substeps, tuple(model.closurestore.file_hash(model.resolve(path)) for path in model.basefiles))
+
+    def get_base(self, baseid):
+        '''
+        Returns
+        -------
+        The cached history of the baseline, or None if it has not been run.
+        '''
+        if baseid in self.bases:
+            return self.bases[baseid]
         
-                    # Define the shape of the matrix
-                    shape = (len(model.equation_manager.fullnames) + len(closure), len(model.solvarhandler.fullnames))
-                    
-                    # Create a sparse matrix in COO format
-                    sparse_matrix = coo_matrix((data, (row_indices, col_indices)), shape=shape)
-                    
-                    # Convert the sparse matrix to CSR format
-                    csr_matrix = sparse_matrix.tocsr()
-                    
+        # A longer baseline over the same closures holds this one in its first steps
+        substeps, hashes = baseid
+        for (cachedsubsteps, cachedhashes), basehistory in self.bases.items():
+            if cachedsubsteps == substeps and cachedhashes[:len(hashes)] == hashes:
+                return basehistory.prefix(len(hashes))
+        return None
+
+    def scenario_model(self, config=None):
+        '''
+        Set up a copy of the model (see Model.policy_model) for a policy scenario, and read its
+        closures
+
+        Parameters
+        ----------
+        config: The scenario, as for run_policy
+
+        Returns
+        -------
+        The model, ready to run.
+        '''
+        if config is None:
+            config = {}
+        settings = {key: config.get(key, default) for key, default in self.defaults.items()}
+        
+        formaterror = writers.check_format(settings["outputformat"])
+        if formaterror is not None:
+            raise ModelException(f"Cannot run the policy: {formaterror}.")
+        
+        model = self.model.policy_model()
+        model.basefiles = settings["basefiles"][:settings["steps"]]
+        model.polfiles = settings["polfiles"][:settings["steps"]]
+        model.shocks = settings["shocks"]
+        model.steps = settings["steps"]
+        model.substeps = settings["substeps"]
+        model.reportingvars = settings["reportingvars"]
+        model.longformat = settings["longformat"]
+        model.outputformat = settings["outputformat"]
+        model.outputdir = model.resolve(settings["outputdir"])
+        
+        if len(model.basefiles) < model.steps or len(model.polfiles) < model.steps:
+            raise ModelException(f"Cannot run {model.steps} steps with {len(model.basefiles)} base and {len(model.polfiles)} policy closure files.")
+        
+        # Read in the closure and shock files, checking that they can be solved
+        model.read_closure_shocks()
         
-                    
-                    # Define labels and data
-                    rowlabels = model.equation_manager.fullnames + [model.solvarhandler.fullnames[i] for i in closure] 
-                    collabels = model.solvarhandler.fullnames
+        return model
 
+    def check_scenario(self, config=None):
+        '''
+        Check a policy scenario without running anything - that its settings are valid and its
+        closures, with the shocks applied, can be solved (see structural_problems). It takes
+        milliseconds once the closure files have been read.
 
-                    zero_row_indices = np.where(csr_matrix.getnnz(axis=1) == 0)[0]
-                    if len(zero_row_indices) > 0:
-                        print("Caught the following equations with no non-zero derivatives:")
-                        for i in zero_row_indices:
-                            print(f"   {model.rowlabels[i]}")
+        Parameters
+        ----------
+        config: The scenario, as for run_policy
+
+        Returns
+        -------
+        None. Raises a ModelException describing the first problem found.
+        '''
+        self.scenario_model(config)
+
+    def run_policy(self, config=None, callback=None):
+        '''
+        Run a policy scenario, solving the baseline first only if it is not already cached,
+        and write out the results (as run_model does)
+
+        Parameters
+        ----------
+        config: A dictionary in the format of the model directive yml file. Only basefiles,
+                polfiles, shocks, steps, substeps, reportingvars, longformat, outputformat and
+                outputdir are used - anything not given comes from the yml file the engine was
+                created with. Relative paths are relative to the engine's base directory
+        callback: If given, called with the StepResult of each step as it completes. The steps
+                  of the baseline are only reported when it has to be solved
+
+        Returns
+        -------
+        The model the scenario was run on, holding its histories.
+        '''
+        model = self.scenario_model(config)
+        os.makedirs(model.outputdir, exist_ok=True)
+        
+        policydone = False
+        with self.lock:
+            baseid = self.base_id(model)
+            base = self.get_base(baseid)
+            
+            if base is None and self.basecache is not None:
+                datafiles = [model.resolve(model.files[name]) for name in sorted(model.filedata)]
+                basefiles = [model.resolve(path) for path in model.basefiles]
+                key = basecache.base_key(self.model_file, datafiles, basefiles, model.steps, model.substeps)
+                base = self.basecache.load(key)
+                if base is not None:
+                    base = history.HistoryStore.from_arrays(*base)
+                    print("Loaded the baseline from the cache")
+                    self.bases[baseid] = base
+            
+            if base is None:
+                # Baselines are shared between scenarios with different closures and reporting vars,
+                # so they are always kept in full
+                model.reset()
+                if model.pipeline:
+                    # The policy runs alongside the baseline
+                    for result in model.run_pipelined(baseretention="full"):
+                        if callback is not None:
+                            callback(result)
+                    policydone = True
+                else:
+                    model.run_simulation("base", retention="full", callback=callback)
+                    model.archive_base()
+                self.bases[baseid] = model.basehistory
+                if self.basecache is not None:
+                    self.basecache.save(key, model.basehistory.svars, model.basehistory.dvars)
+            else:
+                print("Reusing the cached baseline")
+                model.basehistory = base
+                model.reset()
         
-                    zero_row_indices = np.where(csr_matrix.getnnz(axis=0) == 0)[0]
-                    if len(zero_row_indices) > 0:
-                        print("Caught the following equations with no non-zero derivatives:")
-                        for i in zero_row_indices:
-                            print(f"   {collabels[i]}")
+        if not policydone:
+            model.run_simulation("policy", callback=callback)
+        model.do_writes(long=model.longformat)
+        return model
 
 
-                    x = do_inversion(csr_matrix, b, rowlabels, doiterative=model.doiterative, docondense=False, solver=pardisosolver)
+# One engine per model file / yml file, shared by everything in the process
+_policy_engines = {}
+_policy_engines_lock = threading.Lock()
 
-                    # Solve the linear system Ax = b
-                    # with warnings.catch_warnings(record=True) as w:
-                    #     warnings.simplefilter("always")
+def get_policy_engine(model_file="orani.model", ymlfile="default.yml", cachedir=None, basedir=None):
+    '''
+    Returns
+    -------
+    The PolicyEngine for the model and yml file (relative to basedir, by default the current
+    directory), creating it (with the given baseline cache directory) on first use.
+    '''
+    basedir = os.path.abspath(basedir if basedir is not None else os.getcwd())
+    key = (os.path.join(basedir, model_file), os.path.join(basedir, ymlfile))
+    with _policy_engines_lock:
+        if key not in _policy_engines:
+            _policy_engines[key] = PolicyEngine(model_file, ymlfile, cachedir=cachedir, basedir=basedir)
+        return _policy_engines[key]
 
-                    #     if model.doiterative:
-                    #         print("iterative")
-                    #         x = pypardiso.spsolve(csr_matrix, b)
-                            
-                    #     else:
-                    #         print("not iterative")
-                    #         x = spsolve(csr_matrix, b)
 
-                    #     warningstring = ""
-                        
-                    #     if len(w) > 0:
-                    #         warningstring = "The following warnings were raised:\n"
-                    #         for warning in w:
-                    #             warningstring = warningstring + str(warning.message) + "\n"
-                            
-                    #         row_tuples = [tuple(csr_matrix.getrow(i).toarray()[0]) for i in range(csr_matrix.shape[0])]
-                    #         row_dict = {}
-                                
-                    #         for idx, row in enumerate(row_tuples):
-                    #             if row in row_dict:
-                    #                 row_dict[row].append(idx)  # Add index to the group of identical rows
-                    #             else:
-                    #                 row_dict[row] = [idx]  # Create a new group for this row
+def run_model(model_file="qgem.model", do_policy = True, callback=None, ymlfile="default.yml", basedir=None, outputdir=None):
+    '''
+    Run the model as directed by the yml file and write out the results
+
+    Parameters
+    ----------
+    model_file: The model file
+    callback: If given, called with the StepResult of each step of the baseline and then the
+              policy as it completes, so the trajectories can be followed before the writes
+    ymlfile: The model directive yml file
+    basedir: The directory the model file, the yml file and the paths in it are relative to, by
+             default the current directory
+    outputdir: Where to write the results, overriding the yml. Relative to basedir
+
+    Returns
+    -------
+    The model, holding the histories of the simulations
+    '''
     
-                    #         identical_groups = [indices for indices in row_dict.values() if len(indices) > 1]
+    # Instantiate the model
+    model = Model(ymlfile, basedir)
+    if outputdir is not None:
+        model.outputdir = model.resolve(outputdir)
     
-                    #         if identical_groups:
-                    #             warningstring = warningstring + "\nIn addition, the following identical rows were detected:\n"
-                                
-                    #             for i in identical_groups:
-                    #                 for j in i:
-                    #                     warningstring = warningstring + rowlabels[j] + " "
-                    #             warningstring = warningstring + "\n"
-            
-                    #         raise ModelException(f"Error inverting. {warningstring}")
-                    
-                    # Report the residual
-                    Ax = csr_matrix.dot(x)
-                    res = np.linalg.norm(Ax - b)
-                    print(f"Residual norm is {res}")
+    # Read model file, the data, and take the differentials
+    model.setup(model_file)
+
+    if model.solve == False:
+        # Do any start of sim only formulae. This is all we will do before skipping over to the writes
+        model.formula_manager.evaluate_all_formulae(model.datavarvals)
         
-                    model.solvarvals = list(x)
+        model.assert_manager.check_all(model.datavarvals)
+    else:
+        # Actually solve
         
-                    # Keep history of the svarvals       
-                    if len(model.allsvarvals) == s: # Triggered at the end of the first substep
-                        model.allsvarvals.append([])
-                    model.allsvarvals[s].append(list(x))
-                    
-                    # Do updates
-                    model.do_updates()
-                    model.assert_manager.check_all(model.datavarvals)
-                    
-            if simtype == "base":
-                # Archive the svars, dvars, reset the model
-                model.basedvarvals = copy.deepcopy(model.alldvarvals)
-                model.basesvarvals = copy.deepcopy(model.allsvarvals)
-                
-                model.alldvarvals = []
-                model.allsvarvals = []
-                
-                model.solvarvals = []
-                model.datavarvals = []
-                
-                model.read_datavars()
+        # Read in the closure and shock files
+        model.read_closure_shocks()
+        
+        # We are going to do 2 passes - a baseline and a policy run.
+        # At the end of the baseline we will archive the simluation results (ie, the svars and dvars)
+        # and then we will do the policy. The policy will draw on the archived baseline numbers
+        # to determine any shocks that need to be brought over for exogenous variables
+        # With pipeline set in the yml the policy runs alongside the baseline
+        for result in (model.run_pipelined() if model.pipeline else model.run_iter()):
+            if callback is not None:
+                callback(result)
             
             
     model.do_writes(long=model.longformat)
 
     # end of step. Evaluate the final formulae, and do the updates
 
+    return model
+
 
 
 
@@ -1457,6 +2274,13 @@ if __name__ == "__main__":
     # Set the custom exception handler
     sys.excepthook = custom_exception_handler    
 
+    # "python solver.py compile [model file]" writes the compiled artifact rather than running the model
+    # "python solver.py benchmark-parse [model file]" times the parser rather than running the model
+    docompile = len(sys.argv) > 1 and sys.argv[1] == "compile"
+    dobenchmark = len(sys.argv) > 1 and sys.argv[1] == "benchmark-parse"
+    if docompile or dobenchmark:
+        del sys.argv[1]
+
     if len(sys.argv) > 1:
         model_name = sys.argv[1]
         if not os.path.exists(model_name):
@@ -1473,7 +2297,12 @@ if __name__ == "__main__":
         else:
             model_name = None
 
-    if model_name is not None:
+    if model_name is not None and docompile:
+        print(f"Compiling model {model_name}")
+        compile_model(model_file = model_name)
+    elif model_name is not None and dobenchmark:
+        benchmark_parse(model_file = model_name)
+    elif model_name is not None:
         print(f"Running model {model_name}")
         run_model(model_file = model_name)
     else:
@@ -8,123 +8,532 @@ Contains classes and helper functions needed to implement equations and formulas
 
 import itertools
 import copy
-import math
 import re
 
+import numpy as np
+from scipy.sparse import csr_matrix
+from concurrent.futures import ProcessPoolExecutor
+
 #
 #  Helper functions
 #
 
 
-def mergeindexandsets(indexesa, indexesb, setsa, setsb):
+def index_tuples(sizes):
     '''
-    Merge two pairs of indexes and sets by determining which is the super and returning them
+    Build the full cartesian product of offsets over sets of the given sizes as a 2d
+    integer array. The ordering matches itertools.product, ie the rightmost set
+    ranges the fastest.
 
     Parameters
     ----------
-    indexesa : TYPE
-        DESCRIPTION.
-    indexesb : TYPE
-        DESCRIPTION.
-    setsa : TYPE
-        DESCRIPTION.
-    setsb : TYPE
-        DESCRIPTION.
+    sizes : list of ints
+        The sizes of the sets we are ranging over.
 
     Returns
     -------
-    None.
+    numpy array of shape (product of sizes, len(sizes))
+
+    '''
+    if len(sizes) == 0:
+        return np.zeros((1, 0), dtype=np.int64)
+    return np.indices(sizes, dtype=np.int64).reshape(len(sizes), -1).T
 
+def expand_tuples(indextuples, setsize):
     '''
+    Append a new rightmost column to a 2d array of index tuples, ranging over a set of
+    size setsize. Each existing row is repeated setsize times, matching the order
+    in which a sum expands its tuples.
+    '''
+    n = indextuples.shape[0]
+    expanded = np.repeat(indextuples, setsize, axis=0)
+    newcol = np.tile(np.arange(setsize, dtype=np.int64), n)
+    return np.column_stack([expanded, newcol])
+
+
+#
+#  Expression parser
+#
+#  Statement text is split into tokens in a single regex pass, and the tokens are then parsed
+#  by precedence climbing straight into a StatementNode tree. Operators, loosest binding first:
+#
+#      ==  !=  <  >  >=  <=    binary, giving a node with that operator and two branches
+#      +  -                    a chain, held as lists of operators and branches (a leading - is permitted)
+#      *  /                    a chain, held as lists of operators and branches
+#      ^                       binary, giving a '^' node with the base and exponent as branches
+#
+#  Everything else is either a parenthesised expression, a number, a variable (eg X_i_"dom")
+#  or a square bracket block - [sum: i=SET : ...], [if: lhs op rhs : ...] or [loge: ...].
+#
+
+TOKEN_REGEX = re.compile(r'''
+      (?P<space>\s+)
+    | (?P<op>==|!=|>=|<=|[-+*/^()\[\]:=<>])
+    | (?P<atom>[^\s\-+*/^()\[\]:=!<>]+)
+    | (?P<bad>.)
+    ''', re.VERBOSE | re.DOTALL)
 
-    if set(indexesa) <= set(indexesb):
-        superindex = indexesb
-        superset = setsb
-        subindex = indexesa
-        subset = setsa
-    elif set(indexesb) <= set(indexesa):
-        superindex = indexesa
-        superset = setsa
-        subindex = indexesb
-        subset = setsb
-    else:
-        raise ValueError("Error finding supremum set")
-
-    for i in subindex:
-        if i not in superindex:
-            raise ValueError("Error couldnt align indexes")
-
-        if subset[subindex.index(i)] != superset[superindex.index(i)]:
-            raise ValueError("Error indexes dont seem to align")
-
-    return superindex, superset
-
-def strip_outer_parenthesis(instr):
+COMPARISON_OPERATORS = ('==', '!=', '<', '>', '>=', '<=')
+
+# The binary operator levels, loosest first, and whether each level forms a chain
+OPERATOR_LEVELS = [(COMPARISON_OPERATORS, False),
+                   (('+', '-'), True),
+                   (('*', '/'), True),
+                   (('^',), False)]
+
+
+def tokenize(text):
     '''
-    Strip outer parenthesis from a string, as long as they are a single
-    set - eg, (a+b), not (a) + (b)
+    Split statement text into tokens
 
     Parameters
     ----------
-    instr : String
-        The string to strip.
+    text : String
+        The statement text.
 
     Returns
     -------
-    String: the stripped string
+    A list of (kind, value, start, end) tuples, where kind is 'op' or 'atom' and start and end
+    are the offsets of the token in the text. The list is terminated by an 'end' token.
 
     '''
-    outstr = instr.strip()
-    if (outstr[0] == "(") and (outstr[-1] == ")"):
-        parlvl = 0
-        hitzero = False
-        for i in outstr[0:-1]:
-            if i == "(":
-                parlvl = parlvl + 1
-            elif i == ")":
-                parlvl = parlvl - 1
-            if parlvl == 0:
-                hitzero = True
-        if hitzero == False:
-            outstr = instr[1:-1].strip()
-    return outstr
-
-def test_square_block(instr):
+    tokens = []
+    for match in TOKEN_REGEX.finditer(text):
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        if kind == 'bad':
+            raise ValueError(f"Error - unexpected character '{match.group()}' at position {match.start()} in {text}.")
+        tokens.append((kind, match.group(), match.start(), match.end()))
+    tokens.append(('end', '', len(text), len(text)))
+    return tokens
+
+
+class ExpressionParser(object):
     '''
-    Check to see if a string is wholely contained in a single level
-    of square brackets
+    Precedence climbing parser from statement text to a StatementNode tree. Each node holds
+    the text it was parsed from as its equationstringorig.
+    '''
+    def __init__(self, text, statementname = 'None', statementline = 0):
+        self.text = text
+        self.statementname = statementname
+        self.statementline = statementline
+        try:
+            self.tokens = tokenize(text)
+        except ValueError as e:
+            raise type(e)(str(e) + f" - Parsing statement name {statementname} on line {statementline}.")
+        self.position = 0
+
+    def parse(self, sets, indexes):
+        '''
+        Parse the whole of the text
+
+        Parameters
+        ----------
+        sets: The sets over which the statement is defined
+        indexes: The indexes representing each set
+
+        Returns
+        -------
+        The root StatementNode
+        '''
+        if self.tokens[0][0] == 'end':
+            raise self._error("empty expression")
+        node = self._expression(0, sets, indexes)
+        if self.tokens[self.position][0] != 'end':
+            raise self._error(f"unexpected '{self.tokens[self.position][1]}'")
+        return node
+
+    def _error(self, message):
+        offset = self.tokens[self.position][2]
+        return ValueError(f"Error - {message} at position {offset} in {self.text.strip()}, line {self.statementline}.")
+
+    def _peek(self):
+        # The current operator, or None if the current token is not an operator
+        kind, value, start, end = self.tokens[self.position]
+        return value if kind == 'op' else None
+
+    def _take(self):
+        token = self.tokens[self.position]
+        self.position = self.position + 1
+        return token
+
+    def _expect(self, op):
+        if self._peek() != op:
+            found = self.tokens[self.position][1] or "end of statement"
+            raise self._error(f"expected '{op}' but found '{found}'")
+        return self._take()
+
+    def _atom(self):
+        kind, value, start, end = self.tokens[self.position]
+        if kind != 'atom':
+            raise self._error(f"expected a name but found '{value or 'end of statement'}'")
+        self.position = self.position + 1
+        return value
+
+    def _node(self, start, sets, indexes):
+        # A new node covering the text from start to the end of the last token consumed
+        end = self.tokens[self.position - 1][3]
+        return StatementNode(self.text[start:end], sets, indexes, self.statementname, self.statementline, parse=False)
+
+    def _expression(self, level, sets, indexes):
+        if level == len(OPERATOR_LEVELS):
+            return self._primary(sets, indexes)
+
+        operators, chain = OPERATOR_LEVELS[level]
+        start = self.tokens[self.position][2]
+
+        # The first element of a chain carries an implicit + or *, unless it is negated
+        firstop = operators[0]
+        if chain and firstop == '+' and self._peek() == '-':
+            self._take()
+            firstop = '-'
+
+        ops = [firstop]
+        branches = [self._expression(level + 1, sets, indexes)]
+        while self._peek() in operators:
+            ops.append(self._take()[1])
+            branches.append(self._expression(level + 1, sets, indexes))
+
+        if len(branches) == 1 and firstop != '-':
+            return branches[0]
+
+        node = self._node(start, sets, indexes)
+        if chain:
+            node.operator = ops
+        else:
+            if len(branches) != 2:
+                raise ValueError(f"Error - unexpected number of splits after finding {ops[1]} as highest level operator in {node.equationstringorig}, line {self.statementline}.")
+            node.operator = ops[1]
+        node.branches = branches
+        return node
+
+    def _primary(self, sets, indexes):
+        kind, value, start, end = self.tokens[self.position]
+
+        if kind == 'atom':
+            self.position = self.position + 1
+            node = self._node(start, sets, indexes)
+            try:
+                node.value = float(value)
+                node.operator = "num"
+            except ValueError:
+                # We need to split this at the potential underscores
+                # Note that the indexes could also be explicit representations of elements in sets
+                # ie, "household", but that gets picked up at evaluation time
+                splitstr = value.split("_")
+                node.var = splitstr[0]
+                node.myindexes = splitstr[1:]
+                node.operator = "var"
+            return node
+
+        if value == '(':
+            self._take()
+            node = self._expression(0, sets, indexes)
+            self._expect(')')
+            return node
+
+        if value == '[':
+            return self._block(sets, indexes)
+
+        raise self._error(f"unexpected '{value or 'end of statement'}'")
+
+    def _block(self, sets, indexes):
+        start = self._take()[2]
+        keyword = self.tokens[self.position][1].lower() if self.tokens[self.position][0] == 'atom' else None
+
+        if keyword == "sum":
+            # The branch is parsed with the sets and indexes augmented by the index and set of the sum
+            # At evaluation time each instance of the daughter node has a modified indextuple passed
+            # to it, for each instance of the index
+            self._take()
+            self._expect(':')
+            indexandset = [self._atom()]
+            self._expect('=')
+            indexandset.append(self._atom())
+            self._expect(':')
+            branch = self._expression(0, sets + [indexandset[1]], indexes + [indexandset[0]])
+            self._expect(']')
+            node = self._node(start, sets, indexes)
+            node.operator = "sum"
+            node.indexandset = indexandset
+            node.branch = branch
+
+        elif keyword == "if":
+            # [if: lhs op rhs : branch], where branch is only evaluated where the condition holds
+            self._take()
+            self._expect(':')
+            condlhs = self._expression(1, sets, indexes)
+            if self._peek() not in COMPARISON_OPERATORS:
+                raise self._error("expected a comparison in the condition")
+            condop = self._take()[1]
+            condrhs = self._expression(1, sets, indexes)
+            self._expect(':')
+            branch = self._expression(0, sets, indexes)
+            self._expect(']')
+            node = self._node(start, sets, indexes)
+            node.operator = "if"
+            node.condlhs = condlhs
+            node.condop = condop
+            node.condrhs = condrhs
+            node.branch = branch
+
+        elif keyword == "loge":
+            self._take()
+            self._expect(':')
+            branch = self._expression(0, sets, indexes)
+            self._expect(']')
+            node = self._node(start, sets, indexes)
+            node.operator = "loge"
+            node.branch = branch
+
+        else:
+            # Skip over the rest of the block, it is reported when we try to use it
+            depth = 1
+            while depth > 0:
+                value = self._peek()
+                if self.tokens[self.position][0] == 'end':
+                    raise self._error("unterminated '['")
+                if value == '[':
+                    depth = depth + 1
+                elif value == ']':
+                    depth = depth - 1
+                self._take()
+            node = self._node(start, sets, indexes)
+            node.operator = "unhandled"
+
+        return node
+
+
+#
+#  Compiled kernels
+#
+#  A StatementNode tree can be compiled against a fixed set of index tuples into a tree of
+#  kernels. All of the set/index bookkeeping (ie the offsets into the dvar and svar vectors)
+#  is done once at compile time, so evaluating a kernel is just a sequence of numpy gathers
+#  and ufuncs over the whole index space.
+#
+#  Kernels return either a scalar (for constants) or an array aligned to the index tuples
+#  they were compiled against.
+#
+
+_comparisons = {'==': np.equal,
+                '!=': np.not_equal,
+                '<': np.less,
+                '>': np.greater,
+                '<=': np.less_equal,
+                '>=': np.greater_equal}
+
+class ConstKernel(object):
+    def __init__(self, value):
+        self.value = float(value)
+
+    def __call__(self, dvarvals, svarvals):
+        return self.value
+
+class GatherKernel(object):
+    def __init__(self, idx, issvar):
+        self.idx = idx
+        self.issvar = issvar
+
+    def __call__(self, dvarvals, svarvals):
+        if self.issvar:
+            return svarvals[self.idx]
+        return dvarvals[self.idx]
+
+class ArithKernel(object):
+    def __init__(self, operators, branches):
+        self.operators = operators
+        self.branches = branches
+
+    def __call__(self, dvarvals, svarvals):
+        vals = 0.0 if self.operators[0] in "+-" else 1.0
+        for op, branch in zip(self.operators, self.branches):
+            y = branch(dvarvals, svarvals)
+            if op == "+":
+                vals = vals + y
+            elif op == "-":
+                vals = vals - y
+            elif op == "*":
+                vals = vals * y
+            else:
+                vals = vals / y
+        return vals
+
+class SumKernel(object):
+    def __init__(self, branch, n, setsize):
+        self.branch = branch
+        self.n = n
+        self.setsize = setsize
+
+    def __call__(self, dvarvals, svarvals):
+        vals = self.branch(dvarvals, svarvals)
+        if np.ndim(vals) == 0:
+            return vals * self.setsize
+        return vals.reshape(self.n, self.setsize).sum(axis=1)
+
+class IfKernel(object):
+    def __init__(self, condlhs, condop, condrhs, branch, fillval):
+        self.condlhs = condlhs
+        self.condop = condop
+        self.condrhs = condrhs
+        self.branch = branch
+        self.fillval = fillval
+
+    def __call__(self, dvarvals, svarvals):
+        mask = _comparisons[self.condop](self.condlhs(dvarvals, svarvals), self.condrhs(dvarvals, svarvals))
+        # The branch is evaluated everywhere and then masked, so anything that would fail
+        # outside the condition (eg a divide by zero being guarded against) is ignored
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            vals = self.branch(dvarvals, svarvals)
+        return np.where(mask, vals, self.fillval)
+
+class CompareKernel(object):
+    def __init__(self, operator, lhs, rhs):
+        self.operator = operator
+        self.lhs = lhs
+        self.rhs = rhs
+
+    def __call__(self, dvarvals, svarvals):
+        return _comparisons[self.operator](self.lhs(dvarvals, svarvals), self.rhs(dvarvals, svarvals))
+
+class LogKernel(object):
+    def __init__(self, branch):
+        self.branch = branch
+
+    def __call__(self, dvarvals, svarvals):
+        return np.log(self.branch(dvarvals, svarvals))
+
+class PowKernel(object):
+    def __init__(self, base, exponent):
+        self.base = base
+        self.exponent = exponent
+
+    def __call__(self, dvarvals, svarvals):
+        return np.power(self.base(dvarvals, svarvals), self.exponent(dvarvals, svarvals))
+
+
+
+
+#
+#  Derivative terms
+#
+#  Differentiating an equation gives its derivative as a sum of terms, each of the form
+#
+#      sum over the term's sum indexes of: (coefficient) * svar(svar indexes), where the conditions hold
+#
+#  The coefficient is a tree with no svars in it. Everything is still over the symbolic indexes
+#  of the equation (plus the sum indexes), so a single set of terms covers every row of the
+#  equation. The terms are tied to rows and columns by expand_terms.
+#
+
+class DiffTerm(object):
+    def __init__(self, svar, svarindexes, coefficient):
+        self.svar = svar # Name of the svar, or None for the part that doesn't depend on the svars
+        self.svarindexes = svarindexes # The indexes (or quoted elements) of the svar, as they appear in the equation
+        self.coefficient = coefficient # StatementNode
+        self.sums = [] # [index, set] pairs, outermost first
+        self.conditions = [] # [lhs StatementNode, operator, rhs StatementNode] triples that must all hold
+
+def _number(value):
+    node = StatementNode(None, [], [], parse=False)
+    node.operator = "num"
+    node.value = value
+    return node
+
+def _negate(node):
+    if node.operator == "num":
+        return _number(-node.value)
+    negated = StatementNode(None, node.sets, node.indexes, statementname = node.statementname, statementline = node.statementline, parse=False)
+    negated.operator = ["-"]
+    negated.branches = [node]
+    return negated
+
+def _product(operators, factors, parent):
+    # Multiplying through by 1 can be dropped
+    keep = [[op, factor] for op, factor in zip(operators, factors) if not (factor.operator == "num" and factor.value == 1)]
+    if len(keep) == 0:
+        return _number(1.0)
+    elif len(keep) == 1 and keep[0][0] == "*":
+        return keep[0][1]
+    product = StatementNode(None, parent.sets, parent.indexes, statementname = parent.statementname, statementline = parent.statementline, parse=False)
+    product.operator = [op for op, factor in keep]
+    product.branches = [factor for op, factor in keep]
+    return product
+
+def expand_terms(terms, svarhandler, dvarhandler, sets, indexes, indextuples, rows, dvarvals):
+    '''
+    Tie the derivative terms of an equation to concrete rows and columns of the jacobian
 
     Parameters
     ----------
-    instr : String
-        The string to test.
+    terms: The DiffTerms of the equation
+    sets, indexes: The sets and indexes the equation is defined over
+    indextuples: 2d integer array of the index tuples of the rows of the equation
+    rows: Array of the row (in the jacobian) of each of the index tuples
+    dvarvals: The dvar values the conditions are evaluated against
 
     Returns
     -------
-    Bool - true if it is a wholely contained square bracket block.
+    A list of blocks [coefficient, sets, indexes, tuples, rows, cols]. Each row of tuples (over
+    sets/indexes, which include any sum indexes of the term) gives an entry of the jacobian
+    at (rows, cols) with the value of the coefficient.
 
     '''
+    dvarvals = np.asarray(dvarvals, dtype=float)
+    blocks = []
+    for term in terms:
+        if term.svar is None:
+            continue
+
+        termsets = list(sets)
+        termindexes = list(indexes)
+        termtuples = np.asarray(indextuples, dtype=np.int64)
+        termrows = np.asarray(rows, dtype=np.int64)
+
+        for index, theset in term.sums:
+            if index in termindexes:
+                raise ValueError(f"Error - the index {index} is used more than once in a term of {term.coefficient.statementname} on line {term.coefficient.statementline}")
+            setsize = dvarhandler.setmanager.get_size(theset)
+            termsets.append(theset)
+            termindexes.append(index)
+            termtuples = expand_tuples(termtuples, setsize)
+            termrows = np.repeat(termrows, setsize)
+
+        # The conditions are fixed at the data we have now
+        if term.conditions:
+            mask = np.ones(termtuples.shape[0], dtype=bool)
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                for lhs, op, rhs in term.conditions:
+                    lhsvals = lhs.compile(dvarhandler, None, termsets, termindexes, termtuples)(dvarvals, None)
+                    rhsvals = rhs.compile(dvarhandler, None, termsets, termindexes, termtuples)(dvarvals, None)
+                    mask = mask & _comparisons[op](lhsvals, rhsvals)
+            termtuples = termtuples[mask]
+            termrows = termrows[mask]
+            if termtuples.shape[0] == 0:
+                continue
+
+        # Each of the svar's indexes is either one of the indexes we are ranging over, or an explicit element
+        sets_to_fetch = []
+        columns = []
+        for offset, i in enumerate(term.svarindexes):
+            if i[0] == '"':
+                theset = svarhandler.sets[term.svar][offset]
+                sets_to_fetch.append(theset)
+                columns.append(np.full(termtuples.shape[0], svarhandler.setmanager.cge_sets[theset].get_idx(i[1:-1]), dtype=np.int64))
+            else:
+                position = termindexes.index(i)
+                sets_to_fetch.append(termsets[position])
+                columns.append(termtuples[:, position])
 
-    outbool = False
-
-    outstr = instr.strip()
-
-    if (outstr[0] == "[") and (outstr[-1] == "]"):
-        parlvl = 0
-        hitzero = False
-        for i in outstr[0:-1]:
-            if i == "[":
-                parlvl = parlvl + 1
-            elif i == "]":
-                parlvl = parlvl - 1
-            if parlvl == 0:
-                hitzero = True
-        if hitzero == False:
-            outbool = True
-
-    return outbool
+        if len(columns) > 0:
+            termcols = svarhandler.get_index_array(term.svar, sets_to_fetch, np.column_stack(columns))
+        else:
+            termcols = svarhandler.get_index_array(term.svar, None, np.zeros((termtuples.shape[0], 0), dtype=np.int64))
 
+        blocks.append([term.coefficient, termsets, termindexes, termtuples, termrows, termcols])
 
+    return blocks
 
 
 #
@@ -165,1151 +574,269 @@ class StatementNode(object):
             raise ValueError(f"Unhandled operator {self.operator} in StatementNode.__repr__")
         return retval
 
-    def __mul__(self, other):
-
-
-        indexes, sets = mergeindexandsets(self.indexes, other.indexes, self.sets, other.sets)
-
-        if isinstance(other, StatementNode):
-            if self.operator == "num" and other.operator == "num":
-                # both numbers, just do the arithmetic
-                retval = StatementNode(self.value * other.value, sets, indexes, statementname = self.statementname, statementline = self.statementline)
-            elif (self.operator == 'num' and self.value == 0) or (other.operator == 'num' and other.value == 0):
-                # we're multiplying zeros
-                retval = StatementNode(0.0, sets, indexes, statementname = self.statementname, statementline = self.statementline)
-            elif (self.operator == 'num' and self.value == 1):
-                # we're multiplying by 1
-                retval = copy.deepcopy(other)
-            elif (other.operator == 'num' and other.value == 1):
-                # we're multiplying by 1
-                retval = copy.deepcopy(self)
-            elif isinstance(self.operator, list) and \
-                isinstance(other.operator, list) and \
-                self.operator[0] in '*/' and \
-                other.operator[0] in '*/':
-                # check if both sides are */
-
-                retval = StatementNode(None, sets, indexes, parse=False)
-                branchestemp = copy.deepcopy(self.branches) + copy.deepcopy(other.branches)
-                operatortemp = copy.deepcopy(self.operator) + copy.deepcopy(other.operator)
-
-                # Sweep through - if we are multiplying by a 1 we can ditch it
-                retval.branches = []
-                retval.operator = []
-                for b,o in zip(branchestemp, operatortemp):
-                    if not (b.operator == 'num' and b.value == 1):
-                        retval.branches.append(b)
-                        retval.operator.append(o)
-
-
-            else:
-                retval = StatementNode(None, sets, indexes, parse=False)
-                retval.operator = ["*","*"]
-                retval.branches = [copy.deepcopy(self), copy.deepcopy(other)]
-
-            return retval
-        else:
-            raise TypeError("Unsupported operand type for *: 'StatementNode' and '{}'".format(type(other)))
-
-    def __truediv__(self, other):
-
-        indexes, sets = mergeindexandsets(self.indexes, other.indexes, self.sets, other.sets)
-
-        if isinstance(other, StatementNode):
-            retval = StatementNode(None, sets, indexes, parse=False)
-            retval.operator = ["*","/"]
-            retval.branches = [copy.deepcopy(self), copy.deepcopy(other)]
-            return retval
-        else:
-            raise TypeError("Unsupported operand type for /: 'StatementNode' and '{}'".format(type(other)))
-
-    def __add__(self, other):
-
-        indexes, sets = mergeindexandsets(self.indexes, other.indexes, self.sets, other.sets)
-
-        if isinstance(other, StatementNode):
-            if self.operator == "num" and other.operator == "num":
-                # both numbers, just do the arithmetic
-                retval = StatementNode(self.value + other.value, sets, indexes, statementname = self.statementname, statementline = self.statementline)
-
-            elif isinstance(self.operator, list) and \
-                isinstance(other.operator, list) and \
-                self.operator[0] in '+-' and \
-                other.operator[0] in '+-':
-                # check if both sides are +-
-
-                retval = StatementNode(None, sets, indexes, parse=False, statementname = self.statementname, statementline = self.statementline)
-                branchestemp = copy.deepcopy(self.branches) + copy.deepcopy(other.branches)
-                operatortemp = copy.deepcopy(self.operator) + copy.deepcopy(other.operator)
-
-                # Sweep through - if we are adding or subtracting a 0 we can ditch it
-                retval.branches = []
-                retval.operator = []
-                for b,o in zip(branchestemp, operatortemp):
-                    if not (b.operator == 'num' and b.value == 0):
-                        retval.branches.append(b)
-                        retval.operator.append(o)
-
-            elif isinstance(self.operator, list) and \
-                self.operator[0] in '+-' and \
-                (other.operator == 'num' or other.operator == 'var') :
-
-                retval = copy.deepcopy(self)
-                retval.sets = sets
-                retval.indexes = indexes
-                retval.operator.append('+')
-                retval.branches.append(copy.deepcopy(other))
-
-            elif isinstance(other.operator, list) and \
-                other.operator[0] in '+-' and \
-                (self.operator == 'num' or self.operator == 'var') :
-
-                retval = copy.deepcopy(other)
-
-                retval.sets = sets
-                retval.indexes = indexes
-
-                retval.branches = [copy.deepcopy(self)] + retval.branches
-                retval.operator = ['+'] + retval.operator
-
-
-            else:
-                retval = StatementNode(None, sets, indexes, parse=False, statementname = self.statementname, statementline = self.statementline)
-                retval.operator = ["+","+"]
-                retval.branches = [copy.deepcopy(self), copy.deepcopy(other)]
-
-            return retval
-        else:
-            raise TypeError("Unsupported operand type for -: 'StatementNode' and '{}'".format(type(other)))
-
-    def __sub__(self, other):
-
-        indexes, sets = mergeindexandsets(self.indexes, other.indexes, self.sets, other.sets)
-
-        if isinstance(other, StatementNode):
-            if self.operator == "num" and other.operator == "num":
-                # both numbers, just do the arithmetic
-                retval = StatementNode(self.value - other.value, sets, indexes, statementname = self.statementname, statementline = self.statementline)
-
-            elif isinstance(self.operator, list) and \
-                isinstance(other.operator, list) and \
-                self.operator[0] in '+-' and \
-                other.operator[0] in '+-':
-                # check if both sides are +-
-
-                retval = StatementNode(None, sets, indexes, parse=False)
-                branchestemp = copy.deepcopy(self.branches) + copy.deepcopy(other.branches)
-                operatortemp = copy.deepcopy(self.operator)
-                for i in other.operator:
-                    if i == '+':
-                        operatortemp.append('-')
-                    else:
-                        operatortemp.append('+')
-
-                # Sweep through - if we are adding or subtracting a 0 we can ditch it
-                retval.branches = []
-                retval.operator = []
-                for b,o in zip(branchestemp, operatortemp):
-                    if not (b.operator == 'num' and b.value == 0):
-                        retval.branches.append(b)
-                        retval.operator.append(o)
-
-            elif isinstance(self.operator, list) and \
-                self.operator[0] in '+-' and \
-                (other.operator == 'num' or other.operator == 'var') :
-
-                retval = copy.deepcopy(self)
-                retval.sets = sets
-                retval.indexes = indexes
-                retval.operator.append('-')
-                retval.branches.append(copy.deepcopy(other))
-
-            elif isinstance(other.operator, list) and \
-                other.operator[0] in '+-' and \
-                (self.operator == 'num' or self.operator == 'var') :
-
-                retval = copy.deepcopy(other)
-                operatortemp = []
-                for i in retval.operator:
-                    if i == '+':
-                        operatortemp.append('-')
-                    else:
-                        operatortemp.append('+')
-                retval.operator = operatortemp
-
-                retval.branches = [copy.deepcopy(self)] + retval.branches
-                retval.operator = ['+'] + retval.operator
-                retval.sets = sets
-                retval.indexes = indexes
-
-
-            else:
-                retval = StatementNode(None, sets, indexes, parse=False)
-                retval.operator = ["+","-"]
-                retval.branches = [copy.deepcopy(self), copy.deepcopy(other)]
-
-            return retval
-        else:
-            raise TypeError("Unsupported operand type for -: 'StatementNode' and '{}'".format(type(other)))
-
-
-
-
     def _parse(self):
 
-
-        # A number could either be passed as a number, or it could be a string representing a number
-        # Try converting so we can just test it
-        eqnstr = self.equationstringorig
-
-        if isinstance(self.equationstringorig, str):
-            eqnstr = self.equationstringorig.strip()
-
-            eqnstr = eqnstr.replace(":"," : ")
-            eqnstr = eqnstr.replace("+"," + ")
-            eqnstr = eqnstr.replace("-"," - ")
-            eqnstr = eqnstr.replace("/"," / ")
-            eqnstr = eqnstr.replace("*"," * ")
-            eqnstr = eqnstr.replace("^", " ^ ")
-            eqnstr = eqnstr.replace("("," ( ")
-            eqnstr = eqnstr.replace(")"," ) ")
-            eqnstr = eqnstr.replace("=="," == ")
-            eqnstr = eqnstr.replace("!="," != ")
-            eqnstr = eqnstr.replace(">"," > ")
-            eqnstr = eqnstr.replace("<"," < ")
-            eqnstr = eqnstr.replace("> =",">=")
-            eqnstr = eqnstr.replace("< =","<=")
-            eqnstr = eqnstr.replace(">="," >= ")
-            eqnstr = eqnstr.replace("<="," <= ")
-
-            oldeqnstr = eqnstr
-            while True:
-                eqnstr = oldeqnstr.replace("  "," ")
-                if eqnstr == oldeqnstr:
-                    break
-                oldeqnstr = eqnstr
-
-            # see if we are wholely enclosed by parenthesis. This stripping should be done repeatedly
-            # eg to handle (())
-            oldeqnstr = eqnstr
-            while True:
-                eqnstr = strip_outer_parenthesis(oldeqnstr)
-
-                if eqnstr == oldeqnstr:
-                    break
-                oldeqnstr = eqnstr
-
-        try:
-            float(eqnstr)
-            numtype = True
-        except:
-            numtype = False
-
-        # check to see if there are any operators in the remaining expression - we may
-        # be down to simply a variable
-        # Note that from above, every operator should have a space either side.
-        if numtype or (" " not in eqnstr):
-            # This could still be a variable or a number. If its a number we want
-            # to evaluate it as a numeric type, otherwise hold onto it as a string
-            if numtype:
-                self.value = float(eqnstr)
-                self.operator = "num"
-            else:
-                # We need to split this at the potential underscores
-                # Note that the indexes could also be explicit representations of elements in sets
-                # ie, "household", but that gets picked up at evaluation time
-                splitstr = eqnstr.split("_")
-                self.var = splitstr[0]
-                self.myindexes = splitstr[1:]
-                self.operator = "var"
+        # A number could either be passed as a number, or it could be a string to be parsed
+        if not isinstance(self.equationstringorig, str):
+            self.value = float(self.equationstringorig)
+            self.operator = "num"
             return
 
-        if test_square_block(eqnstr):
-            # We are in a square bracket block
-            # There is the potential for different types
-            eqnparts = eqnstr[1:-1].strip().split(":", maxsplit=2)
-            if eqnparts[0].strip().lower() == "sum":
-                self.operator = "sum"
-                # for a sum the nodes are simply a pair of an index and a set, combined with the actual internal node
-                # at parse time we simply augment the sets and indices that get passed to the
-                # daughter node with the new index and set
-                # At evaluation time each instance of the daughter node will have a modified
-                # indextuple passed to it, for each instance of the index
-                self.indexandset = eqnparts[1].replace(" ","").split("=") # left is a pair of an index, and a set
-                self.branch = StatementNode(eqnparts[2].strip(), self.sets + [self.indexandset[1]], self.indexes + [self.indexandset[0]], self.statementname, self.statementline)
-            elif eqnparts[0].strip().lower() == "if":
-                self.operator = "if"
-                # TODO if documentation
-                condition = eqnparts[1].strip().split(maxsplit=3)
-                # TODO CHECK THE CONDITION IS GOOD
-                self.condlhs = StatementNode(condition[0], self.sets, self.indexes, self.statementname, self.statementline)
-                self.condrhs = StatementNode(condition[2], self.sets, self.indexes, self.statementname, self.statementline)
-                self.condop = condition[1]
-                self.branch = StatementNode(eqnparts[2].strip(), self.sets, self.indexes, self.statementname, self.statementline)
-            elif eqnparts[0].strip().lower() == "loge":
-                self.operator = "loge"
-                # TODO loge documentation
-                self.branch = StatementNode(eqnparts[1].strip(), self.sets, self.indexes, self.statementname, self.statementline)
-            else:
-                self.operator = "unhandled"
-            return
-
-        # You can definately do this with a regex - but this is easier to follow
-        # iterate from left to right, finding the highest ranked operator
-        
-        # The point of the logic below is to find the operator with the highest level
-        # of precidence - ie, we do * before +, etc etc
-        
-        highestlevel = 0
-
-        pardepth = 0
-        levels = []
-
-
-        highestlevel = 0
-        for i in range(len(eqnstr)):
-            # classify the current character. we only care if the depth is zero, ie
-            # we arent inside a parenthesis block (noting that we've already stripped
-            # outer parenthesis above)
-            testchar = eqnstr[i]
-            if   testchar in "([":
-                pardepth = pardepth + 1
-            elif testchar in ")]":
-                pardepth = pardepth - 1
-
-            currentlvl = 0
-            if pardepth == 0:
-                if testchar in '+-':
-                    currentlvl = 10
-                elif testchar in '*/':
-                    currentlvl = 9
-                elif testchar in '^':
-                    currentlvl = 8
-                    
-                # Check for operators that will return a bool
-                # These may be more than a character long, so there's a bit of logic to
-                # see if we've already matched a comparison operator, eg to stop us from
-                # first matching '<>' then matching '>'
-                
-                # We don't want to catch anything that isn't at pardepth > 0 (ie, in an 'if' or similar)
-                # remember the 
-                
-                if testchar in ['=','<','>','!']:
-                    if highestlevel != 11: # this makes sure we don't match a second '=' as noted above
-                        teststr = testchar
-                        if (i < (len(eqnstr) - 1)) and eqnstr[i+1] == '=':
-                            teststr = teststr + '='
-                        if teststr in ['==','!=','<','>','>=','<=']:
-                            currentlvl = 11
-                            conditional = teststr
-            
-
-            if (currentlvl > highestlevel) and (pardepth == 0):
-                highestlevel = currentlvl
-            levels.append(currentlvl)
-
-
-        # now we know the highest level of operator, and a vector of the positions
-        # lets bust the equation string into the substrings that will be our
-        # daughters and the operators that are applied
-        splitpositions = []
-        for i in range(len(levels)):
-            if levels[i] == highestlevel:
-                splitpositions.append(i)
-        splitpositions.append(len(levels))
-
-
-        # Highest level of 8 (ie, '^') should always split in 2
-        if highestlevel == 8:
-            if len(splitpositions) != 2:
-                raise ValueError(f"Error - unexpected number of splits after finding ^ as highest level operator in {eqnstr}, line {self.statementline}.")
-            num = eqnstr[0:splitpositions[0]]
-            exp = eqnstr[splitpositions[0]+1:]
-            self.branches = [StatementNode(num, self.sets, self.indexes, self.statementname, self.statementline), \
-                             StatementNode(exp, self.sets, self.indexes, self.statementname, self.statementline)]
-            self.operator = '^'
-
-        # These are the conditionals
-        elif highestlevel == 11:
-            if len(splitpositions) != 2:
-                raise ValueError(f"Error - unexpected number of splits after finding conditional as highest level operator in {eqnstr}, line {self.statementline}.")
-
-            lhs = eqnstr[:splitpositions[0]]
-            rhs = eqnstr[splitpositions[0]+len(conditional):]
-            self.branches = [StatementNode(lhs, self.sets, self.indexes, self.statementname, self.statementline), \
-                             StatementNode(rhs, self.sets, self.indexes, self.statementname, self.statementline)]
-            self.operator = conditional
+        tree = ExpressionParser(self.equationstringorig, self.statementname, self.statementline).parse(self.sets, self.indexes)
 
-        else:
+        # Take on the parsed root, keeping hold of the full text we were given
+        equationstringorig = self.equationstringorig
+        self.__dict__.update(tree.__dict__)
+        self.equationstringorig = equationstringorig
 
-            # The remaining possible operators have arbitrary number of branches, so operator is now a list
-            self.branches = []
-            self.operator = []
-    
-            # The first split position can be a special case
-            # if we found a split at 0, then it is a '-'
-            # If it's not, thats unexpected
-            firstneg = False
-            if splitpositions[0] == 0:
-                if highestlevel != 10:
-                    raise ValueError(f"Error - unexpected operator {eqnstr[0]} found at the start of {eqnstr}, line {self.statementline}.")
-                if eqnstr[0] == '-':
-                    firstneg = True
-                    splitpositions = splitpositions[1:]
-                else:
-                    raise ValueError(f"Error - unexpected operator {eqnstr[0]} found at the start of {eqnstr}, line {self.statementline}.")
-    
-            for i in range(len(splitpositions)):
-                # The highest level tells us something about what we are about to decompose
-                # If its 10, we are dealing with addition and subtraction.
-                # If its 9, multiplication and division
-    
-                # The first element carries an implicit + or *, depending on what we are doing
-                if i == 0:
-                    start = 0
-                    if firstneg:
-                        operator = '-'
-                        start = 1
-                    elif highestlevel == 10:
-                        operator = '+'
-                    else:
-                        operator = '*'
-                else:
-                    start = splitpositions[i-1] + 1
-                    operator = eqnstr[splitpositions[i-1]]
-                end = splitpositions[i]
-    
-                spliteqn = eqnstr[start:end]
-    
-                self.branches.append(StatementNode(spliteqn, self.sets, self.indexes, self.statementname, self.statementline))
-                self.operator.append(operator)
 
-
-    def clean(self):
+    def varnames(self):
         '''
-        Member to do a filter through and collapse unnecessary structures
-
         Returns
         -------
-        None.
+        A set of the names of all the variables referenced in the tree below (and including) this node.
 
         '''
-        # Check to see if we have multiple 'num' vars in an arithmetic branch, which may then be collapsed
-
-        if isinstance(self.operator, list):
-            # Check if we have multiple nums
-            numcount = 0
-
-            for i in self.branches:
-                if i.operator == 'num':
-                    numcount = numcount + 1
-
-            if numcount > 0:
-                # There are nodes we can collapse
-                if self.operator[0] in "+-":
-                    collapsed = 0
-                else:
-                    collapsed = 1
-
-            # easier if we count backwards from the end
-            for i in range(len(self.branches)-1, -1, -1):
-                if self.branches[i] == 'num':
-                    if self.operators[i] == '+':
-                        collapsed = collapsed + self.branches.value
-                    elif self.operators[i] == '-':
-                        collapsed = collapsed + self.branches.value
-                    elif self.operators[i] == '*':
-                        collapsed = collapsed * self.branches.value
-                    elif self.operators[i] == '/':
-                        collapsed = collapsed / self.branches.value
-                self.branches = self.branches[0:i] + self.branches[i+1:]
-
+        if self.operator == "var":
+            return {self.var}
+        elif self.operator == "if":
+            return self.condlhs.varnames() | self.condrhs.varnames() | self.branch.varnames()
+        elif self.operator in ["sum", "loge"]:
+            return self.branch.varnames()
+        elif self.operator == "num" or self.operator == "unhandled":
+            return set()
+        else:
+            return set().union(*[b.varnames() for b in self.branches])
 
+    def structure_key(self):
+        '''
+        Returns
+        -------
+        A hashable description of the tree below (and including) this node. Two trees with
+        the same key evaluate identically when given the same sets, indexes and tuples.
 
+        '''
+        if self.operator == "var":
+            return ("var", self.var, tuple(self.myindexes))
+        elif self.operator == "num":
+            return ("num", self.value)
+        elif self.operator == "if":
+            return ("if", self.condop, self.condlhs.structure_key(), self.condrhs.structure_key(), self.branch.structure_key())
+        elif self.operator == "sum":
+            return ("sum", tuple(self.indexandset), self.branch.structure_key())
+        elif self.operator == "loge":
+            return ("loge", self.branch.structure_key())
+        elif self.operator == "unhandled":
+            return ("unhandled", self.equationstringorig)
+        elif isinstance(self.operator, list):
+            return (tuple(self.operator), tuple(b.structure_key() for b in self.branches))
+        else:
+            return (self.operator, tuple(b.structure_key() for b in self.branches))
 
-    def evaluate(self, dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = None, fillval = None):
+    def compile(self, dvarhandler, svarhandler, sets, indexes, indextuples, fillval = None):
         '''
+        Compile the tree below this node into a tree of kernels that evaluate the node
+        over a fixed set of index tuples. This does the same job as evaluate, except that all
+        the offsets are resolved once, here, and evaluation becomes array operations.
+
         Parameters
         ----------
-        dvarhandler : TYPE
-            DESCRIPTION.
-
-        sets: A list of the sets over which the formula is defined
+        sets: A list of the sets over which the node is defined
         indexes: A list of the indexes that are used to represent each set
-        indextuples: A list of tuples describing the ordering within the sets in which the formula is applied
-
+        indextuples: 2d integer array (one row per tuple) of offsets into the sets
+        fillval: The value taken where a conditional is false. As with evaluate,
+                 this is the identity of the parent operator.
 
         Returns
         -------
-        A list of the values evaluated, aligned to the ordering of indextuples.
+        A callable kernel, kernel(dvarvals, svarvals), returning a scalar or an array aligned to indextuples.
 
         '''
-        if evalvec is not None:
-            if isinstance(evalvec, list):
-                if len(evalvec) != len(indextuples):
-                    raise ValueError(f"Unexpected length for evalvec, got {len(evalvec)}, expecting {len(indextuples)}.")
-            else:
-                raise ValueError(f"Expecting list type for evalvec, got {type(evalvec)}")
-
+        indextuples = np.asarray(indextuples, dtype=np.int64)
+        if indextuples.ndim != 2:
+            indextuples = indextuples.reshape(len(indextuples), len(indexes))
 
         try:
             if self.operator == "unhandled":
                 raise ValueError("Unhandled operator encountered")
             elif self.operator == "num":
-                # this needs to be returned as a list of values the same length
-                # as expected by the parent
-                if evalvec is None:
-                    return [self.value] * len(indextuples)
-                else:
-                    retval = [fillval] * len(indextuples)
-                    for i in range(len(indextuples)):
-                        if evalvec[i]:
-                            retval[i] = self.value
-                    return retval
+                return ConstKernel(self.value)
 
             elif self.operator == "var":
-                # this is where we evaluate the variables
-                # we have:
-                #   self.var - the name of the datavar
-                #   self.myindexes - the indexes over which the datavar is ranging (eg X_i_j)
-                #   sets - the potential sets over which we might range
-                #   indexes - the indexes represnting these sets, which should cover self.myindexes
-                #   indextuples - the tuples that describe the order in which the indexes range
-                #
-                #   We need to merge these as follows (for example)
-                #
-                #   self.var is X, self.myindexes is [i,j], representing X_i_j
-                #   sets is [J,K,I]
-                #   indexes is [j,k,i]
-                #   tuples is [[0,0,0], [1,2,3], [4,5,6]]
-                #
-                #   we need to get indexes for X 0 0, X 3 1, X 6 4
-                #
-                # Finally - an index could have a leading " (and we would expect it to end in ")
-                # which is an explicit set element. In that case we need to look up the element
-                # in the set over which the var is defined, find the offset, and then augment the
-                # tuples that have been passed to suit
-                #
-
-                # TODO - we also permit formulae where the
-
-
-                # We will start by handling explicit elements
-                for offset, i in enumerate(self.myindexes):
-                    if i[0] == '"':
-                        if i[-1] != '"':
-                            raise ValueError(f"Error: Expecting closing quote in index {i} for variable {self.var} on {self.statementline}.")
-
-                        # Get the corresponding set and look up the index
-                        theset = dvarhandler.sets[self.var][offset]
-                        theoff = dvarhandler.setmanager.cge_sets.elements[theset].index(i[1:-1]) # need to strip off the quotes at either end
-
-                        # append the set and the offsets
-
-                        indexes = indexes + [i]
-                        sets = sets + [theset]
-                        indextuples = [tup + [theoff] for tup in indextuples]
-
-                # Figure out which sets are aligned to each of the indexes I'm defined over
-
-                indexes_of_sets = [indexes.index(idx) for idx in self.myindexes]
-                sets_to_fetch = [sets[i] for i in indexes_of_sets]
-
-                # TODO - this could be slow
-                tuples_reordered = []
-                for tup in indextuples:
-                    tuples_reordered.append([tup[i] for i in indexes_of_sets])
-
-                # We could be looking up either a dvar or an svar, depending on if we are doing
-                # a classic formula or perhaps an update
-
-                isdvar = False
-
                 if self.var in dvarhandler:
-                    isdvar = True
-                else:
-                    isdvar = False
-
-                if (svarhandler is not None) and (self.var in svarhandler):
-                    issvar = True
-                else:
+                    handler = dvarhandler
                     issvar = False
-
-                if isdvar:
-                    idxlist = dvarhandler.get_index_list(self.var, sets_to_fetch, tuples_reordered)
-                elif issvar:
-                    idxlist = svarhandler.get_index_list(self.var, sets_to_fetch, tuples_reordered)
+                elif (svarhandler is not None) and (self.var in svarhandler):
+                    handler = svarhandler
+                    issvar = True
                 else:
                     raise ValueError(f"Could not find the variable {self.var} as either a Datavar nor a Solvar")
 
-
-                if evalvec is None:
-                    if isdvar:
-                        return [dvarvals[i] for i in idxlist]
+                # Each of my indexes is either one of the indexes we are ranging over, or an explicit
+                # element (in quotes) of the set that the variable is defined over at that position
+                sets_to_fetch = []
+                columns = []
+                for offset, i in enumerate(self.myindexes):
+                    if i[0] == '"':
+                        if i[-1] != '"':
+                            raise ValueError(f"Error: Expecting closing quote in index {i} for variable {self.var} on {self.statementline}.")
+                        theset = handler.sets[self.var][offset]
+                        theoff = handler.setmanager.cge_sets[theset].get_idx(i[1:-1])
+                        sets_to_fetch.append(theset)
+                        columns.append(np.full(indextuples.shape[0], theoff, dtype=np.int64))
                     else:
-                        return [svarvals[i] for i in idxlist]
-                else:
-                    retval = [fillval] * len(indextuples)
-                    for i in range(len(indextuples)):
-                        if evalvec[i]:
-                            if isdvar:
-                                retval[i] = dvarvals[idxlist[i]]
-                            else:
-                                retval[i] = svarvals[idxlist[i]]
-                    return retval
-
-
+                        position = indexes.index(i)
+                        sets_to_fetch.append(sets[position])
+                        columns.append(indextuples[:, position])
 
+                if len(columns) > 0:
+                    instances = np.column_stack(columns)
+                    idx = handler.get_index_array(self.var, sets_to_fetch, instances)
+                else:
+                    idx = handler.get_index_array(self.var, None, np.zeros((indextuples.shape[0], 0), dtype=np.int64))
+                return GatherKernel(idx, issvar)
 
             elif self.operator == "sum":
-                # The index and set that we are taking the sum over is contained as a 2 element list in the left node
-                thisindex = self.indexandset[0]
-                thisset = self.indexandset[1]
+                thisindex, thisset = self.indexandset
                 thissetlen = dvarhandler.setmanager.get_size(thisset)
-
-                if evalvec is None:
-                    retval = [0] * len(indextuples)
-
-                    for i in range(thissetlen):
-                        newtuples = [tuple(list(sublist) + [i]) for sublist in indextuples]
-                        retval = [x+y for x,y in zip(retval, self.branch.evaluate(dvarhandler, svarhandler, sets + [thisset], indexes + [thisindex], newtuples, dvarvals, svarvals, fillval = 0))]
-                    return retval
-
-                else:
-                    raise ValueError("Sums in ifs not currently handled")
+                branch = self.branch.compile(dvarhandler, svarhandler, sets + [thisset], indexes + [thisindex],
+                                             expand_tuples(indextuples, thissetlen), fillval = 0)
+                return SumKernel(branch, indextuples.shape[0], thissetlen)
 
             elif self.operator == "if":
-
-
-                # first, we need to evaluate the self.condlhs, self.condrhs and apply self.condop
-                lhs = self.condlhs.evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals)
-                rhs = self.condrhs.evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals)
-
-                # now build a vector of true and false depending on the self.condop
-                truefalse = []
-                for l, r in zip(lhs,rhs):
-                    append = False
-                    if self.condop == "==":
-                        if l == r:
-                            append = True
-                    elif self.condop == "!=":
-                        if l != r:
-                            append = True
-                    elif self.condop == "<":
-                        if l < r:
-                            append = True
-                    elif self.condop == ">":
-                        if l > r:
-                            append = True
-                    elif self.condop == "<=":
-                        if l <= r:
-                            append = True
-                    elif self.condop == ">=":
-                        if l >= r:
-                            append = True
-                    truefalse.append(append)
-
-                retval = self.branch.evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = truefalse, fillval=fillval)
-
-                return retval
+                condlhs = self.condlhs.compile(dvarhandler, svarhandler, sets, indexes, indextuples)
+                condrhs = self.condrhs.compile(dvarhandler, svarhandler, sets, indexes, indextuples)
+                branch = self.branch.compile(dvarhandler, svarhandler, sets, indexes, indextuples, fillval = fillval)
+                return IfKernel(condlhs, self.condop, condrhs, branch, np.nan if fillval is None else fillval)
 
             elif self.operator == "loge":
-
-
-                retval = [math.log(i) for i in self.branch.evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval=fillval)]
-
-                return retval
-
+                return LogKernel(self.branch.compile(dvarhandler, svarhandler, sets, indexes, indextuples, fillval = fillval))
 
             elif self.operator == "^":
-
-                if evalvec is None:
-                    return [x ** y for x,y in zip (self.left.evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals),  self.right.evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals))]
-                else:
-                    retval = [fillval] * len(indextuples)
-                    x = self.left.evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval = 1)
-                    y = self.right.evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval = 1)
-                    for i in range(len(evalvec)):
-                        if evalvec[i]:
-                            retval[i] = x[i] ** y[i]
+                return PowKernel(self.branches[0].compile(dvarhandler, svarhandler, sets, indexes, indextuples, fillval = 1),
+                                 self.branches[1].compile(dvarhandler, svarhandler, sets, indexes, indextuples, fillval = 1))
 
             elif self.operator in ['==','!=','<','>','>=','<=']:
-
-                if evalvec is None:
-                    if self.operator == '==':
-                        return [x == y for x,y in zip (self.branches[0].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals),  self.branches[1].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals))]
-                    elif self.operator == '!=':
-                        return [x != y for x,y in zip (self.branches[0].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals),  self.branches[1].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals))]
-                    elif self.operator == '<':
-                        return [x < y for x,y in zip (self.branches[0].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals),  self.branches[1].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals))]
-                    elif self.operator == '>':
-                        return [x > y for x,y in zip (self.branches[0].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals),  self.branches[1].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals))]
-                    elif self.operator == '>=':
-                        return [x >= y for x,y in zip (self.branches[0].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals),  self.branches[1].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals))]
-                    else: # <=
-                        return [x <= y for x,y in zip (self.branches[0].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals),  self.branches[1].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals))]
-                else:
-                    retval = [fillval] * len(indextuples)
-                    x = self.branches[0].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval = 1)
-                    y = self.branches[1].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval = 1)
-                    for i in range(len(evalvec)):
-                        if evalvec[i]:
-
-                            if self.operator == '==':
-                                retval[i] = (x[i] == y[i])
-                            elif self.operator == '!=':
-                                retval[i] = (x[i] != y[i])
-                            elif self.operator == '<':
-                                retval[i] = (x[i] < y[i])
-                            elif self.operator == '>':
-                                retval[i] = (x[i] > y[i])
-                            elif self.operator == '>=':
-                                retval[i] = (x[i] >= y[i])
-                            else: # <=
-                                retval[i] = (x[i] <= y[i])
+                return CompareKernel(self.operator,
+                                     self.branches[0].compile(dvarhandler, svarhandler, sets, indexes, indextuples, fillval = 1),
+                                     self.branches[1].compile(dvarhandler, svarhandler, sets, indexes, indextuples, fillval = 1))
 
             elif isinstance(self.operator, list):
+                branches = []
+                for op, branch in zip(self.operator, self.branches):
+                    branchfill = 0 if op in "+-" else 1
+                    branches.append(branch.compile(dvarhandler, svarhandler, sets, indexes, indextuples, fillval = branchfill))
+                return ArithKernel(list(self.operator), branches)
 
-                if self.operator[0] in "+-":
-                    initval = 0
-                else:
-                    initval = 1
-
-                if evalvec is None:
-                    vals = [initval] * len(indextuples)
-                else:
-                    vals = [fillval] * len(indextuples)
-                    for i in range(len(evalvec)):
-                        if evalvec[i]:
-                            vals[i] = initval
-
-                for i in range(len(self.operator)):
-                    if self.operator[i] == "+":
-                        if evalvec is None:
-                            vals = [x + y for x,y in zip (vals, self.branches[i].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, fillval = 0))]
-                        else:
-                            y = self.branches[i].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval = 0)
-                            for i in range(len(evalvec)):
-                                if evalvec[i]:
-                                    vals[i] = vals[i] + y[i]
-
-                    elif self.operator[i] == "-":
-                        if evalvec is None:
-                            vals = [x - y for x,y in zip (vals, self.branches[i].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, fillval = 0))]
-                        else:
-                            y = self.branches[i].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval = 0)
-                            for i in range(len(evalvec)):
-                                if evalvec[i]:
-                                    vals[i] = vals[i] - y[i]
-
-                    elif self.operator[i] == "*":
-                        if evalvec is None:
-                            vals = [x * y for x,y in zip (vals, self.branches[i].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, fillval = 1))]
-                        else:
-                            y = self.branches[i].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval = 1)
-                            for i in range(len(evalvec)):
-                                if evalvec[i]:
-                                    vals[i] = vals[i] * y[i]
-
-                    elif self.operator[i] == "/":
-                        if evalvec is None:
-                            vals = [x / y for x,y in zip (vals, self.branches[i].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, fillval = 1))]
-                        else:
-                            y = self.branches[i].evaluate(dvarhandler, svarhandler, sets, indexes, indextuples, dvarvals, svarvals, evalvec = evalvec, fillval = 1)
-                            for i in range(len(evalvec)):
-                                if evalvec[i]:
-                                    vals[i] = vals[i] / y[i]
-
-                return vals
             else:
                 raise ValueError(f"Unknown operator: {self.operator}")
         except Exception as e:
-            raise type(e)(str(e) + f" - Evaluating statement name {self.statementname} on line {self.statementline}. {self}\n")
-
-
-
-    def differentiate(self, svarmanager, dvarmanager, setsin, indexesin, indextuplesin, dvarvals, deep = 0):
-
-        # For either a + or a - we merge the two lists, looking for collisions in svar
-        # offsets (and fail if we find them)
-
-        # For a * we have to merge the lists, using the branch that has an svar as the
-        # guide
-
-        # For a sum we have to use the new index/set to expand the indexes and sets
-        # and build new trees
-
-        # The structure returned from this is a list of 2-element lists
-        # Element 1     - the svar that this differential relates to
-        # Element 2     - a list of statementnode structures
-        #   Element 2.1 - a list of the sets that the node is defined over
-        #   Element 2.2 - the indexes tied to those sets
-        #   Element 2.3 - the tuple (in index order) that the statement node is defined over
-        #   Element 2.4 - the statement node that is the root of this part of the differential
-
-        # The final differential for each svar is the sum of element 2
-
-        sets = copy.deepcopy(setsin)
-        indexes = copy.deepcopy(indexesin)
-        indextuples = copy.deepcopy(indextuplesin)
-
-        # basic arithmetic will have an operator variable that is a list
-        if isinstance(self.operator, list):
-            if self.operator[0] in '+-':
-                diffedbranches = []
+            raise type(e)(str(e) + f" - Compiling statement name {self.statementname} on line {self.statementline}. {self}\n")
 
-                # Take the derivative of each branch
-                for i in self.branches:
-                    tempdiff = i.differentiate(svarmanager, dvarmanager, sets, indexes, indextuples, dvarvals, deep = deep + 1)
-                    diffedbranches.append(tempdiff)
 
 
-                # If this branch is subtracted, replace it with 0 - branch
-                for i in range(len(diffedbranches)): # TODO THIS IS CLUNKY - IS IT THOUGH????? A: Yeah, it is
-                    if self.operator[i] == "-":
-                        temp = []
-                        for j in diffedbranches[i]:
-                            twigs = []
-                            for k in j[1]:
-                                # Here we are building out all the potential set/index/tuple twigs
-                                twigs.append([k[0], k[1], k[2], StatementNode(0, k[0], k[1]) - k[3]])
-                            temp.append([ j[0], twigs ])
-
-                        diffedbranches[i] = temp
-
-
-                # TODO REDUNDANT
-                retdifflist = []
-                for i in diffedbranches:
-                    retdifflist = retdifflist + i
-
-
-
-            elif self.operator[0] in '*/':
-                # Rules for the multiplicative operators
-                # - There can be only one branch with svars - we arent implementing the product rule
-                # - The division operator may only be applied to dvars - we aren't implementing the quotient rule
-
-                # Differentiate each branch
-                diffedbranches = []
-                for i in self.branches:
-                    tempdiff = i.differentiate(svarmanager, dvarmanager, sets, indexes, indextuples, dvarvals, deep = deep + 1)
-                    diffedbranches.append(tempdiff)
-
-                # Here we need to take the cartesian product of the twigs
-                # This will need each branch to be broken down into a list of twigs
-
-                twiglists = []
-                for i in diffedbranches:
-                    twiglists.append([]) # Start a new empty set for this branch
-                    # Each branch could contain data pertaining to a range of svars, dvars. Want to break them into individual parts.
-                    for j in i: # IE - for everything that is differentiated by an svar
-                        for k in j[1]: # IE, for every list that gives a S/I/T combination
-                            twiglists[-1].append([j[0], [k]])
-
-                cart = list(itertools.product(*twiglists))
-
-                # A real benefit of this approach is that now we can guarantee that every element
-                # of the product has only a single S/I/T twig per branch we are multiplying
-
-                retdifflist = []
-                for i in cart:
+    def differentiate(self, svarmanager, dvarmanager):
+        '''
+        Symbolically differentiate the tree below this node with respect to the solution
+        variables. This is done once over the symbolic indexes - it is only when the terms are
+        expanded (see expand_terms) that they are tied to particular rows and columns.
 
-                    # check theres only one svar per product combination, and get the offset
-                    # Also double check that we arent doing the quotient nor product rule anywhere
+        The tree has to be linear in the svars: a product can have only one branch with svars
+        in it (we aren't implementing the product rule), and we can only divide by
+        branches with no svars (nor the quotient rule).
 
-                    svarcount = 0
-                    newnode = StatementNode(1.0, self.sets, self.indexes)
+        Returns
+        -------
+        A list of DiffTerms. The terms with an svar of None are the part of the tree that
+        doesn't depend on any svar, which is only needed further up the tree.
 
-                    # have to keep track of the supremum sets and index
-                    finalsets = []
-                    finalindexes = []
-                    finaltuple = []
+        '''
+        # A branch with no svars, and no conditionals (which are fixed at the initial data, so
+        # have to be pulled out into the terms), is just a constant that we keep as it is
+        if not self._has_svar_or_if(svarmanager):
+            return [DiffTerm(None, None, self)]
 
-                    for j in range(len(i)):
-                        if self.operator[j] == "*":
-                            newnode = newnode * i[j][1][0][3] # 1 - the S/I/T lists, 0 because it is guaranteed to only have a single element, 3 is the node
-                        else:
-                            if i[j][0] is None: # ie, we will only divide by a dvar or number, not an svar
-                                newnode = newnode / i[j][1][0][3]
-                            else:
+        try:
+            if isinstance(self.operator, list):
+                if self.operator[0] in '+-':
+                    retterms = []
+                    for op, branch in zip(self.operator, self.branches):
+                        for term in branch.differentiate(svarmanager, dvarmanager):
+                            if op == '-':
+                                term.coefficient = _negate(term.coefficient)
+                            retterms.append(term)
+
+                elif self.operator[0] in '*/':
+                    # Each combination of a term from each branch gives a term of the product
+                    branchterms = [branch.differentiate(svarmanager, dvarmanager) for branch in self.branches]
+
+                    retterms = []
+                    for combination in itertools.product(*branchterms):
+                        svarterms = [term for term in combination if term.svar is not None]
+                        if len(svarterms) > 1:
+                            raise ValueError(f"Error - encountered product rule while differentiating statement {self.statementname} on line {self.statementline}")
+
+                        operators = []
+                        factors = []
+                        for op, term in zip(self.operator, combination):
+                            if op == '/' and term.svar is not None:
                                 raise ValueError(f"Error - encountered quotient rule while differentiating statement {self.statementname} on line {self.statementline}")
+                            operators.append(op)
+                            factors.append(term.coefficient)
 
-                        if i[j][0] is not None:
-                            svarcount = svarcount + 1
-                            svaroffset = j
-
-                        tempindexes, tempsets = mergeindexandsets(finalindexes, i[j][1][0][1], finalsets, i[j][1][0][0])
-                        if tempindexes != finalindexes:
-                            finalindexes = tempindexes
-                            finalsets = tempsets
-                            if len(finaltuple) < len(i[j][1][0][2]):
-                                finaltuple = i[j][1][0][2]
-
-                    if svarcount > 1:
-                        raise ValueError(f"Error - encountered product rule while differentiating statement {self.statementname} on line {self.statementline}")
-                    elif svarcount == 1:
-                        svar = i[svaroffset][0]
-                    else:
-                        svar = None
-
-                    retdifflist = retdifflist + [ [svar, [[finalsets, finalindexes, finaltuple, newnode ]]] ]
-
-
-            else:
-                raise ValueError(f"Unexpected leading operator {self.operator[0]} differentiating {self.equationstringorig} on line {self.statementline}.")
-
-        elif self.operator == 'if':
+                        newterm = DiffTerm(svarterms[0].svar if svarterms else None,
+                                           svarterms[0].svarindexes if svarterms else None,
+                                           _product(operators, factors, self))
+                        for term in combination:
+                            newterm.sums = newterm.sums + term.sums
+                            newterm.conditions = newterm.conditions + term.conditions
+                        retterms.append(newterm)
 
-            # Need to evaluate the condition, and if it is true we return the differential of the branch
-            # otherwise return zero
-
-            # first, we need to evaluate the self.condlhs, self.condrhs and apply self.condop
-            lhs = self.condlhs.evaluate(dvarmanager, None, sets, indexes, indextuples, dvarvals, None)
-            rhs = self.condrhs.evaluate(dvarmanager, None, sets, indexes, indextuples, dvarvals, None)
-
-            # now build a vector of true and false depending on the self.condop
-            truefalse = []
-            for l, r in zip(lhs,rhs):
-                append = False
-                if self.condop == "==":
-                    if l == r:
-                        append = True
-                elif self.condop == "!=":
-                    if l != r:
-                        append = True
-                elif self.condop == "<":
-                    if l < r:
-                        append = True
-                elif self.condop == ">":
-                    if l > r:
-                        append = True
-                elif self.condop == "<=":
-                    if l <= r:
-                        append = True
-                elif self.condop == ">=":
-                    if l >= r:
-                        append = True
-                else:
-                    raise ValueError(f"Error - encountered unknown operator {self.condop}")
-                truefalse.append(append)
-
-            retdifflist = []
-            for tf, idx in zip(truefalse, indextuples):
-                if tf:
-                    retdifflist = retdifflist + self.branch.differentiate(svarmanager,
-                                                                          dvarmanager,
-                                                                          sets,
-                                                                          indexes,
-                                                                          [idx], dvarvals,
-                                                                          deep = deep + 1)
                 else:
-                    retdifflist = retdifflist + [[None, [[sets, indexes, idx, StatementNode(0, sets, indexes)]]]]
-
-
-        elif self.operator == 'sum':
-
-            # When we encounter a sum we need to expand out the sets, indexes, and index tuples, and then
-            # differentiate the branch underneath with respect to each of the index tuples
-            newindex = self.indexandset[0]
-            newset = self.indexandset[1]
-
-            newsetsize = svarmanager.setmanager.get_size(newset)
-
-            newtuples = []
-            for i in indextuples:
-                for j in range(newsetsize):
-                    newtuples.append(i + [j])
-
-            retdifflist = []
-            for i in newtuples:
-                diffedbranches = self.branch.differentiate(svarmanager,
-                                                            dvarmanager,
-                                                            sets + [newset],
-                                                            indexes + [newindex],
-                                                            [i], dvarvals,
-                                                            deep = deep + 1)
-
-                retdifflist = retdifflist + diffedbranches
-
-        elif self.operator == 'num':
-            # This is the simplest of the cases - we simply return the number as a (new) statementnode
-            retdifflist = [[None, [[sets, indexes, i, StatementNode(self.value, sets, indexes)]]] for i in indextuples]
-
-        elif self.operator == 'var':
-            # In the case of a var we need to get the solution variable offsets that relate to this var, in the order
-            # that they occur given the sets and indexes that we have neen passed.
-
-            # We also need to know if its a solution variable or a data variable
-
-            # Step 1 - figure out which sets are aligned to each of the indexes I'm defined over
-            # note also - we could have explicit elements which won't correspond to an index.
-
-            # To handle explicit elements we will alter the indexes and tuples, inserting a dummy
-            # index and a fixed new element in the tuples - ie:
-            # variable A_r_s, r=REG, s=REG
-            # incoming index is r over REG, tuple [0]
-            # Equation has A_r_"aus"
-            # We'll modifyt the incoming index and tuple and create a shadow copy that look like
-            # r,s, tuple [0,0]
-            # note! We will have to first find what the second set is for A (ie, the s) and also
-            # look up the explicit element in that set.
-            # Finally, what is returned is in reference to the original indexes and tuples, not the
-            # shadow copies
-
-            issvar = False
-            isdvar = False
-            if self.var in svarmanager.names:
-                issvar = True
-                definedsets = svarmanager.sets[self.var]
-            elif self.var in dvarmanager.names:
-                isdvar = True
-                definedsets = dvarmanager.sets[self.var]
-            else:
-                raise ValueError(f"Error - cannot find {self.var} as either a solution nor a data variable")
-
-            # Get some new dummy indexes to use in place of the explicit element. Ensure we done have a collision with an existing index.
-#            dummys = ['a', 'b','c','d','e','f','g','h','i','j','k','l','m']
-#            filtereddummys = [item for item in dummys if item not in indexes]
-
-
-            shadowindexes = indexes
-            shadowsets = sets
-            shadowtuples = indextuples
-            # sweep through and find anything in quotes, add index, set, tuple element as required
-
-            # I don't want to modify the parent
-            indextuples = copy.deepcopy(indextuples)
-
-
-            try:
-
-                indexes_of_sets = []
-                for num, idx in enumerate(self.myindexes):
-                    # We are going to use the type to differentiate purpose
-                    # if indexes_of_sets
-                    if idx[0] != '"':
-                        indexes_of_sets.append(indexes.index(idx)) # this will be an int
-                    else:
-                        indexes_of_sets.append(definedsets[num]) # this will be a string
+                    raise ValueError(f"Unexpected leading operator {self.operator[0]}")
 
+            elif self.operator == 'if':
+                # The condition is evaluated once, against the data at the time the terms are
+                # expanded. Where it is false the branch contributes nothing.
+                retterms = self.branch.differentiate(svarmanager, dvarmanager)
+                for term in retterms:
+                    term.conditions = [[self.condlhs, self.condop, self.condrhs]] + term.conditions
 
-                sets_to_fetch = []
-                for i in indexes_of_sets:
-                    if isinstance(i, str):
-                        sets_to_fetch.append(i)
-                    else:
-                        sets_to_fetch.append(sets[i])
-
-#                indexes_of_sets = [shadowindexes.index(idx) for idx in self.myindexes]
-                #sets_to_fetch = [shadowsets[i] for i in indexes_of_sets]
-
-
-
-            except:
-                raise ValueError(f"Error aligning sets and indexes when trying to take differential for statement {self.equationstringorig} on line {self.statementline}. Got indexes of {self.myindexes}.")
+            elif self.operator == 'sum':
+                # Each term picks up the sum - when expanded it is repeated for each element of the set
+                retterms = self.branch.differentiate(svarmanager, dvarmanager)
+                for term in retterms:
+                    term.sums = [self.indexandset] + term.sums
 
-            # TODO - this could be slow
-            tuples_reordered = []
-            for tup in indextuples:
-                tuples_reordered.append([])
-                for num, i in enumerate(indexes_of_sets):
-                    if isinstance(i, str):
-                        tuples_reordered[-1].append(dvarmanager.setmanager.cge_sets[sets_to_fetch[num]].get_idx(self.myindexes[num][1:-1]))
-                    else:
-                        tuples_reordered[-1].append(tup[i])
-
-            if issvar:
-
-                # When returning an svar, the lists returned are:
-                # - the svar offset
-                # - the sets over which we are defined
-                # - the index tuple that this pertains to
-                # - the root of the tree
-                #
-                # NOTE - The index and sets in elements 1 and 2 of each of the lists below are the index and sets for the
-                #        node, not for the svar! That is, if the equation being evaluated is over i=I, j=J, but the
-                #        indexes are swapped for this leave (eg, x_j_i) then this is handled through perturbation of
-                #        the index list
-                #
-                indexlist = svarmanager.get_index_list(self.var, sets_to_fetch, tuples_reordered)
-                indexlisttuple = zip(indexlist, indextuples) # This is where the perterbation happens - its the indexes from the reordered tuples
-                                                         # against the original indexes for the node
-                retdifflist = [[i[0], [[sets, indexes, i[1], StatementNode(1, sets, indexes)]]] for i in indexlisttuple]
+            elif self.operator == 'var':
+                # Only svars get here (anything else is a constant)
+                retterms = [DiffTerm(self.var, self.myindexes, _number(1.0))]
 
             else:
-                # When returning a dvar, the lists returned are:
-                # - None - this signals there is no svar
-                # - the sets over which we are defined
-                # - the index tuple that this pertains to
-                # - the root of the tree
-                #
-                # NOTE - Again we need to perterb this - this is achieved by passing the reordered tuples into element 2
-                #        of the lists
-                #
-
-                # Also - we need to dummy back in the replaced indexes, ie, we can't go using equationstringorig
-                eqnstr = self.var
-                for i in indexes_of_sets:
-                    eqnstr = eqnstr + "_" + self.indexes[i]
-
-                retdifflist = [[None, [[sets, indexes, i, StatementNode(eqnstr, sets, indexes)]]] for i in indextuples]
-
-        elif self.operator == 'loge':
-            # We only permit logs of dvars, not svars - ie, they are constants
-            retdifflist = [[None, [[sets, indexes, i, StatementNode(self.equationstringorig, sets, indexes)]]] for i in indextuples]
-
-        else:
-            raise ValueError(f"Unexpected operator {self.operator} differentiating {self.equationstringorig} on line {self.statementline}.")
-
-        # Now, sweep through the returned value and merge anything where there is the same svar
-
-
-        # TODO misshapen lists
-
-
-
-        # get the list of svars that we're looking at
-        svarlist = []
-        for i in retdifflist:
-            if i[0] not in svarlist:
-                # dvars are treated a little different - we hold onto them as values in case they are needed further up the tree
-                # The can be identified by having an svar offset that is None (ie, the first element)
-                # If we've reached the top of the tree however we don't want to return them, ie, they arent a
-                # partial derivative with respect to any of the actual svars
-                if not (deep == 0 and i[0] is None):
-                    svarlist.append(i[0])
-
-        mergedret = [[i, []] for i in svarlist]
-
-
-        # For each possible svar (ie, each entry in mergedret), we will iterate
-        # through the diff list, see if we match the svar, and then for each match we will
-        # find a (potential) corresponding set, index, tuple combination and
-        for i in mergedret:
-
-            for j in retdifflist:
-
-                if i[0] == j[0]:
-                    # We have an svar match. Now look for a set/index/tuple match.
-
-                    # Need to do a double loop. At the first level we will look through the s/i/t
-                    # combinations in the retdifflist - as this is the one where if we don't find a match
-                    # in i[1] we need to add it
-
-                    for jtwig in j[1]:
-                        matched = False
-                        for itwig in i[1]:
-                            if (jtwig[0] == itwig[0]) and (jtwig[1] == itwig[1]) and (jtwig[2] == itwig[2]):
-                                matched = True
-                                itwig[3] = itwig[3] + jtwig[3]
-                        if not matched:
-                            # Didnt find it, must append
-                            i[1].append(jtwig)
+                raise ValueError(f"Unexpected operator {self.operator}")
 
+        except Exception as e:
+            raise type(e)(str(e) + f" - Differentiating {self.equationstringorig} on line {self.statementline}.")
 
+        return retterms
 
-        return mergedret
+    def _has_svar_or_if(self, svarmanager):
+        '''
+        Returns
+        -------
+        True if there is a solution variable, or a conditional, anywhere in the tree below this node
+        '''
+        if self.operator == 'var':
+            return self.var in svarmanager.names
+        elif self.operator == 'if':
+            return True
+        elif self.operator in ['sum', 'loge']:
+            # logs are only permitted of dvars, so they are always treated as constants
+            return self.operator == 'sum' and self.branch._has_svar_or_if(svarmanager)
+        elif self.operator in ['num', 'unhandled']:
+            return False
+        else:
+            return any(branch._has_svar_or_if(svarmanager) for branch in self.branches)
 
 
 
@@ -1341,6 +868,8 @@ class StatementManager(object):
 
         self.rootnodes = {} # A dictionary of the root nodes for the statement trees for each statement. Names is the key.
 
+        self.kernels = {} # A dictionary of the compiled kernels for each statement, None until compiled. Names is the key.
+
     def add(self,statementname,statementtext,sets,indexes,statementline):
 
         if not isinstance(statementname, str):
@@ -1355,6 +884,33 @@ class StatementManager(object):
 
         self.rootnodes[statementname] = StatementNode(statementtext,sets,indexes, statementname, statementline)
 
+    def compile_statement(self, statementname, svarhandler=None):
+        '''
+        Compile the named statement into a kernel. Implemented by the derived classes.
+        '''
+        raise NotImplementedError("compile_statement is implemented by the derived classes")
+
+    def _compile_if_ready(self, statementname):
+        # Compile straight away if everything the statement refers to is an already defined datavar.
+        # Otherwise (eg updates that refer to solution variables defined later in the model file) the
+        # compilation is left until the first evaluation.
+        if self.rootnodes[statementname].varnames() <= set(self.datavarmanager.names):
+            self.kernels[statementname] = self.compile_statement(statementname)
+        else:
+            self.kernels[statementname] = None
+
+    def _run_kernel(self, statementname, dvarvals, svarhandler, svarvals):
+        if self.kernels.get(statementname) is None:
+            self.kernels[statementname] = self.compile_statement(statementname, svarhandler)
+        kernel = self.kernels[statementname]
+
+        # Outside of conditionals, a divide by zero (etc) is an error in the model or data
+        try:
+            with np.errstate(divide='raise', invalid='raise'):
+                return kernel[0](dvarvals, svarvals)
+        except Exception as e:
+            raise type(e)(str(e) + f" - Evaluating statement name {statementname} on line {self.rootnodes[statementname].statementline}. {self.rootnodes[statementname]}\n")
+
     def __contains__(self, item):
         return item in self.names
 
@@ -1376,91 +932,61 @@ class AssertManager(StatementManager):
         # Hand the rest over to the parent class.
         super().add(statementname,statementtext,sets,indexes,statementline)
 
+        self._compile_if_ready(statementname)
+
+    def compile_statement(self, statementname, svarhandler=None):
+        '''
+        Compile an assertion over the full product of the sets that it is defined over
+
+        Returns
+        -------
+        A list of [kernel, indextuples]
+
+        '''
+        sizes = [len(self.datavarmanager.setmanager.cge_sets[s]) for s in self.sets[statementname]]
+        indextuples = index_tuples(sizes)
+
+        # if we are evaluating assertions we should never care about sol vars - hence the None
+        kernel = self.rootnodes[statementname].compile(self.datavarmanager,
+                                                       None,
+                                                       self.sets[statementname],
+                                                       self.indexes[statementname],
+                                                       indextuples)
+        return [kernel, indextuples]
 
     # Check a single statement 
-    # TODO can I turn this and the FormulaManager one into a helper function
     def check(self, statementname, dvarvals):
-        # Get the sizes of the sets over which this assertion is defined
-        sizes = [len(self.datavarmanager.setmanager.cge_sets[s]) for s in self.sets[statementname]]
 
-        # Now we need some lists that give the element ranges over which we will vary
-        # TODO change this to get_sizes
-        sizelists = [list(range(s)) for s in sizes]
+        dvarvals = np.asarray(dvarvals, dtype=float)
+        retvalues = self._run_kernel(statementname, dvarvals, None, None)
+        indextuples = self.kernels[statementname][1]
+        retvalues = np.broadcast_to(np.asarray(retvalues, dtype=bool), (indextuples.shape[0],))
 
-        # Now, we need to build the tuples over which we will evaluate
-        # We need to use the itertools library for this
-        # TODO - each formula really should evaluate this list at instantiation
-        indextuples = list(itertools.product(*sizelists))
+        # Iterate over the failures. If we find anything that is false an assertion has failed
+        # and we must report it
 
-        # We would also like the indexes into the dvarvals that these correspond to
-        # Note - we cannot simply use the indextuples from above!!
-        # Because (for example) we may have an assertion defined over x=X, y=Y, with a left hand side
-        # data variable that doubles up an index eg DATAVAR_x_x_y
-        # The indextuples above however is the correct ordering for evaluation of the statementnode tree
-        # We just need to map the indextuples through to a new set of tuples that are permuted by the
-        # order of indexes in the lhsdata
-        # First, get the
-
-        # Initialise a list of empty lists of the same length as the tuples over which the formula is evaluated
-#        indexlist = [() for _ in range(len(indextuples))]
-        # For each index on the LHS, pick out the correct element of the tuples
-#        for j, i in enumerate(self.lhsindexes[statementname]):
-#            if i[0] != '"':
-#                # Not an explicitly defined element
-#                offset = self.indexes[statementname].index(i)
-#                indexlist = [tuple(list(x) + [y[offset]]) for x,y in zip(indexlist, indextuples)]
-#            else:
-#                # Get the corresponding set and look up the index
-#                theset = self.datavarmanager.sets[self.lhsdata[statementname]][j]
-#                theoff = self.datavarmanager.setmanager.cge_sets[theset].elements.index(i[1:-1]) # need to strip off the quotes at either end
-#                indexlist = [tuple(list(x) + [theoff]) for x in indexlist]
-
-        # Finally, build the list of sets based on the indexes
-
-#        setlist = []
-#        for j,i in enumerate(self.lhsindexes[statementname]):
-#            if i[0] != '"':
-#                setlist.append(self.sets[statementname][self.indexes[statementname].index(i)])
-#            else:
-#                setlist.append(self.datavarmanager.sets[self.lhsdata[statementname]][j])
-
-#        retindexes = self.datavarmanager.get_index_list(self.lhsdata[statementname], setlist, indexlist)
-
-        # if we are evaluating formulas we should never care about sol vars - hence the Nones
-        retvalues = self.rootnodes[statementname].evaluate(self.datavarmanager,
-                                                           None,
-                                                           self.sets[statementname],
-                                                           self.indexes[statementname],
-                                                           indextuples,
-                                                           dvarvals,
-                                                           None)
-
-        # Iterate over the retvals. If we find anything that is false an assertion has failed
-        # and we must raise an exception
-
-        for i in range(len(retvalues)):
-            if not retvalues[i]:
+        for i in np.flatnonzero(~retvalues):
+
+            settext = ""
+            for idx, offset in enumerate(indextuples[i]):
+
+                indextext = self.indexes[statementname][idx]                        
+                elementtext = self.datavarmanager.setmanager.cge_sets[self.sets[statementname][idx]].elements[offset]
                 
-                settext = ""
-                if indextuples[i] is not None:
-                    for idx, offset in enumerate(indextuples[i]):
-
-                        indextext = self.indexes[statementname][idx]                        
-                        elementtext = self.datavarmanager.setmanager.cge_sets[self.sets[statementname][idx]].elements[offset]
-                        
-                        settext = settext + f"{indextext} = {elementtext}"
-                        
-                        if idx != len(indextuples[i]) - 1:
-                            settext = settext + ", "
+                settext = settext + f"{indextext} = {elementtext}"
+                
+                if idx != len(indextuples[i]) - 1:
+                    settext = settext + ", "
                     
-#                raise ValueError(f"Assertion {statementname} failed, for index combination {settext}.")
-                print(f"Assertion {statementname} failed, for index combination {settext}.")
+#            raise ValueError(f"Assertion {statementname} failed, for index combination {settext}.")
+            print(f"Assertion {statementname} failed, for index combination {settext}.")
 
 
 
         
     # Check all statement
     def check_all(self, dvarvals):
+        dvarvals = np.asarray(dvarvals, dtype=float)
         for n in self.names:
             self.check(n, dvarvals)
 
@@ -1504,30 +1030,33 @@ class FormulaManager(StatementManager):
         # Hand the rest over to the parent class
         super().add(statementname,statementtext,sets,indexes,statementline)
 
+        # The LHS has to be known as well as the RHS before we can compile
+        if self.lhsdata[statementname] in self.datavarmanager:
+            self._compile_if_ready(statementname)
+        else:
+            self.kernels[statementname] = None
+
     def addloop(self, nametxt, iterations, formula_list, linenumber):
 
         for i in range(iterations-1):
             self.names = self.names + formula_list
 
 
-    # Evaluate a single formula
-    # If inplace is true, we modify the passed dvarvals list. This is the default for a
-    # formula
-    # If inplace is false, we return the zip of indexes and values to be updated. This will
-    # be used when we are doing updates (ie, we are moving to a new vector of dvarvals)
-    def evaluate(self, statementname, dvarvals, svarhandler, svarvals, inplace = True):
+    def compile_statement(self, statementname, svarhandler=None):
+        '''
+        Compile a formula (or update) into a kernel that evaluates the RHS, along with the
+        offsets into the dvarvals of the LHS that the results are written to.
 
-        # Get the sizes of the sets over which this formula is defined
-        sizes = [len(self.datavarmanager.setmanager.cge_sets[s]) for s in self.sets[statementname]]
+        Returns
+        -------
+        A list of [kernel, retindexes]
 
-        # Now we need some lists that give the element ranges over which we will vary
-        # TODO change this to get_sizes
-        sizelists = [list(range(s)) for s in sizes]
+        '''
 
-        # Now, we need to build the tuples over which we will evaluate
-        # We need to use the itertools library for this
-        # TODO - each formula really should evaluate this list at instantiation
-        indextuples = list(itertools.product(*sizelists))
+        # Get the sizes of the sets over which this formula is defined, and build the tuples
+        # over which we will evaluate
+        sizes = [len(self.datavarmanager.setmanager.cge_sets[s]) for s in self.sets[statementname]]
+        indextuples = index_tuples(sizes)
 
         # We would also like the indexes into the dvarvals that these correspond to
         # Note - we cannot simply use the indextuples from above!!
@@ -1536,73 +1065,89 @@ class FormulaManager(StatementManager):
         # The indextuples above however is the correct ordering for evaluation of the statementnode tree
         # We just need to map the indextuples through to a new set of tuples that are permuted by the
         # order of indexes in the lhsdata
-        # First, get the
 
-        # Initialise a list of empty lists of the same length as the tuples over which the formula is evaluated
-        indexlist = [() for _ in range(len(indextuples))]
-        # For each index on the LHS, pick out the correct element of the tuples
+        # For each index on the LHS, pick out the correct column of the tuples, and the list of sets
+        columns = []
+        setlist = []
         for j, i in enumerate(self.lhsindexes[statementname]):
             if i[0] != '"':
                 # Not an explicitly defined element
                 offset = self.indexes[statementname].index(i)
-                indexlist = [tuple(list(x) + [y[offset]]) for x,y in zip(indexlist, indextuples)]
+                columns.append(indextuples[:, offset])
+                setlist.append(self.sets[statementname][offset])
             else:
                 # Get the corresponding set and look up the index
                 theset = self.datavarmanager.sets[self.lhsdata[statementname]][j]
                 theoff = self.datavarmanager.setmanager.cge_sets[theset].elements.index(i[1:-1]) # need to strip off the quotes at either end
-                indexlist = [tuple(list(x) + [theoff]) for x in indexlist]
+                columns.append(np.full(indextuples.shape[0], theoff, dtype=np.int64))
+                setlist.append(theset)
 
-        # Finally, build the list of sets based on the indexes
-        setlist = []
-        for j,i in enumerate(self.lhsindexes[statementname]):
-            if i[0] != '"':
-                setlist.append(self.sets[statementname][self.indexes[statementname].index(i)])
-            else:
-                setlist.append(self.datavarmanager.sets[self.lhsdata[statementname]][j])
+        if len(columns) > 0:
+            indexlist = np.column_stack(columns)
+            retindexes = self.datavarmanager.get_index_array(self.lhsdata[statementname], setlist, indexlist)
+        else:
+            indexlist = np.zeros((indextuples.shape[0], 0), dtype=np.int64)
+            retindexes = self.datavarmanager.get_index_array(self.lhsdata[statementname], None, indexlist)
 
-        retindexes = self.datavarmanager.get_index_list(self.lhsdata[statementname], setlist, indexlist)
+        kernel = self.rootnodes[statementname].compile(self.datavarmanager,
+                                                       svarhandler,
+                                                       setlist,
+                                                       self.lhsindexes[statementname],
+                                                       indexlist)
+        return [kernel, retindexes]
 
-        # if we are evaluating formulas we should never care about sol vars - hence the Nones
-        # TODO IF NOT VALID ANY MORE
-        if inplace:
-            retvalues = self.rootnodes[statementname].evaluate(self.datavarmanager,
-                                                               svarhandler,
-                                                               setlist,
-                                                               self.lhsindexes[statementname],
-                                                               indexlist,
-                                                               dvarvals,
-                                                               svarvals)
-        else:
-            retvalues = self.rootnodes[statementname].evaluate(self.datavarmanager,
-                                                               svarhandler,
-                                                               setlist,
-                                                               self.lhsindexes[statementname],
-                                                               indexlist,
-                                                               dvarvals,
-                                                               svarvals)
+    # Evaluate a single formula
+    # If inplace is true, we modify the passed dvarvals. This is the default for a
+    # formula
+    # If inplace is false, we return the zip of indexes and values to be updated. This will
+    # be used when we are doing updates (ie, we are moving to a new vector of dvarvals)
+    def evaluate(self, statementname, dvarvals, svarhandler, svarvals, inplace = True):
+
+        values = np.asarray(dvarvals, dtype=float)
+        if svarvals is not None:
+            svarvals = np.asarray(svarvals, dtype=float)
+
+        retvalues = self._run_kernel(statementname, values, svarhandler, svarvals)
+        retindexes = self.kernels[statementname][1]
+        retvalues = np.broadcast_to(retvalues, retindexes.shape)
 
         if inplace:
-            for i,v in zip(retindexes,retvalues):
-                dvarvals[i] = v
+            if isinstance(dvarvals, np.ndarray):
+                dvarvals[retindexes] = retvalues
+            else:
+                for i,v in zip(retindexes.tolist(),retvalues.tolist()):
+                    dvarvals[i] = v
             return None
         else:
-            return list(zip(retindexes,retvalues))
+            return list(zip(retindexes.tolist(),retvalues.tolist()))
 
     def evaluate_all_formulae(self, dvarvals, excludedmodifiers=[], asupdates=False, svarhandler=None, svarvals=None):
 
         # The included and excluded modifiers parameters allow us to either whitelist or blacklist particular modifiers
         # We aren't handling a circumstance where we have both a whitelist and a blacklist
 
+        # All the formulae are evaluated in place against a single array. If we were handed a list
+        # it is updated from the array at the end.
+        if isinstance(dvarvals, np.ndarray) and dvarvals.dtype == np.float64:
+            values = dvarvals
+        else:
+            values = np.array(dvarvals, dtype=float)
+        if svarvals is not None:
+            svarvals = np.asarray(svarvals, dtype=float)
+
         if asupdates:
-            # For updates we will be constructing a new dvarvals vector from scratch based on the updates
             # Note - if we are being called as updates, we are assuming that this instance of the class is
             # storing updates not regular formulae.
             for n in self.names:
-                self.evaluate(n, dvarvals, svarhandler, svarvals, inplace=True)
+                self.evaluate(n, values, svarhandler, svarvals, inplace=True)
         else:
             for n in self.names:
                 if len(set(self.modifiers[n]).intersection(set(excludedmodifiers))) == 0:
-                    self.evaluate(n, dvarvals, None, None, inplace=True)
+                    self.evaluate(n, values, None, None, inplace=True)
+
+        if values is not dvarvals:
+            dvarvals[:] = values.tolist() if isinstance(dvarvals, list) else values
+
 
 
 class EquationManager(StatementManager):
@@ -1624,7 +1169,7 @@ class EquationManager(StatementManager):
         self.sets = {} # A dictionary of lists of the set (in order) over which each variable is defined
         self.current_size = 0 # The current maximum extent of the variable list, which becomes the offset for any new variable which is added
 
-        self.derivatives = [] # a list (ordered by self.fullnames) of lists of svar_offset / statement node pairs
+        self.derivatives = {} # a dictionary (keyed by names) of the list of DiffTerms for each equation
 
         super().__init__(setmanager, datavarmanager)
 
@@ -1667,21 +1212,170 @@ class EquationManager(StatementManager):
 
 
 
-    def diffall(self, svarmanager, dvarvals):
+    def diff_equation(self, eqnname, svarmanager, dvarvals):
+        '''
+        Differentiate a single equation and expand its terms
+
+        Returns
+        -------
+        The list of DiffTerms for the equation, and the list of blocks from expand_terms
+        '''
+        eqnsets = self.sets[eqnname] if self.sets[eqnname] else []
+        eqnindexes = self.indexes[eqnname] if self.indexes[eqnname] else []
+
+        # One set of terms for the equation, whatever its size
+        terms = self.rootnodes[eqnname].differentiate(svarmanager, self.datavarmanager)
+
+        setsizes = self.setmanager.get_sizes()
+        indextuples = index_tuples([setsizes[i] for i in eqnsets])
+        rows = self.offsets[eqnname] + np.arange(indextuples.shape[0])
+        blocks = expand_terms(terms, svarmanager, self.datavarmanager, eqnsets, eqnindexes, indextuples, rows, dvarvals)
+
+        return terms, blocks
+
+    def diffall(self, svarmanager, dvarvals, workers=1):
         '''
-        Evaluate all the differential trees for the set of statementnodes that sit under me
-        A full set of new trees will be built that have a 1:1 correspondence to the preexisting statement nodes
+        Differentiate each equation once over its symbolic indexes, then expand the resulting
+        terms out to the rows of the equation and the svar columns, and set up the jacobian
+
+        Parameters
+        ----------
+        workers: The number of processes to split the equations across. With 1 (the default)
+                 everything is done in this process.
 
         Returns
         -------
         None.
 
         '''
+        if workers > 1 and len(self.names) > 1:
+            # Contiguous blocks of equations, a few per worker so that one large equation
+            # doesn't hold everything up. map returns them in order, so the merge below is
+            # the same whatever order the workers finish in.
+            nchunks = min(len(self.names), workers * 4)
+            chunks = [list(chunk) for chunk in np.array_split(np.array(self.names, dtype=object), nchunks)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_diff_worker_init, initargs=(self, svarmanager, dvarvals)) as executor:
+                results = [result for chunkresults in executor.map(_diff_worker_chunk, chunks) for result in chunkresults]
+        else:
+            results = [self.diff_equation(eqnname, svarmanager, dvarvals) for eqnname in self.names]
+
+        blocks = []
+        for eqnname, (terms, eqnblocks) in zip(self.names, results):
+            self.derivatives[eqnname] = terms
+            blocks = blocks + eqnblocks
+
+        # The sparsity pattern is fixed from here on, so the jacobian can be set up once
+        self.jacobian = JacobianEngine(blocks, self.datavarmanager, len(self.fullnames), len(svarmanager.fullnames))
+
 
-        # Iterate through each of the statement nodes
-        for i in range(len(self.fullnamesbycolumn)):
+# Each worker process of a parallel diffall gets its own copy of the managers, once, here
+_diff_worker_state = None
 
-            eqnname = self.fullnamesbycolumn[i][0]
-            indextuple = self.indexoffsets[i]
+def _diff_worker_init(equationmanager, svarmanager, dvarvals):
+    global _diff_worker_state
+    _diff_worker_state = (equationmanager, svarmanager, dvarvals)
 
-            self.derivatives = self.derivatives + [self.rootnodes[eqnname].differentiate(svarmanager, self.datavarmanager, self.sets[eqnname], self.indexes[eqnname], [indextuple], dvarvals)]
\ No newline at end of file
+def _diff_worker_chunk(eqnnames):
+    equationmanager, svarmanager, dvarvals = _diff_worker_state
+    return [equationmanager.diff_equation(eqnname, svarmanager, dvarvals) for eqnname in eqnnames]
+
+
+class JacobianEngine(object):
+    '''
+    JacobianEngine
+
+    Assembles the jacobian of the equation system (rows are equations, columns are svars) as a
+    CSR matrix. The sparsity pattern is computed once from the expanded derivative terms. Every
+    block of terms that shares the same coefficient structure, sets and indexes is compiled into
+    a single kernel over the stacked index tuples, so that each assembly is one kernel call per
+    structure followed by a segmented sum into the preallocated CSR data array.
+
+    '''
+    def __init__(self, blocks, dvarmanager, nrows, ncols):
+
+        self.shape = (nrows, ncols)
+
+        # Group the blocks by structure
+        groups = {} # structure key -> [node, sets, indexes, tuples, rows, cols]
+        for node, sets, indexes, tuples, rows, cols in blocks:
+            key = (node.structure_key(), tuple(sets), tuple(indexes))
+            if key not in groups:
+                groups[key] = [node, sets, indexes, [], [], []]
+            group = groups[key]
+            group[3].append(tuples)
+            group[4].append(rows)
+            group[5].append(cols)
+        for group in groups.values():
+            group[3] = np.concatenate(group[3])
+            group[4] = np.concatenate(group[4]).astype(np.int64)
+            group[5] = np.concatenate(group[5]).astype(np.int64)
+
+        # The sparsity pattern - one entry for each distinct (row, col) pair, in CSR order
+        grouprows = [g[4] for g in groups.values()]
+        groupcols = [g[5] for g in groups.values()]
+        allkeys = np.concatenate(grouprows) * ncols + np.concatenate(groupcols) if groups else np.zeros(0, dtype=np.int64)
+        patternkeys = np.unique(allkeys)
+        patternrows = patternkeys // ncols
+        self.indices = (patternkeys % ncols).astype(np.int32)
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(patternrows, minlength=nrows))]).astype(np.int32)
+        self.data = np.zeros(len(patternkeys))
+
+        # Each term value is written into a buffer that is ordered by its slot in the pattern, so that
+        # the values for each nonzero are contiguous and can be summed with a single reduceat
+        slots = np.searchsorted(patternkeys, allkeys)
+        order = np.argsort(slots, kind='stable')
+        position = np.empty_like(order)
+        position[order] = np.arange(len(order))
+        self.starts = np.searchsorted(slots[order], np.arange(len(patternkeys)))
+        self.buffer = np.zeros(len(allkeys))
+
+        self.kernels = [] # list of [kernel, positions in the buffer]
+        start = 0
+        for node, sets, indexes, tuples, rows, cols in groups.values():
+            kernel = node.compile(dvarmanager, None, list(sets), list(indexes), tuples)
+            self.kernels.append([kernel, position[start:start + len(rows)]])
+            start = start + len(rows)
+
+        self.matrix = csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+    def copy(self):
+        '''
+        Returns
+        -------
+        An engine that shares the pattern and kernels of this one, but has its own buffers, so
+        the two can be evaluated at the same time (eg on different threads)
+        '''
+        engine = copy.copy(self)
+        engine.data = np.zeros_like(self.data)
+        engine.buffer = np.zeros_like(self.buffer)
+        engine.matrix = csr_matrix((engine.data, engine.indices, engine.indptr), shape=engine.shape)
+        return engine
+
+    def pattern(self):
+        '''
+        Returns
+        -------
+        The sparsity pattern as a CSR matrix of ones. It is the same whatever the dvarvals, so
+        it can be looked at before anything is evaluated
+
+        '''
+        return csr_matrix((np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr), shape=self.shape)
+
+    def evaluate(self, dvarvals):
+        '''
+        Fill the jacobian for the given dvarvals
+
+        Returns
+        -------
+        The CSR matrix. Note that its data array is reused (and overwritten) by the next call.
+
+        '''
+        dvarvals = np.asarray(dvarvals, dtype=float)
+        with np.errstate(divide='raise', invalid='raise'):
+            for kernel, positions in self.kernels:
+                self.buffer[positions] = kernel(dvarvals, None)
+
+        if len(self.data) > 0:
+            np.add.reduceat(self.buffer, self.starts, out=self.data)
+        self.matrix.data = self.data
+        return self.matrix
\ No newline at end of file
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Shared setup for the tests. The modules sit at the top of the repository rather than in a
+package, so it is put on the path here.
+"""
+
+import os
+import sys
+
+import pytest
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+@pytest.fixture(scope="session")
+def short_yml():
+    '''
+    Returns
+    -------
+    A function that writes a copy of default.yml cut down to the first few steps into a
+    directory, with the compiled model kept there too, and returns its path
+    '''
+    def make(directory, steps, **overrides):
+        with open(os.path.join(REPO, "default.yml")) as file:
+            settings = yaml.safe_load(file)
+        settings["steps"] = steps
+        settings["basefiles"] = settings["basefiles"][:steps]
+        settings["polfiles"] = settings["polfiles"][:steps]
+        settings["compileddir"] = os.path.join(str(directory), "compiled")
+        settings.update(overrides)
+        
+        path = os.path.join(str(directory), "test.yml")
+        with open(path, "w") as file:
+            yaml.safe_dump(settings, file)
+        return path
+    return make
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+The on disk baseline cache.
+"""
+
+import os
+
+import numpy as np
+
+import basecache
+
+
+def write(path, contents):
+    with open(path, "w") as file:
+        file.write(contents)
+    return str(path)
+
+
+def test_round_trip(tmp_path):
+    cache = basecache.BaseCache(str(tmp_path / "cache"))
+    rng = np.random.default_rng(0)
+    svars = rng.normal(size=(3, 2, 50))
+    dvars = rng.normal(size=(3, 2, 40))
+    
+    assert cache.load("missing") is None
+    cache.save("key", svars, dvars)
+    loaded = cache.load("key")
+    
+    np.testing.assert_array_equal(loaded[0], svars)
+    np.testing.assert_array_equal(loaded[1], dvars)
+    # Nothing is left behind from writing the entry
+    assert os.listdir(str(tmp_path / "cache")) == ["key.npz"]
+
+
+def test_unreadable_entry(tmp_path):
+    cache = basecache.BaseCache(str(tmp_path))
+    write(cache.path("key"), "not an npz file")
+    assert cache.load("key") is None
+
+
+def test_key_follows_the_contents(tmp_path):
+    model = write(tmp_path / "model", "model")
+    data = write(tmp_path / "data", "data")
+    base1 = write(tmp_path / "base1", "add x1")
+    base2 = write(tmp_path / "base2", "add x2")
+    copy = write(tmp_path / "copy", "add x1")
+    
+    key = basecache.base_key(model, [data], [base1, base2], 2, 1)
+    assert key == basecache.base_key(model, [data], [copy, base2], 2, 1)
+    assert key != basecache.base_key(model, [data], [base2, base1], 2, 1)
+    assert key != basecache.base_key(model, [data], [base1, base2], 2, 2)
+    
+    write(base1, "add x1\nshock x1 1")
+    assert key != basecache.base_key(model, [data], [base1, base2], 2, 1)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+The compiled closures.
+"""
+
+import shutil
+
+import numpy as np
+
+import closures
+
+
+def sample():
+    builder = closures.ClosureBuilder(10)
+    builder.add([7, 2], False)
+    builder.add([5], True)
+    builder.shock([2], 3.0)
+    return builder.build()
+
+
+def test_builder_keeps_order():
+    builder = closures.ClosureBuilder(10)
+    assert not builder.add([7, 2], False)
+    assert builder.add([2, 5, 5], True)
+    builder.add([0], False)
+    builder.remove([7])
+    builder.shock([5], 1.5)
+    
+    assert builder.contains([2, 5])
+    assert not builder.contains([2, 7])
+    closure = builder.build()
+    np.testing.assert_array_equal(closure.exogenous, [2, 5, 0])
+    np.testing.assert_array_equal(closure.ischange, [True, True, False])
+    np.testing.assert_array_equal(closure.shocks, [0, 1.5, 0])
+    
+    # Adding again clears the shock
+    builder.add([5], True)
+    assert builder.build().shocks[1] == 0
+
+
+def test_positions():
+    closure = sample()
+    np.testing.assert_array_equal(closure.positions([5, 7, 3, 2]), [2, 0, -1, 1])
+    np.testing.assert_array_equal(closures.Closure(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool),
+                                                   np.zeros(0)).positions([1]), [-1])
+
+
+def test_shocked_shares_structure():
+    closure = sample()
+    shocked = closure.shocked([7], 4.0, False)
+    
+    assert shocked.exogenous is closure.exogenous
+    assert shocked.ischange is closure.ischange
+    np.testing.assert_array_equal(shocked.shocks, [4.0, 3.0, 0])
+    # The original is left alone
+    np.testing.assert_array_equal(closure.shocks, [0, 3.0, 0])
+
+
+def test_shocked_appends_missing():
+    closure = sample()
+    shocked = closure.shocked([3, 5, 9], 2.0, False)
+    
+    np.testing.assert_array_equal(shocked.exogenous, [7, 2, 5, 3, 9])
+    np.testing.assert_array_equal(shocked.ischange, [False, False, False, False, False])
+    np.testing.assert_array_equal(shocked.shocks, [0, 3.0, 2.0, 2.0, 2.0])
+    assert len(closure) == 3
+
+
+def test_exogenous_values():
+    closure = sample()
+    basevals = np.array([1.0, 2.0, 0.5])
+    values = closure.exogenous_values(basevals, 2)
+    
+    # Percentage changes compound over the substeps, change variables are split evenly
+    np.testing.assert_allclose(values[:2], (1 + basevals[:2] / 100) * (1 + closure.shocks[:2] / 100) ** 0.5 * 100 - 100)
+    assert values[2] == 0.5
+    assert closure.shocked([5], 4.0, True).exogenous_values(basevals, 2)[2] == 2.5
+
+
+def test_store_by_contents(tmp_path):
+    store = closures.ClosureStore()
+    compiled = []
+    
+    def compile(path):
+        compiled.append(path)
+        return sample()
+    
+    first = str(tmp_path / "first.txt")
+    with open(first, "w") as file:
+        file.write("add x1\n")
+    copy = str(tmp_path / "copy.txt")
+    shutil.copy(first, copy)
+    
+    closure = store.get(first, compile)
+    assert store.get(copy, compile) is closure
+    assert compiled == [first]
+    
+    with open(copy, "a") as file:
+        file.write("add x2\n")
+    assert store.get(copy, compile) is not closure
+    assert compiled == [first, copy]
+
+
+def test_store_interns_structure():
+    store = closures.ClosureStore()
+    closure = store.intern(sample())
+    other = sample()
+    other.shocks[:] = 1.0
+    other = store.intern(other)
+    
+    assert other.exogenous is closure.exogenous
+    assert other.ischange is closure.ischange
+    np.testing.assert_array_equal(other.shocks, [1.0, 1.0, 1.0])
+    assert store.intern(sample().shocked([9], 1.0, False)).exogenous is not closure.exogenous
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+A short run of the model, under each of the history retention policies, compared against the
+results committed with it (base.xlsx and policy.xlsx), which were written by the original
+solver.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import solver
+from conftest import REPO
+
+STEPS = 3
+
+
+@pytest.fixture(scope="module", params=["full", "reporting", "final"])
+def outputdir(tmp_path_factory, short_yml, request):
+    directory = tmp_path_factory.mktemp(request.param)
+    ymlfile = short_yml(directory, STEPS, retention=request.param)
+    solver.run_model("orani.model", ymlfile=ymlfile, basedir=REPO, outputdir=str(directory))
+    return str(directory), request.param
+
+
+@pytest.mark.parametrize("sim", ["base", "policy"])
+@pytest.mark.parametrize("sheet", ["svars", "dvars"])
+def test_matches_committed_results(outputdir, sim, sheet):
+    outputdir, retention = outputdir
+    expected = pd.read_excel(os.path.join(REPO, f"{sim}.xlsx"), sheet_name=sheet)
+    actual = pd.read_excel(os.path.join(outputdir, f"{sim}.xlsx"), sheet_name=sheet)
+    
+    assert list(actual.iloc[:, 0]) == list(expected.iloc[:, 0])
+    # Under the final retention policy only the last step is written
+    steps = [f"S{s}" for s in range(STEPS)] if retention != "final" else [f"S{STEPS - 1}"]
+    assert list(actual.columns[1:]) == steps
+    
+    # Relative to the size of the value, so that the large levels and the small percentage
+    # changes are held to the same number of digits
+    scaled = np.abs(actual[steps].values - expected[steps].values) / (1 + np.abs(expected[steps].values))
+    worst = np.unravel_index(np.argmax(scaled), scaled.shape)
+    assert scaled.max() < 1e-8, f"{actual.iloc[worst[0], 0]} {steps[worst[1]]}: {actual[steps].values[worst]} against {expected[steps].values[worst]}"
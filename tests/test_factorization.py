@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+FactorizationCache and do_inversion against a fresh factorisation of the same system.
+"""
+
+import numpy as np
+import pytest
+from scipy.sparse import csc_matrix, csr_matrix, diags, random as sparse_random
+from scipy.sparse.linalg import splu
+
+import solver
+
+NEQUATIONS = 300
+NEXOGENOUS = 40
+
+
+def make_system(seed, pattern=None):
+    '''
+    Returns
+    -------
+    A CSR jacobian (equations by solvars) that is non singular once the exogenous columns are
+    taken out, and the exogenous columns. With a pattern, the jacobian has the same sparsity
+    as that one with new values.
+    '''
+    rng = np.random.default_rng(seed)
+    if pattern is None:
+        A = sparse_random(NEQUATIONS, NEQUATIONS + NEXOGENOUS, density=0.02, random_state=rng, format="csr")
+        # A strong diagonal over the endogenous columns keeps the reduced system well away from singular
+        A = A + csr_matrix((np.ones(NEQUATIONS), (np.arange(NEQUATIONS), np.arange(NEQUATIONS))), shape=A.shape)
+        A = csr_matrix(A)
+        A.sort_indices()
+    else:
+        A = pattern.copy()
+    A.data = rng.uniform(0.5, 2, A.nnz) * np.sign(rng.uniform(-1, 1, A.nnz))
+    diagonal = A.diagonal()
+    A.setdiag(diagonal + 10 * np.sign(diagonal))
+    return A, np.arange(NEQUATIONS, NEQUATIONS + NEXOGENOUS)
+
+
+def fresh_solve(A, exogenous, exogvals):
+    # The reference - take the columns apart and factorise the endogenous part from scratch
+    endogenous = np.setdiff1d(np.arange(A.shape[1]), exogenous)
+    x = np.zeros(A.shape[1])
+    x[exogenous] = exogvals
+    x[endogenous] = splu(csc_matrix(A[:, endogenous])).solve(-(A @ x))
+    return x
+
+
+def test_reuse_matches_fresh_factorisation():
+    cache = solver.FactorizationCache()
+    A, exogenous = make_system(0)
+    pattern = A.copy()
+    rng = np.random.default_rng(1)
+    
+    # The first factorisation, a refactorisation with the stored ordering, and the same system
+    # again (reusing the last factorisation as it is), each with a new rhs
+    for seed in [0, 2, 2, 3, 3]:
+        A, exogenous = make_system(seed, pattern)
+        exogvals = rng.normal(size=NEXOGENOUS)
+        x = solver.do_inversion(A, exogvals, [str(i) for i in range(NEQUATIONS)], solver=cache, exogenous=exogenous)
+        np.testing.assert_allclose(x, fresh_solve(A, exogenous, exogvals), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(A @ x, 0, atol=1e-10)
+    
+    assert len(cache.entries) == 1
+
+
+def test_entry_per_closure():
+    cache = solver.FactorizationCache()
+    A, exogenous = make_system(0)
+    rowlabels = [str(i) for i in range(NEQUATIONS)]
+    solver.do_inversion(A, np.ones(NEXOGENOUS), rowlabels, solver=cache, exogenous=exogenous)
+    
+    # Swap an exogenous column for an endogenous one in the same equation
+    other = exogenous.copy()
+    other[0] = 0
+    A = A.tolil()
+    A[0, NEQUATIONS] = 1
+    A = csr_matrix(A)
+    x = solver.do_inversion(A, np.ones(NEXOGENOUS), rowlabels, solver=cache, exogenous=other)
+    
+    assert len(cache.entries) == 2
+    np.testing.assert_allclose(x, fresh_solve(A, other, np.ones(NEXOGENOUS)), rtol=1e-10, atol=1e-12)
+
+
+def test_tiny_rows():
+    # Equations like (V1PUR+TINY)*p1 = V1BAS*(p0+t1) where there is no flow have nothing but
+    # coefficients of 1e-12. Scaling rows by that must not change the solution
+    n = 400
+    rng = np.random.default_rng(6)
+    A = csc_matrix(sparse_random(n, n, density=0.008, random_state=rng, data_rvs=lambda k: rng.uniform(-1, 1, k))
+                   + diags(rng.uniform(0.01, 1, n)))
+    b = rng.normal(size=n)
+    expected = splu(A).solve(b)
+    
+    scale = np.ones(n)
+    scale[rng.choice(n, n // 3, replace=False)] = 1e-12
+    x = solver.do_inversion(diags(scale) @ A, b * scale, [str(i) for i in range(n)])
+    
+    np.testing.assert_allclose(x, expected, rtol=0, atol=1e-10 * np.abs(expected).max())
+
+
+def test_wrong_number_of_exogenous():
+    A, exogenous = make_system(0)
+    with pytest.raises(solver.ModelException, match="too many exogenous"):
+        solver.do_inversion(A, np.ones(NEXOGENOUS + 1), [str(i) for i in range(NEQUATIONS)],
+                            exogenous=np.append(exogenous, 0))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+The simulation history store.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import history
+
+STEPS = 3
+SUBSTEPS = 2
+NSVARS = 20
+NDVARS = 15
+
+
+def record(store, seed=0):
+    '''
+    Record a made up simulation into the store
+
+    Returns
+    -------
+    The full (steps, substeps, n) svar and dvar arrays that were recorded
+    '''
+    rng = np.random.default_rng(seed)
+    svars = rng.normal(size=(STEPS, SUBSTEPS, NSVARS))
+    dvars = rng.normal(size=(STEPS, SUBSTEPS, NDVARS))
+    for s in range(STEPS):
+        for ss in range(SUBSTEPS):
+            store.record_dvars(s, ss, dvars[s, ss])
+            store.record_svars(s, ss, svars[s, ss])
+    store.flush()
+    return svars, dvars
+
+
+def test_full_in_memory():
+    store = history.HistoryStore(STEPS, SUBSTEPS, NSVARS, NDVARS)
+    svars, dvars = record(store)
+    
+    assert store.isfull
+    np.testing.assert_array_equal(store.svars, svars)
+    np.testing.assert_array_equal(store.dvars, dvars)
+    np.testing.assert_array_equal(store.svar_values(1, 1, [3, 7]), svars[1, 1, [3, 7]])
+    np.testing.assert_array_equal(store.dvar_history([0, 14]), dvars[:, :, [0, 14]])
+    np.testing.assert_array_equal(store.prefix(2).svars, svars[:2])
+
+
+def test_memory_mapped(tmp_path):
+    store = history.HistoryStore(STEPS, SUBSTEPS, NSVARS, NDVARS, directory=str(tmp_path), name="base")
+    svars, dvars = record(store)
+    
+    np.testing.assert_array_equal(np.load(str(tmp_path / "base.svars.npy"), mmap_mode='r'), svars)
+    np.testing.assert_array_equal(np.load(str(tmp_path / "base.dvars.npy"), mmap_mode='r'), dvars)
+    
+    # A new store of the same name leaves the mapping of the old one alone
+    again = history.HistoryStore(STEPS, SUBSTEPS, NSVARS, NDVARS, directory=str(tmp_path), name="base")
+    record(again, seed=1)
+    np.testing.assert_array_equal(store.svars, svars)
+    assert sorted(os.listdir(str(tmp_path))) == ["base.dvars.npy", "base.svars.npy"]
+
+
+def test_from_arrays():
+    svars = np.ones((STEPS, SUBSTEPS, NSVARS))
+    dvars = np.zeros((STEPS, SUBSTEPS, NDVARS))
+    store = history.HistoryStore.from_arrays(svars, dvars)
+    assert store.isfull
+    assert store.steps == STEPS and store.substeps == SUBSTEPS
+    np.testing.assert_array_equal(store.svar_values(2, 0, [5]), [1])
+
+
+def test_reporting_retention():
+    store = history.HistoryStore(STEPS, SUBSTEPS, NSVARS, NDVARS, svarcolumns=[9, 2, 2], dvarcolumns=[4],
+                                 trackedsvars=[11])
+    svars, dvars = record(store)
+    
+    assert not store.isfull
+    assert store.svars.shape == (STEPS, SUBSTEPS, 2)
+    np.testing.assert_array_equal(store.svar_history([9, 2]), svars[:, :, [9, 2]])
+    np.testing.assert_array_equal(store.dvar_history([4]), dvars[:, :, [4]])
+    np.testing.assert_array_equal(store.svar_values(0, 1, [11]), svars[0, 1, [11]])
+    
+    with pytest.raises(ValueError, match="not held"):
+        store.svar_history([3])
+    with pytest.raises(ValueError, match="not a full history"):
+        store.prefix(1)
+
+
+def test_final_retention():
+    store = history.HistoryStore(STEPS, SUBSTEPS, NSVARS, NDVARS, svarcolumns=[5], dvarcolumns=[6],
+                                 finalonly=True, trackedsvars=[1, 8])
+    svars, dvars = record(store)
+    
+    assert store.stepnumbers == [STEPS - 1]
+    np.testing.assert_array_equal(store.svar_history([5]), svars[-1:, :, [5]])
+    np.testing.assert_array_equal(store.dvar_history([6]), dvars[-1:, :, [6]])
+    # The tracked svars are still there for every step and substep
+    for s in range(STEPS):
+        np.testing.assert_array_equal(store.svar_values(s, 0, [1, 8]), svars[s, 0, [1, 8]])
+    np.testing.assert_array_equal(store.svar_values(STEPS - 1, 1, [5]), svars[-1, 1, [5]])
+    
+    with pytest.raises(ValueError, match="Step 0 is not held"):
+        store.svar_values(0, 0, [5])
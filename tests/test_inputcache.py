@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+The binary cache of the input workbooks.
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import inputcache
+from conftest import REPO
+
+
+def write_workbook(path, scale=1.0):
+    sheets = {"numbers": pd.DataFrame({"a": np.arange(5) * scale, "b": np.arange(5, dtype=np.int64)}),
+              "labels": pd.DataFrame({"name": ["x", None, "z"], "value": [1.5, 2.5, np.nan]}),
+              # A column that mixes text and numbers is pickled rather than stored as columns
+              "mixed": pd.DataFrame({"c": ["x", 1, 2.5]})}
+    with pd.ExcelWriter(path) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+    return str(path)
+
+
+def assert_same_workbook(cached, path):
+    expected = pd.read_excel(path, sheet_name=None)
+    assert list(cached) == list(expected)
+    for name in expected:
+        pd.testing.assert_frame_equal(cached[name], expected[name])
+
+
+@pytest.fixture
+def no_excel(monkeypatch):
+    # Anything that gets past this is served from the cache
+    def fail(*args, **kwargs):
+        raise AssertionError("read the workbook rather than the cache")
+    
+    def disable():
+        monkeypatch.setattr(inputcache.pd, "read_excel", fail)
+    return disable
+
+
+def test_round_trip(tmp_path, no_excel):
+    path = write_workbook(tmp_path / "data.xlsx")
+    cache = inputcache.InputCache(str(tmp_path / "cache"))
+    assert_same_workbook(cache.read_excel(path), path)
+    
+    formats = {name: sheet["format"] for name, sheet in cache.read_excel(path).sheets.items()}
+    assert formats == {"numbers": "npz", "labels": "npz", "mixed": "pickle"}
+    
+    expected = pd.read_excel(path, sheet_name=None)
+    no_excel()
+    cached = cache.read_excel(path)
+    assert cached.loaded == {}
+    for name in expected:
+        pd.testing.assert_frame_equal(cached[name], expected[name])
+    
+    # Pickled (as into a compiled model) it is a plain dictionary of what has been loaded
+    assert pickle.loads(pickle.dumps(cached)).keys() == expected.keys()
+
+
+def test_touched_and_changed(tmp_path, no_excel):
+    path = write_workbook(tmp_path / "data.xlsx")
+    cache = inputcache.InputCache(str(tmp_path / "cache"))
+    cache.read_excel(path)
+    
+    # Touching the workbook only costs a hash
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(inputcache.pd, "read_excel", lambda *args, **kwargs: pytest.fail("rebuilt a touched workbook"))
+        cache.read_excel(path)
+    
+    # Changing it rebuilds the entry
+    write_workbook(path, scale=2.0)
+    assert cache.read_excel(path)["numbers"]["a"].tolist() == [0.0, 2.0, 4.0, 6.0, 8.0]
+    no_excel()
+    assert cache.read_excel(path)["numbers"]["a"].tolist() == [0.0, 2.0, 4.0, 6.0, 8.0]
+
+
+def test_model_database(tmp_path):
+    path = os.path.join(REPO, "database", "oranignm.xlsx")
+    cache = inputcache.InputCache(str(tmp_path))
+    cache.read_excel(path)
+    assert_same_workbook(cache.read_excel(path), path)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+PolicyEngine reusing its baselines.
+"""
+
+import os
+import shutil
+
+import numpy as np
+
+import solver
+from conftest import REPO
+
+
+def test_edited_closure_is_a_new_baseline(tmp_path, short_yml):
+    basefile = str(tmp_path / "base2023.txt")
+    shutil.copyfile(os.path.join(REPO, "closures", "base2023.txt"), basefile)
+    ymlfile = short_yml(tmp_path, 1, basefiles=[basefile])
+    engine = solver.PolicyEngine("orani.model", ymlfile, basedir=REPO)
+    
+    def run():
+        simtypes = []
+        model = engine.run_policy({"outputdir": str(tmp_path)}, callback=lambda result: simtypes.append(result.simtype))
+        return simtypes, model.basehistory.svars[0, 0].copy()
+    
+    first, firstbase = run()
+    again, _ = run()
+    assert "base" in first
+    assert "base" not in again
+    
+    # The same file with a different shock is solved again, and gives a different baseline
+    with open(basefile) as file:
+        contents = file.read()
+    assert "shock realgdp 3.32653498580532" in contents
+    with open(basefile, "w") as file:
+        file.write(contents.replace("shock realgdp 3.32653498580532", "shock realgdp 2"))
+    edited, editedbase = run()
+    assert "base" in edited
+    assert len(engine.bases) == 2
+    assert (firstbase != editedbase).any()
+
+
+def test_baseline_from_the_disk_cache(tmp_path, short_yml):
+    ymlfile = short_yml(tmp_path, 2)
+    cachedir = str(tmp_path / "cache")
+    
+    results = []
+    for run in range(2):
+        # A new engine each time, as another process would have
+        engine = solver.PolicyEngine("orani.model", ymlfile, cachedir=cachedir, basedir=REPO)
+        simtypes = []
+        model = engine.run_policy({"outputdir": str(tmp_path / str(run))}, callback=lambda result: simtypes.append(result.simtype))
+        results.append((simtypes, model.basehistory.svars.copy(), model.history.svars.copy()))
+    
+    assert "base" in results[0][0]
+    assert "base" not in results[1][0]
+    np.testing.assert_array_equal(results[0][1], results[1][1])
+    np.testing.assert_array_equal(results[0][2], results[1][2])
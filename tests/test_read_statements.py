@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting a model file into statements.
+"""
+
+import pytest
+
+import solver
+
+
+def test_statements_over_and_within_lines():
+    lines = ["Set COM # The commodities;",
+             "    (AG, MIN);",
+             "Set IND (AG, MIN);Set SRC (dom, imp); Set OCC",
+             "(LAB);"]
+    statements = solver.read_statements(lines, "test.model")
+    
+    assert [statement['line'] for statement in statements] == ["Set COM (AG, MIN);",
+                                                              "Set IND (AG, MIN);",
+                                                              "Set SRC (dom, imp);",
+                                                              "Set OCC (LAB);"]
+    assert [(statement['linenumberstart'], statement['linenumberend']) for statement in statements] == [(1, 2), (3, 3), (3, 3), (3, 4)]
+
+
+def test_unterminated_statement():
+    with pytest.raises(solver.ModelException, match="not terminated"):
+        solver.read_statements(["Set COM (AG, MIN);", "Set IND (AG"], "test.model")
+
+
+def test_text_outside_a_statement():
+    with pytest.raises(solver.ModelException, match="Expected statement type on line 1"):
+        solver.read_statements(["Set COM (AG, MIN); AG"], "test.model")
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+The columnar output formats against the Excel output of the same run.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import solver
+import writers
+from conftest import REPO
+
+FORMATS = ["csv"] + (["parquet", "arrow"] if writers.pyarrow is not None else [])
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory, short_yml):
+    directory = tmp_path_factory.mktemp("xlsx")
+    ymlfile = short_yml(directory, 2)
+    return solver.run_model("orani.model", ymlfile=ymlfile, basedir=REPO, outputdir=str(directory))
+
+
+@pytest.fixture(scope="module", params=FORMATS)
+def written(model, tmp_path_factory, request):
+    '''
+    Returns
+    -------
+    The directory of the Excel output, and the directory and format the same results were
+    written to in a columnar format
+    '''
+    exceldir = model.outputdir
+    model.outputformat = request.param
+    model.outputdir = str(tmp_path_factory.mktemp(request.param))
+    try:
+        model.do_writes(long=model.longformat)
+        return exceldir, model.outputdir, request.param
+    finally:
+        model.outputformat = "xlsx"
+        model.outputdir = exceldir
+
+
+# Excel keeps 15 significant digits, the columnar formats every bit
+@pytest.mark.parametrize("sim", ["base", "policy"])
+def test_long_tables(written, sim):
+    exceldir, outputdir, outputformat = written
+    stem = os.path.join(outputdir, sim)
+    assert writers.table_names(stem, outputformat) == ["dvars", "svars"]
+    
+    for table, label in [("svars", "SVAR"), ("dvars", "DVAR")]:
+        expected = pd.read_excel(os.path.join(exceldir, f"{sim}.xlsx"), sheet_name=table)
+        actual = writers.read_long(stem, table, outputformat, label)
+        pd.testing.assert_frame_equal(actual, expected, check_exact=False, rtol=1e-14, atol=0, check_dtype=False)
+
+
+def test_write_statements(written):
+    exceldir, outputdir, outputformat = written
+    expected = pd.read_excel(os.path.join(exceldir, "summary.xlsx"), sheet_name=None)
+    stem = os.path.join(outputdir, "summary")
+    assert sorted(writers.table_names(stem, outputformat)) == sorted(expected)
+    
+    for table, df in expected.items():
+        path = writers.table_path(stem, table, outputformat)
+        if outputformat == "csv":
+            actual = pd.read_csv(path, keep_default_na=False, na_values=[""], float_precision="round_trip")
+        elif outputformat == "parquet":
+            actual = pd.read_parquet(path)
+        else:
+            actual = pd.read_feather(path)
+        pd.testing.assert_frame_equal(actual, df, check_exact=False, rtol=1e-14, atol=0, check_dtype=False)
+
+
+def test_check_format():
+    assert writers.check_format("xlsx") is None
+    assert "must be one of" in writers.check_format("xls")
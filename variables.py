@@ -7,6 +7,8 @@ Created on Thu Mar 28 09:47:31 2024
 
 import itertools
 
+import numpy as np
+
 
 class VarHandler(object):
     '''
@@ -68,12 +70,12 @@ class VarHandler(object):
         else:
             raise TypeError(f"add_var: Unsupported operand type for sets, expecting list of set strings or None: '{format(type(sets))}'")
 
-    def get_index_list(self, name, sets, instances):
+    def get_index_array(self, name, sets, instances):
         '''
         This function takes on a variable name, the sets over which the instances of indexes are ranging (noting
-        that they may be subsets of the sets over which the variables are actually defined), and the list of instances
-        of the index tuples (noting that we have no guarantees about which variable is ranging the fastest)
-        and builds them into a list of offsets into the master variable list that refers to each individual offset
+        that they may be subsets of the sets over which the variables are actually defined), and the instances
+        of the index tuples as a 2d integer array (one row per instance, one column per set), and returns the
+        offsets into the master variable list as an integer numpy array
 
         Parameters
         ----------
@@ -81,103 +83,46 @@ class VarHandler(object):
             The name of the variable that we are going to be indexing.
         sets : None or list of strings
             The sets that the variable is being asked to range over.
-        instances : None (if there are no sets) or a list of tuples (of the same size as sets)
-            The tuples that give the offsets into each set that we are ranging over.
+        instances : 2d array like of ints, shape (number of instances, len(sets))
+            The offsets into each set that we are ranging over.
 
         Returns
         -------
-        A list of integers that give the offsets into the variable list.
+        A numpy array of integers that give the offsets into the variable list.
 
         '''
 
-        # Some quick type etc checking on the way in
-        if not isinstance(name, str):
-            raise TypeError(f"get_index_list: Unsupported operand type for name, expecting string: '{format(type(name))}'")
-        
-        if not (sets is None or isinstance(sets, list)):
-            raise TypeError(f"get_index_list: Unsupported operand type for sets, expecting None or list of strings: '{format(type(sets))}'")
-            
-        if not (instances is None or isinstance(instances, list)):
-            raise TypeError(f"get_index_list: Unsupported operand type for instances, expecting None or list of ints: '{format(type(instances))}'")
-
-        if ((sets is None) and (instances is not None)) or ((sets is not None) and (instances is None)):
-            raise TypeError(f"get_index_list: Expected sets and instances to either both be None, or neither be None: '{format(type(sets))}', '{format(type(instances))}'")
-
         if name not in self.names:
-            raise ValueError(f"get_index_list: Could not find variable {name}")
+            raise ValueError(f"get_index_array: Could not find variable {name}")
 
-        if sets is None:
-            insetslen = 0
-        else:
-            insetslen = len(sets)
-            
-        if self.sets[name] is None:
-            mysetslen = 0
-        else:
-            mysetslen = len(self.sets[name])
+        insetslen = 0 if sets is None else len(sets)
+        mysetslen = 0 if self.sets[name] is None else len(self.sets[name])
         if insetslen != mysetslen:
-            raise ValueError(f"get_index_list: Variable {name} ranging over sets {sets} inconsistent with defined sets {self.sets[name]}\n")
-        
-        # If its width 1 this is super easy - though remember we need to return a vector as long as the instances passed in
-        
-        if mysetslen == 0:
-            return([self.offsets[name]] * len(instances))
+            raise ValueError(f"get_index_array: Variable {name} ranging over sets {sets} inconsistent with defined sets {self.sets[name]}\n")
 
-        # First, get the mappings from the sets over which we are expected to range and the sets over which the variable is defined
-        setsizes = self.setmanager.get_sizes()
-        setpairs = [i[:2] for i in self.setmanager.mappings]
+        instances = np.asarray(instances, dtype=np.int64)
+        if instances.ndim == 1:
+            instances = instances.reshape(-1, mysetslen) if mysetslen > 0 else instances.reshape(-1, 0)
 
+        if mysetslen == 0:
+            return np.full(instances.shape[0], self.offsets[name], dtype=np.int64)
 
-        mymappings = []
-        mysizes = []
-        for i in range(len(sets)):
-            # If its the native set, just a zip over the set size
+        # Map each column from the set we are ranging over into the set the variable is defined over,
+        # then combine the columns with the usual row major strides
+        setsizes = self.setmanager.get_sizes()
+        mysizes = [setsizes[s] for s in self.sets[name]]
+        columns = []
+        for i in range(mysetslen):
             if sets[i] == self.sets[name][i]:
-                mymappings.append([j for j in range(setsizes[sets[i]])])
+                columns.append(instances[:, i])
             else:
-                try:
-                    index = setpairs.index([self.sets[name][i], sets[i]])
-                except:
+                mapping = self.setmanager.get_mapping(self.sets[name][i], sets[i])
+                if mapping is None:
                     raise ValueError(f"Error resolving mapping from set {sets[i]} to {self.sets[name][i]} for variable {name}.")
-                mymappings.append(self.setmanager.mappings[index][2])
-            mysizes.append(setsizes[self.sets[name][i]])
+                columns.append(np.asarray(mapping, dtype=np.int64)[instances[:, i]])
 
+        return self.offsets[name] + np.ravel_multi_index(columns, mysizes)
 
-        result = []
-        
-        # Iterate over each instance in instances ASDF
-        for instance in instances:
-            temp = []
-            
-            # Iterate over indices i from 0 to mysetslen-1
-            for i in range(mysetslen):
-                # Access elements from mymappings using instance[i] as an index for each inner list
-                temp.append(mymappings[i][instance[i]])
-            
-            # Append the temporary list to the result list
-            result.append(temp)
-        
-        # result now contains the expanded list
-
-
-        
-        transformedinstances = [[mymappings[i][instance[i]] for i in range(mysetslen)] for instance in instances]
-        baseoffset = self.offsets[name]
-        indexoffsets = []
-        # These offsets will ensure that the offsets behave a bit like regular
-        # representation of numbers
-        # eg, hundreds, tens, units
-        # So - the leftmost index has the biggest "jumps" in the list, whereas the
-        # rightmost index behaves more like units and only moves by 1
-        for i in range(mysetslen):
-            indexoffset = 1
-            for j in range(i+1,mysetslen):
-                indexoffset = indexoffset * mysizes[j]
-            indexoffsets.append(indexoffset)
-        
-        indexes = [baseoffset + sum([ti[i] * indexoffsets[i] for i in range(mysetslen)]) for ti in transformedinstances]
-        return(indexes)
-            
     def __contains__(self,item):
         return item in self.names
 
@@ -203,71 +148,63 @@ class DataVarHandler(VarHandler):
             
     def read_from_files(self, files):
         
-        # This reads all the values from the files and returns a list of all dvars
+        # This reads all the values from the files and returns a float64 array of all dvars
         # including those that are zeros (ie not read)
         
         if not isinstance(files,dict):
             raise TypeError(f"read from files: Unsupported operand types for files, expected dict, got '{format(type(files))}'.'")
             
-        retvect = []
+        retvect = np.zeros(self.current_size)
+        
+        # element -> position lookups, built once per set
+        lookups = {}
 
         for i in self.names:
             file, sheet = self.files_and_sheets[i]
-            # Not every datavar is read from a file, those that are not will have Nones
-            if file:
-                # We cannot guarantee that the order in the file will match our needs
-                # (in fact no reason to believe it will), nor that every value will be
-                # present (which we should warn about).
-                # So, we will read, reindex, sort, reset index, and convert NaNs to zeros
-                # and warn as required
-                
-                # TODO implement wanings for missing values
-                # TODO check column names are correct
-                
-                try:
-                    workingdf = files[file][sheet]
-                except:
-                    raise ValueError(f"read_from_files - Could not find data {sheet} in file {file}.")
-                
-                # If it has no dimension (ie, a single value) then we can just get the value
-                
-                if self.sets[i]:
-                    # build a list of tuples that match our desired order
-                    
-                    temp = [self.setmanager.cge_sets[j].elements for j in self.sets[i]]
-                    
-                    # if there is only a single set (ie, temp is len 1) then the product below
-                    # will give us a list of single element tuples, but the reindex doesnt like that,
-                    # it just wants a list of strings
-                    if len(temp) == 1:
-                        indexorder = temp[0]
-                    else:
-                        # Note!!! The * operator below unpacks the unknown number of lists that
-                        # are packed up in temp and passes them as individual arguments to the list function
-                        indexorder = list(itertools.product(*temp))
-                    
-                    try:
-                        # multiindex, set order to the product above, and reset the index
-                        df_multiindex = workingdf.set_index(workingdf.columns[:-1].tolist())
-                        df_reordered = df_multiindex.reindex(list(indexorder))
-                        df_reordered.reset_index(inplace=True)
-                    except:
-                        raise ValueError(f"read_from_files - Error reprocessing header {i}. Is there a mismatch between the dimensions defined in the model file and the dimensions in {file}?")
-                        
-                    if df_reordered['Value'].isna().any():
-                        raise ValueError(f"read_from_files - Missing values detected when reading header {i}.")
-                    values = df_reordered['Value'].tolist()
-                else:
-                    values = [workingdf['Value'].loc[0]]
-            else:
-                values = [0] * self.sizes[i]
-                
-            # A check - the length of the values list should match our precalculated length
-            # If not something has gone badly wrong!!!
-            if len(values) != self.sizes[i]:
-                raise ValueError(f"read_from_files - read vector length doesnt match predetermined length for variable {i}.")
-                            
-            retvect = retvect + values    
+            # Not every datavar is read from a file, those that are not will stay as zeros
+            if not file:
+                continue
+            
+            try:
+                workingdf = files[file][sheet]
+            except:
+                raise ValueError(f"read_from_files - Could not find data {sheet} in file {file}.")
+            
+            # If it has no dimension (ie, a single value) then we can just get the value
+            if not self.sets[i]:
+                retvect[self.offsets[i]] = workingdf['Value'].loc[0]
+                continue
+            
+            # We cannot guarantee that the order in the file will match our needs
+            # (in fact no reason to believe it will), nor that every value will be
+            # present. So each row is placed by looking up the position of each of its
+            # elements in the corresponding set. Rows for elements that are not in the
+            # sets are ignored.
+            
+            # TODO check column names are correct
+            indexcolumns = workingdf.columns[:-1]
+            if len(indexcolumns) != len(self.sets[i]):
+                raise ValueError(f"read_from_files - Error reprocessing header {i}. Is there a mismatch between the dimensions defined in the model file and the dimensions in {file}?")
+            
+            positions = []
+            for column, setname in zip(indexcolumns, self.sets[i]):
+                if setname not in lookups:
+                    lookups[setname] = {element: position for position, element in enumerate(self.setmanager.cge_sets[setname].elements)}
+                positions.append(workingdf[column].map(lookups[setname]).fillna(-1).to_numpy(dtype=np.int64))
+            
+            inset = np.all(np.column_stack(positions) >= 0, axis=1)
+            sizes = [len(self.setmanager.cge_sets[setname].elements) for setname in self.sets[i]]
+            flat = np.ravel_multi_index([p[inset] for p in positions], sizes)
+            values = workingdf['Value'].to_numpy(dtype=float)[inset]
+            
+            if len(np.unique(flat)) != len(flat):
+                raise ValueError(f"read_from_files - Error reprocessing header {i}. Is there a mismatch between the dimensions defined in the model file and the dimensions in {file}?")
+            
+            # Every element of the variable needs a value
+            if len(flat) != self.sizes[i] or np.isnan(values).any():
+                raise ValueError(f"read_from_files - Missing values detected when reading header {i}.")
+            
+            retvect[self.offsets[i] + flat] = values
             
         return retvect
                     
@@ -288,6 +225,15 @@ class SolVarHandler(VarHandler):
         
     def ischange(self, name):
         return self.change[name]
+    
+    def change_mask(self):
+        '''
+        Returns
+        -------
+        A boolean array over every column of the svars, true where the column belongs to a
+        change (rather than a percentage change) variable
+        '''
+        return np.repeat([self.change[name] for name in self.names], [self.sizes[name] for name in self.names]).astype(bool)
             
             
             
\ No newline at end of file
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+A pool of worker processes for running policy scenarios, each holding a warm PolicyEngine.
+
+Setting up a model (reading the data, parsing and differentiating) is done once per worker
+rather than once per scenario. Where processes can be forked the engine is set up once in the
+parent before the workers are started, and the workers share it copy on write. Otherwise (eg
+on Windows) each worker sets it up when it starts, from the compiled model.
+
+Forking is only safe while the parent has no other threads - a lock held by another thread at
+the time of the fork stays held forever in the child. Create the pool before the process starts
+threads of its own (the api server does it in its startup hook, before any request is served).
+If the parent already has other threads the workers are spawned instead.
+
+Each worker runs one scenario at a time, writing its outputs into the directory given for the
+scenario, and reports every completed step back to the parent through a queue. The model, the
+data and the closures are found through the model directory, so the workers never change their
+current directory.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import solver
+
+
+# The queue the worker reports completed steps on, set by _worker_init
+_worker_progress = None
+
+
+def _worker_init(modeldir, model_file, ymlfile, cachedir, progress):
+    global _worker_progress
+    _worker_progress = progress
+
+    solver.get_policy_engine(model_file=model_file, ymlfile=ymlfile, cachedir=cachedir, basedir=modeldir)
+
+
+def _worker_run(modeldir, model_file, ymlfile, cachedir, config, outputdir, scenario_id):
+    engine = solver.get_policy_engine(model_file=model_file, ymlfile=ymlfile, cachedir=cachedir, basedir=modeldir)
+
+    def publish(result):
+        _worker_progress.put((scenario_id, result.simtype, result.step, result.svarnames, result.aggregated_svars()))
+
+    engine.run_policy(dict(config, outputdir=outputdir), callback=publish)
+
+
+class WorkerPool(object):
+    '''
+    WorkerPool
+
+    A fixed number of worker processes, each able to run a policy scenario against its own warm
+    PolicyEngine for the model. If a worker dies the scenarios running at the time fail, and the
+    pool is replaced by a new one for those that follow.
+    '''
+    def __init__(self, workers, modeldir, model_file="orani.model", ymlfile="default.yml", cachedir=None, onstep=None):
+        '''
+        Parameters
+        ----------
+        workers: The number of worker processes
+        modeldir: The directory holding the model, the yml file and the data
+        model_file: The model file, relative to modeldir
+        ymlfile: The yml file, relative to modeldir
+        cachedir: Optional directory for the on disk baseline cache, shared by the workers
+        onstep: If given, called (on a thread of the pool) with the scenario id, the simulation,
+                the step, the svar names and the aggregated svars of each step a worker completes
+        '''
+        self.workers = workers
+        self.modeldir = os.path.abspath(modeldir)
+        self.model_file = model_file
+        self.ymlfile = ymlfile
+        self.cachedir = cachedir
+        self.onstep = onstep
+        self.lock = threading.Lock() # Held while the executor is replaced
+
+        self._start()
+
+    def _start(self):
+        # Fork only while this is the only thread. A pool replaced while a server is running is
+        # always spawned, as the listener thread of the old one is still alive.
+        if "fork" in multiprocessing.get_all_start_methods() and threading.active_count() == 1:
+            context = multiprocessing.get_context("fork")
+            solver.get_policy_engine(model_file=self.model_file, ymlfile=self.ymlfile, cachedir=self.cachedir,
+                                     basedir=self.modeldir)
+        else:
+            context = multiprocessing.get_context("spawn")
+
+        self.progress = context.Queue()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_worker_init,
+                                            initargs=(self.modeldir, self.model_file, self.ymlfile, self.cachedir,
+                                                      self.progress))
+
+        # Start every worker now, rather than on the first scenario
+        for future in [self.executor.submit(os.getpid) for i in range(self.workers)]:
+            future.result()
+
+        self.listener = threading.Thread(target=self._listen, args=(self.progress,), name="workerpool-progress",
+                                         daemon=True)
+        self.listener.start()
+
+    def _listen(self, progress):
+        while True:
+            message = progress.get()
+            if message is None:
+                return
+            if self.onstep is not None:
+                self.onstep(*message)
+
+    def _replace(self, broken):
+        '''
+        Replace the executor after a worker died, unless another scenario already has
+
+        Returns
+        -------
+        The executor to use from now on
+        '''
+        with self.lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False)
+                self.progress.put(None)
+                self._start()
+            return self.executor
+
+    def run(self, config, outputdir, scenario_id=None):
+        '''
+        Run a policy scenario on one of the workers, blocking until it is done
+
+        Parameters
+        ----------
+        config: The scenario, as for PolicyEngine.run_policy
+        outputdir: The directory to write the outputs to
+        scenario_id: Passed to onstep with each completed step
+
+        Returns
+        -------
+        None. Raises BrokenProcessPool if a worker died while the scenario was running.
+        '''
+        args = (_worker_run, self.modeldir, self.model_file, self.ymlfile, self.cachedir,
+                config, os.path.abspath(outputdir), scenario_id)
+
+        executor = self.executor
+        try:
+            future = executor.submit(*args)
+        except BrokenProcessPool:
+            # A worker died before this scenario was submitted, so it can go on the new pool
+            executor = self._replace(executor)
+            future = executor.submit(*args)
+
+        try:
+            future.result()
+        except BrokenProcessPool:
+            self._replace(executor)
+            raise
+
+    def shutdown(self):
+        with self.lock:
+            self.executor.shutdown()
+            self.progress.put(None)
+            self.listener.join()
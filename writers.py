@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Writing out the results of a model.
+
+The reporting vars (base, policy) and the write statements of the model file can go out as
+Excel workbooks (the default, through openpyxl) or in a columnar format:
+
+- parquet: one .parquet file per table
+- arrow: one .arrow file per table, in the Arrow IPC file format (aka Feather v2)
+- csv: one .csv file per table
+
+A table that would have been the sheet {sheet} of {stem}.xlsx is written to {stem}.{sheet}.parquet
+(or .arrow/.csv). In the columnar formats the long format tables identify each row by a dictionary
+encoded variable column and element column (eg x1 and AG_dom_AG) rather than by the full name
+(x1_AG_dom_AG), and the values go straight from the numpy history into the columns.
+
+Parquet and Arrow need pyarrow, which is optional.
+"""
+
+import glob
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+OUTPUT_FORMATS = ["xlsx", "parquet", "arrow", "csv"]
+
+EXTENSIONS = {"xlsx": ".xlsx", "parquet": ".parquet", "arrow": ".arrow", "csv": ".csv"}
+
+
+def check_format(outputformat):
+    '''
+    Returns
+    -------
+    None if the output format can be written, otherwise a message saying why not
+    '''
+    if outputformat not in OUTPUT_FORMATS:
+        return f"outputformat must be one of {OUTPUT_FORMATS}, got '{outputformat}'"
+    if outputformat in ["parquet", "arrow"] and pyarrow is None:
+        return f"outputformat {outputformat} needs pyarrow, which is not installed"
+    return None
+
+
+def table_path(stem, table, outputformat):
+    '''
+    Returns
+    -------
+    The path of the file a table goes to in a columnar format
+    '''
+    return f"{stem}.{table}{EXTENSIONS[outputformat]}"
+
+
+def output_paths(stem, outputformat):
+    '''
+    Returns
+    -------
+    The paths of the files written under a stem (eg base) that exist
+    '''
+    if outputformat == "xlsx":
+        return glob.glob(glob.escape(stem) + ".xlsx")
+    return sorted(glob.glob(glob.escape(stem) + ".*" + EXTENSIONS[outputformat]))
+
+
+def table_names(stem, outputformat):
+    '''
+    Returns
+    -------
+    The names of the tables written under a stem in a columnar format, in the order of
+    output_paths
+    '''
+    prefix = len(stem) + 1
+    suffix = len(EXTENSIONS[outputformat])
+    return [path[prefix:-suffix] for path in output_paths(stem, outputformat)]
+
+
+def column_labels(handler):
+    '''
+    Returns
+    -------
+    For every column of the handler's values, the position of its variable in handler.names
+    and its element label (the full name without the variable name, empty for a scalar)
+    '''
+    variablecodes = np.repeat(np.arange(len(handler.names)), [handler.sizes[name] for name in handler.names])
+    elements = np.array([fullname[len(handler.names[code]) + 1:] for fullname, code in zip(handler.fullnames, variablecodes)], dtype=object)
+    return variablecodes, elements
+
+
+def long_frame(handler, offsets, values, headings, label, encoded):
+    '''
+    Build a long format table of the variables at the given offsets
+
+    Parameters
+    ----------
+    handler: The SolVarHandler or DataVarHandler the offsets refer to
+    offsets: Offsets of the rows into the handler's values
+    values: A (len(offsets), len(headings)) array of values
+    headings: The headings of the value columns
+    label: The heading of the full name column (eg SVAR)
+    encoded: If true the rows are identified by dictionary encoded variable and element
+             columns, otherwise by a column of full names
+
+    Returns
+    -------
+    The dataframe
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if encoded:
+        variablecodes, elements = column_labels(handler)
+        columns = {"variable": pd.Categorical.from_codes(variablecodes[offsets], categories=handler.names),
+                   "element": pd.Categorical(elements[offsets])}
+    else:
+        columns = {label: np.array(handler.fullnames, dtype=object)[offsets]}
+    for k, heading in enumerate(headings):
+        columns[heading] = values[:, k]
+    return pd.DataFrame(columns)
+
+
+def wide_frame(handler, name, values, headings):
+    '''
+    Build a table of one variable in the same layout as the input data - a column for each
+    set it ranges over, then the values
+
+    Parameters
+    ----------
+    handler: The SolVarHandler or DataVarHandler holding the variable
+    name: The name of the variable
+    values: A (size of the variable, len(headings)) array of its values
+    headings: The headings of the value columns. A single value column is headed Value
+
+    Returns
+    -------
+    The dataframe
+    '''
+    sets = handler.sets[name] or []
+    elements = [np.asarray(handler.setmanager.cge_sets[s].elements, dtype=object) for s in sets]
+    
+    # The elements of each set for every column of the variable, in the same (row major) order
+    # as the values
+    columns = []
+    if sets:
+        positions = np.indices([len(e) for e in elements]).reshape(len(sets), -1)
+        columns = [e[p] for e, p in zip(elements, positions)]
+    columns = columns + [values[:, k] for k in range(values.shape[1])]
+    
+    # The columns go in by position, as a variable can range over the same set more than once
+    df = pd.DataFrame(dict(enumerate(columns)))
+    df.columns = list(sets) + (["Value"] if len(headings) == 1 else list(headings))
+    return df
+
+
+def wide_frames(handler, offsets, values, headings):
+    '''
+    Build a wide_frame for each of the variables whose columns are among the offsets
+
+    Parameters
+    ----------
+    handler: The SolVarHandler or DataVarHandler the offsets refer to
+    offsets: Sorted offsets of the rows into the handler's values, covering whole variables
+    values: A (len(offsets), len(headings)) array of values
+
+    Returns
+    -------
+    A dictionary of variable name to dataframe
+    '''
+    frames = {}
+    for name in handler.names:
+        start = np.searchsorted(offsets, handler.offsets[name])
+        if start < len(offsets) and offsets[start] == handler.offsets[name]:
+            frames[name] = wide_frame(handler, name, values[start:start + handler.sizes[name]], headings)
+    return frames
+
+
+def write_tables(stem, tables, outputformat):
+    '''
+    Write out a dictionary of table name to dataframe, as the sheets of {stem}.xlsx or as one
+    file per table
+    '''
+    if outputformat == "xlsx":
+        with pd.ExcelWriter(stem + ".xlsx", engine='openpyxl') as writer:
+            for table, df in tables.items():
+                df.to_excel(writer, sheet_name=table, index=False)
+        return
+
+    for table, df in tables.items():
+        path = table_path(stem, table, outputformat)
+        if outputformat == "parquet":
+            df.to_parquet(path, index=False)
+        elif outputformat == "arrow":
+            df.to_feather(path)
+        else:
+            df.to_csv(path, index=False)
+
+
+def read_long(stem, table, outputformat, label):
+    '''
+    Read back a long format table as written by long_frame and write_tables, with the rows
+    identified by their full names in the label column whatever the format
+
+    Returns
+    -------
+    The dataframe
+    '''
+    if outputformat == "xlsx":
+        return pd.read_excel(stem + ".xlsx", sheet_name=table)
+
+    path = table_path(stem, table, outputformat)
+    if outputformat == "parquet":
+        df = pd.read_parquet(path)
+    elif outputformat == "arrow":
+        df = pd.read_feather(path)
+    else:
+        # Only empty cells are missing, so that elements such as NA survive the round trip
+        df = pd.read_csv(path, dtype={"variable": str, "element": str}, keep_default_na=False, na_values=[""], float_precision="round_trip")
+
+    variables = df["variable"].astype(str)
+    elements = df["element"].astype(object).fillna("").astype(str)
+    fullnames = variables.where(elements == "", variables + "_" + elements)
+    df = df.drop(columns=["variable", "element"])
+    df.insert(0, label, fullnames)
+    return df